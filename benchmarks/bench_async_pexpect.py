@@ -0,0 +1,57 @@
+"""pexpect版AsyncBaseConnectionの同時実行ベンチマーク
+
+疑似telnet装置(fake_device.py)に対して N セッションを同時に張り、
+ログインとコマンド実行にかかる時間を計測する。I/O待ちが重なっていれば
+N を増やしても経過時間はほぼ一定になり、スピードアップは N に近づく。
+
+pexpect版は ``telnet <ip>`` を起動するため、疑似装置は23番ポートで待ち受ける必要がある。
+
+    python benchmarks/bench_async_pexpect.py --concurrency 1 10 50 --latency 0.2
+"""
+import argparse
+import asyncio
+import time
+
+from fake_device import FakeDevice, ServerThread
+from pexnetlib.async_base_connection_pexpect import AsyncBaseConnection
+from pexnetlib.model import Device
+
+
+async def run_session(ip: str, commands: list[str]) -> None:
+    device = Device(ip=ip, username="admin", password="admin", enable="", device_type="cisco_telnet")
+    async with AsyncBaseConnection(device, timeout=10) as conn:
+        for command in commands:
+            await conn.send_command(command, read_timeout=10)
+
+
+async def run_concurrent(ip: str, sessions: int, commands: list[str]) -> float:
+    start = time.perf_counter()
+    await asyncio.gather(*(run_session(ip, commands) for _ in range(sessions)))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--latency", type=float, default=0.2, help="コマンド応答の遅延(秒)")
+    parser.add_argument("--commands", type=int, default=3, help="1セッションあたりのコマンド数")
+    args = parser.parse_args()
+
+    device = FakeDevice(latency=args.latency, outputs={"show version": "Fake IOS Software"})
+    server = ServerThread(device, args.host, args.port).start()
+    commands = ["show version"] * args.commands
+
+    try:
+        baseline = asyncio.run(run_concurrent(args.host, 1, commands))
+        print(f"{'sessions':>8} {'elapsed[s]':>11} {'speedup':>8}")
+        for sessions in args.concurrency:
+            elapsed = asyncio.run(run_concurrent(args.host, sessions, commands))
+            print(f"{sessions:>8} {elapsed:>11.3f} {sessions * baseline / elapsed:>8.1f}")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
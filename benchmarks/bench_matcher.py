@@ -0,0 +1,100 @@
+"""StreamMatcherのベンチマーク
+
+数MBの擬似 show running-config 出力を1024バイトずつ流し込み、
+旧実装(bytesの += 連結 + チャンク単位の検索)と処理時間を比較する。
+サイズを倍にしたときに処理時間もほぼ倍になれば線形時間で動作している。
+
+    python benchmarks/bench_matcher.py --sizes 1 2 4 8
+"""
+import argparse
+import time
+
+from pexnetlib.matcher import StreamMatcher
+
+CHUNK_SIZE = 1024
+PROMPT = b"switch01#"
+
+
+def make_output(size_mb: int) -> bytes:
+    """プロンプトで終わる擬似コマンド出力を生成"""
+    lines = []
+    total = 0
+    index = 0
+    while total < size_mb * 1024 * 1024:
+        line = f"interface GigabitEthernet1/0/{index}\r\n description uplink-{index}\r\n!\r\n".encode()
+        lines.append(line)
+        total += len(line)
+        index += 1
+    lines.append(b"end\r\n\r\n" + PROMPT)
+    return b"".join(lines)
+
+
+def chunks_of(data: bytes, split_prompt: bool) -> list[bytes]:
+    chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+    if split_prompt:
+        # プロンプトがチャンク境界をまたぐように最後の2チャンクを組み直す
+        tail = chunks.pop()
+        if len(tail) < len(PROMPT):
+            tail = chunks.pop() + tail
+        cut = len(tail) - len(PROMPT) // 2
+        chunks.extend([tail[:cut], tail[cut:]])
+    return chunks
+
+
+def legacy_expect(chunks: list[bytes], pattern: bytes) -> bytes:
+    """旧実装相当: += 連結と最新チャンクのみの検索"""
+    data = b""
+    buffer = b""
+    for chunk in chunks:
+        data += chunk
+        buffer = (buffer + chunk)[-4096:]
+        if pattern in chunk:
+            break
+    return data
+
+
+def stream_expect(chunks: list[bytes], pattern: bytes, reg: bool) -> bytes:
+    matcher = StreamMatcher(pattern, reg=reg)
+    for chunk in chunks:
+        if matcher.feed(chunk):
+            break
+    else:
+        raise RuntimeError("pattern not found")
+    return matcher.getvalue()
+
+
+def bench(func, *args, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 2, 4, 8], help="出力サイズ(MB)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy", action="store_true", help="旧実装の計測を省略")
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'literal[s]':>11} {'regex[s]':>9} {'legacy[s]':>10} {'literal MB/s':>13}")
+    for size in args.sizes:
+        data = make_output(size)
+        chunks = chunks_of(data, split_prompt=True)
+
+        literal = bench(stream_expect, chunks, PROMPT, False, repeat=args.repeat)
+        regex = bench(stream_expect, chunks, rb"switch\d+#", True, repeat=args.repeat)
+        if args.skip_legacy:
+            legacy = "-"
+        else:
+            # 旧実装はチャンク境界をまたいだプロンプトを検出できないため境界を分割しない
+            legacy_chunks = chunks_of(data, split_prompt=False)
+            legacy = f"{bench(legacy_expect, legacy_chunks, PROMPT, repeat=args.repeat):.4f}"
+
+        print(f"{size:>4}MB {literal:>11.4f} {regex:>9.4f} {legacy:>10} {size / literal:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
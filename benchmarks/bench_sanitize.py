@@ -0,0 +1,76 @@
+"""出力整形(Sanitizer)のマイクロベンチマーク
+
+旧実装(呼び出しごとの正規表現コンパイル + 4回の全体replace)と
+Sanitizer.sanitize を大きな出力で比較する。
+
+    python benchmarks/bench_sanitize.py --sizes 1 4 16
+"""
+import argparse
+import re
+import timeit
+
+from pexnetlib.sanitizer import Sanitizer, strip_backspaces, strip_exec_timestamp, strip_pager_remnants
+
+PROMPT = "switch01#"
+COMMAND = "show running-config"
+
+
+def make_output(size_mb: int, ansi: bool) -> str:
+    lines = [COMMAND]
+    total = 0
+    index = 0
+    color = "\x1b[0m" if ansi else ""
+    while total < size_mb * 1024 * 1024:
+        line = f"{color}interface GigabitEthernet1/0/{index}\r\n description uplink-{index}\r\n!"
+        lines.append(line)
+        total += len(line)
+        index += 1
+    lines.append(PROMPT)
+    return "\r\n".join(lines)
+
+
+def legacy_sanitize(raw_data: str, command: str, pattern: str, echo: bool, ansi: bool) -> str:
+    """旧実装相当(ANSIの正規表現は元の記述が不正なため修正済みのものを使う)"""
+    if ansi:
+        ansi_escape = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+        raw_data = ansi_escape.sub("", raw_data)
+
+    if echo:
+        raw_data = raw_data.replace(command, "")
+        raw_data = (
+            raw_data.replace(f"!{pattern}", "")
+            .replace(f"!!{pattern}", "")
+            .replace(pattern, "")
+        )
+
+    return raw_data.strip()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 16], help="出力サイズ(MB)")
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [
+        ("plain", False, Sanitizer()),
+        ("ansi", True, Sanitizer(ansi=True)),
+        ("cisco-steps", False, Sanitizer(steps=[strip_exec_timestamp])),
+        ("all-steps", True, Sanitizer(ansi=True, steps=[strip_exec_timestamp, strip_backspaces, strip_pager_remnants])),
+    ]
+
+    print(f"{'case':>12} {'size':>6} {'legacy[ms]':>11} {'sanitizer[ms]':>14} {'ratio':>6}")
+    for size in args.sizes:
+        for name, ansi, sanitizer in cases:
+            raw_data = make_output(size, ansi)
+            legacy = timeit.timeit(
+                lambda: legacy_sanitize(raw_data, COMMAND, PROMPT, True, ansi), number=args.number
+            ) / args.number
+            new = timeit.timeit(
+                lambda: sanitizer.sanitize(raw_data, COMMAND, PROMPT, True), number=args.number
+            ) / args.number
+            print(f"{name:>12} {size:>4}MB {legacy * 1000:>11.2f} {new * 1000:>14.2f} {legacy / new:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
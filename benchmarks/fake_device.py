@@ -0,0 +1,416 @@
+"""ベンチマーク用の疑似telnet装置サーバ
+
+asyncioで動作する簡易telnetサーバ。Cisco/Apresiaのログインの流れとプロンプト、
+enable/configモード、ページャ(--More--)を再現し、コマンドごとに登録した出力を返す。
+応答の遅延、帯域制限、チャンクの分割(断片化)も指定できる。
+
+出力はコマンド文字列、またはFakeSessionを受け取って文字列を返す関数で登録する。
+JSONのシナリオファイルからも読み込める。
+
+    python benchmarks/fake_device.py --port 2323 --latency 0.2
+    python benchmarks/fake_device.py --vendor apresia --bandwidth 100000 --fragment 64
+    python benchmarks/fake_device.py --script scenario.json
+
+シナリオファイルの形式:
+
+    {"hostname": "switch01", "vendor": "cisco", "latency": 0.05,
+     "outputs": {"show version": "Cisco IOS Software ..."},
+     "output_files": {"show running-config": "running-config.txt"}}
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+from typing import Callable, Optional, Union
+
+IAC = 255
+SB = 250
+SE = 240
+WILL = 251
+WONT = 252
+DO = 253
+DONT = 254
+ECHO = 1
+SGA = 3
+
+Output = Union[str, Callable[["FakeSession"], str]]
+
+# ベンダごとのログインの流れ
+VENDOR_PROFILES = {
+    "cisco": {
+        "banner": "\r\nUser Access Verification\r\n\r\n",
+        "login_prompt": "Username: ",
+        "password_prompt": "Password: ",
+        "auth_failed": "\r\n% Authentication failed\r\n",
+        "pager_lines": 24,
+    },
+    "apresia": {
+        "banner": "\r\n",
+        "login_prompt": "login: ",
+        "password_prompt": "Password: ",
+        "auth_failed": "\r\nLogin incorrect\r\n",
+        "pager_lines": None,
+    },
+}
+
+PAGER = " --More-- "
+# Ciscoはキー入力後にバックスペースと空白で--More--を消す
+PAGER_ERASE = "\x08" * len(PAGER) + " " * len(PAGER) + "\x08" * len(PAGER)
+EXEC_TIMESTAMP = (
+    "Load for five secs: 1%/0%; one minute: 1%; five minutes: 1%\r\n"
+    "Time source is hardware calendar, *12:00:00.000 UTC Mon Jan 1 2024\r\n\r\n"
+)
+
+
+class FakeDevice:
+    """1台分の装置の振る舞い
+
+    latency: コマンドを受け付けてから応答を返し始めるまでの遅延(秒)
+    bandwidth: 送信速度の上限(バイト/秒)。Noneの場合は制限しない
+    fragment_size: 1回の送信で書き込む最大バイト数。受信側のチャンク分割を再現する
+    pager_lines: ページャを有効にする行数。Noneの場合はベンダの既定値
+                 (Ciscoは24行、terminal length 0で無効化)
+    """
+
+    def __init__(
+        self,
+        hostname: str = "switch01",
+        username: str = "admin",
+        password: str = "admin",
+        login_prompt: Optional[str] = None,
+        latency: float = 0.0,
+        outputs: Optional[dict[str, Output]] = None,
+        vendor: str = "cisco",
+        enable_password: str = "enable",
+        pager_lines: Optional[int] = None,
+        bandwidth: Optional[float] = None,
+        fragment_size: Optional[int] = None,
+        fragment_delay: float = 0.0,
+    ) -> None:
+        if vendor not in VENDOR_PROFILES:
+            raise ValueError(f"Unsupported vendor: {vendor}")
+        self.profile = VENDOR_PROFILES[vendor]
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.login_prompt = login_prompt or self.profile["login_prompt"]
+        self.latency = latency
+        self.outputs: dict[str, Output] = outputs or {}
+        self.vendor = vendor
+        self.enable_password = enable_password
+        self.pager_lines = pager_lines if pager_lines is not None else self.profile["pager_lines"]
+        self.bandwidth = bandwidth
+        self.fragment_size = fragment_size
+        self.fragment_delay = fragment_delay
+        # 統計情報
+        self.sessions = 0
+        self.commands = 0
+
+    @classmethod
+    def from_script(cls, path: str) -> "FakeDevice":
+        """JSONのシナリオファイルから作成する"""
+        with open(path) as f:
+            script = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(path))
+        outputs: dict[str, Output] = dict(script.pop("outputs", {}))
+        for command, filename in script.pop("output_files", {}).items():
+            with open(os.path.join(base_dir, filename)) as f:
+                outputs[command] = f.read()
+        return cls(outputs=outputs, **script)
+
+    def prompt(self) -> str:
+        return f"{self.hostname}>"
+
+    def respond(self, command: str) -> str:
+        output = self.outputs.get(command, "")
+        return output if isinstance(output, str) else output(FakeSession(self))
+
+
+class FakeSession:
+    """1セッション分の状態(モード、ページャ設定)"""
+
+    def __init__(self, device: FakeDevice) -> None:
+        self.device = device
+        self.mode = "user"
+        self.pager_lines = device.pager_lines
+        self.exec_timestamp = False
+
+    def prompt(self) -> str:
+        hostname = self.device.hostname
+        if self.mode == "config":
+            return f"{hostname}(config)#"
+        if self.mode == "enable":
+            return f"{hostname}#"
+        return f"{hostname}>"
+
+    def builtin(self, command: str) -> Optional[str]:
+        """モード遷移などの組み込みコマンドを処理する。該当しない場合はNone"""
+        words = command.split()
+        if words[:2] == ["terminal", "length"] and len(words) == 3 and words[2].isdigit():
+            self.pager_lines = int(words[2]) or None
+            return ""
+        if words == ["terminal", "exec", "prompt", "timestamp"]:
+            self.exec_timestamp = True
+            return ""
+        if words in (["configure", "terminal"], ["conf", "t"]) and self.mode == "enable":
+            self.mode = "config"
+            return "Enter configuration commands, one per line.  End with CNTL/Z."
+        if words == ["end"] and self.mode == "config":
+            self.mode = "enable"
+            return ""
+        if words == ["exit"] and self.mode == "config":
+            self.mode = "enable"
+            return ""
+        if words == ["disable"] and self.mode == "enable":
+            self.mode = "user"
+            return ""
+        return None
+
+    def respond(self, command: str) -> str:
+        output = self.device.outputs.get(command, "")
+        return output if isinstance(output, str) else output(self)
+
+
+class _TelnetLineReader:
+    """IACシーケンスを取り除きながら1行ずつ読み込む"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.pending = bytearray()
+        self._last_was_cr = False
+
+    async def readline(self, echo: bool = True) -> Optional[str]:
+        line = bytearray()
+        while True:
+            if not self.pending:
+                data = await self.reader.read(1024)
+                if not data:
+                    return None
+                self.pending += data
+
+            byte = self.pending.pop(0)
+            if byte == IAC:
+                await self._skip_command()
+                continue
+            if byte in (0, 10) and not line and self._last_was_cr:
+                # CR LF / CR NUL の2バイト目
+                self._last_was_cr = False
+                continue
+            if byte in (13, 10):
+                self._last_was_cr = byte == 13
+                if echo:
+                    self.writer.write(b"\r\n")
+                return line.decode(errors="ignore")
+
+            self._last_was_cr = False
+            line.append(byte)
+            if echo:
+                self.writer.write(bytes([byte]))
+
+    async def readkey(self) -> Optional[str]:
+        """ページャへの応答として1文字読み込む"""
+        while True:
+            try:
+                byte = await self._read_byte()
+            except ConnectionResetError:
+                return None
+            if byte == IAC:
+                await self._skip_command()
+                continue
+            if byte in (0, 10) and self._last_was_cr:
+                self._last_was_cr = False
+                continue
+            self._last_was_cr = byte == 13
+            return chr(byte)
+
+    async def _read_byte(self) -> int:
+        while not self.pending:
+            data = await self.reader.read(1024)
+            if not data:
+                raise ConnectionResetError
+            self.pending += data
+        return self.pending.pop(0)
+
+    async def _skip_command(self) -> None:
+        command = await self._read_byte()
+        if command in (WILL, WONT, DO, DONT):
+            await self._read_byte()
+        elif command == SB:
+            # SEが来るまで読み飛ばす
+            previous = 0
+            while True:
+                byte = await self._read_byte()
+                if previous == IAC and byte == SE:
+                    break
+                previous = byte
+
+
+async def _send(device: FakeDevice, writer: asyncio.StreamWriter, text: str) -> None:
+    """断片化と帯域制限を適用して送信する"""
+    data = text.encode()
+    step = device.fragment_size or len(data) or 1
+    for offset in range(0, len(data), step):
+        fragment = data[offset:offset + step]
+        writer.write(fragment)
+        await writer.drain()
+        delay = device.fragment_delay
+        if device.bandwidth:
+            delay += len(fragment) / device.bandwidth
+        if delay and offset + step < len(data):
+            await asyncio.sleep(delay)
+
+
+async def _send_output(
+    device: FakeDevice, session: FakeSession, lines: _TelnetLineReader, output: str
+) -> bool:
+    """ページャの設定に従って出力を送信する。qで中断された場合もTrue、切断時はFalse"""
+    writer = lines.writer
+    if not output:
+        return True
+    rows = output.split("\n")
+    page = session.pager_lines
+    if not page or len(rows) <= page:
+        await _send(device, writer, "\r\n".join(rows) + "\r\n")
+        return True
+
+    index = 0
+    while index < len(rows):
+        await _send(device, writer, "\r\n".join(rows[index:index + page]) + "\r\n")
+        index += page
+        if index >= len(rows):
+            break
+        await _send(device, writer, PAGER)
+        key = await lines.readkey()
+        if key is None:
+            return False
+        await _send(device, writer, PAGER_ERASE)
+        if key in ("q", "Q"):
+            break
+        # Enterは1行、それ以外のキーは1ページ進める
+        page = 1 if key in ("\r", "\n") else session.pager_lines or page
+    return True
+
+
+async def handle_session(
+    device: FakeDevice, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    lines = _TelnetLineReader(reader, writer)
+    session = FakeSession(device)
+    profile = device.profile
+    device.sessions += 1
+    try:
+        writer.write(bytes([IAC, WILL, ECHO, IAC, WILL, SGA]))
+        await _send(device, writer, f"{profile['banner']}{device.login_prompt}")
+        username = await lines.readline()
+        await _send(device, writer, profile["password_prompt"])
+        password = await lines.readline(echo=False)
+        if username != device.username or password != device.password:
+            await _send(device, writer, profile["auth_failed"])
+            return
+
+        await _send(device, writer, f"\r\n{session.prompt()}")
+        while True:
+            command = await lines.readline()
+            if command is None:
+                return
+            command = command.strip()
+            if command in ("exit", "quit", "logout") and session.mode != "config":
+                return
+            device.commands += 1
+
+            if command == "enable" and session.mode == "user":
+                await _send(device, writer, "Password: ")
+                secret = await lines.readline(echo=False)
+                if secret == device.enable_password:
+                    session.mode = "enable"
+                    await _send(device, writer, f"\r\n{session.prompt()}")
+                else:
+                    await _send(device, writer, f"\r\n% Bad secrets\r\n\r\n{session.prompt()}")
+                continue
+
+            if device.latency:
+                await asyncio.sleep(device.latency)
+
+            output = session.builtin(command)
+            if output is None:
+                output = session.respond(command)
+                if session.exec_timestamp and command.startswith("show"):
+                    output = EXEC_TIMESTAMP.replace("\r\n", "\n") + output
+            if not await _send_output(device, session, lines, output.replace("\r\n", "\n")):
+                return
+            await _send(device, writer, session.prompt())
+
+    except ConnectionResetError:
+        pass
+
+    finally:
+        writer.close()
+
+
+async def start_server(device: FakeDevice, host: str = "127.0.0.1", port: int = 0) -> asyncio.AbstractServer:
+    return await asyncio.start_server(
+        lambda r, w: handle_session(device, r, w), host=host, port=port
+    )
+
+
+class ServerThread(threading.Thread):
+    """ベンチマーク対象のイベントループを妨げないよう別スレッドでサーバを動かす"""
+
+    def __init__(self, device: FakeDevice, host: str = "127.0.0.1", port: int = 0) -> None:
+        super().__init__(daemon=True)
+        self.device = device
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(start_server(self.device, self.host, self.port))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self.loop.run_forever()
+
+    def start(self) -> "ServerThread":
+        super().start()
+        self._ready.wait()
+        return self
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2323)
+    parser.add_argument("--script", help="シナリオファイル(JSON)")
+    parser.add_argument("--vendor", choices=sorted(VENDOR_PROFILES), default="cisco")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=float, default=None, help="送信速度の上限(バイト/秒)")
+    parser.add_argument("--fragment", type=int, default=None, help="1回の送信の最大バイト数")
+    args = parser.parse_args()
+
+    if args.script:
+        device = FakeDevice.from_script(args.script)
+    else:
+        device = FakeDevice(
+            vendor=args.vendor,
+            latency=args.latency,
+            bandwidth=args.bandwidth,
+            fragment_size=args.fragment,
+            outputs={"show version": "Fake IOS Software"},
+        )
+
+    async def serve() -> None:
+        server = await start_server(device, args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
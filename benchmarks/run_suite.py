@@ -0,0 +1,385 @@
+"""疑似telnet装置を使った通しベンチマーク
+
+fake_device.pyのサーバを起動し、同期pexpect版(ConnectHandler)、非同期pexpect版
+(async_base_connection_pexpect)、telnetlib3版(ConnectHandlerAsync)の3つの実装で
+以下を計測してJSONに出力する。
+
+- sessions: ログインから切断までを繰り返したときのセッション数/秒
+- commands: コマンド数/秒と1コマンドあたりのレイテンシ(p50/p99)
+- textfsm: use_textfsm=Trueで同じコマンドを実行した場合のレイテンシと解析単体の処理時間
+- memory: セッションを張ったままにした場合の1セッションあたりのメモリ使用量
+  (Pythonヒープはtracemalloc、RSSは/proc/self/statmから。telnetの子プロセス分は含まない)
+
+疑似装置は--portで待ち受け、全実装が同じポートへ接続する(pexpect版は ``telnet <ip> <port>``。
+23番の場合はポートを省略する)。
+
+    python benchmarks/run_suite.py --output result.json
+    python benchmarks/run_suite.py --stacks telnetlib3 --rows 5000 --latency 0.05
+    python benchmarks/run_suite.py --output new.json --baseline result.json --tolerance 0.2
+
+--baselineを指定した場合、スループットの低下またはレイテンシの増加がtoleranceを超えた
+項目を表示して終了コード1で終了する。
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+
+from fake_device import FakeDevice, ServerThread
+
+import pexnetlib
+from pexnetlib import ConnectHandler, ConnectHandlerAsync
+from pexnetlib.async_base_connection_pexpect import AsyncBaseConnection as AsyncPexpectConnection
+from pexnetlib.model import Device
+from pexnetlib.textfsm_util import clear_template_cache, get_structured_data_textfsm
+
+STACKS = ("sync_pexpect", "sync_socket", "async_pexpect", "telnetlib3")
+COMMAND = "show interfaces description"
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+def make_output(rows: int) -> str:
+    lines = [f"{'Interface':<30} {'Status':<14} {'Protocol':<8} Description"]
+    for index in range(rows):
+        port = f"Gi{index // 48 + 1}/0/{index % 48 + 1}"
+        lines.append(f"{port:<30} {'up':<14} {'up':<8} uplink-{index}")
+    return "\n".join(lines)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+def latency_summary(latencies: list[float], elapsed: float) -> dict[str, float]:
+    return {
+        "count": len(latencies),
+        "per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class SyncStack:
+    """同期pexpect版。並列数はスレッドで確保する"""
+
+    name = "sync_pexpect"
+
+    def __init__(self, device: dict[str, str]) -> None:
+        self.device = device
+
+    def open(self) -> Any:
+        return ConnectHandler(self.device, timeout=10)
+
+    def close(self, conn: Any) -> None:
+        conn.disconnect()
+
+    def run(self, sessions: int, concurrency: int, work: Callable[[Any], list[float]]) -> tuple[float, list[float]]:
+        def session(_: int) -> list[float]:
+            conn = self.open()
+            try:
+                return work(conn)
+            finally:
+                self.close(conn)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(session, range(sessions)))
+        return time.perf_counter() - start, [value for result in results for value in result]
+
+    def commands(self, count: int, use_textfsm: bool) -> Callable[[Any], list[float]]:
+        def work(conn: Any) -> list[float]:
+            latencies = []
+            for _ in range(count):
+                start = time.perf_counter()
+                conn.send_command(COMMAND, use_textfsm=use_textfsm, read_timeout=10)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+        return work
+
+    def hold(self, sessions: int) -> tuple[int, Optional[int]]:
+        """sessions本を同時に張ったときのメモリ増加量(tracemalloc, RSS)を返す"""
+        gc.collect()
+        rss_before = rss_bytes()
+        tracemalloc.start()
+        conns = [self.open() for _ in range(sessions)]
+        heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        rss_after = rss_bytes()
+        for conn in conns:
+            self.close(conn)
+        rss = None if rss_before is None or rss_after is None else rss_after - rss_before
+        return heap, rss
+
+
+class SyncSocketStack(SyncStack):
+    """同期版のうち、telnetコマンドを起動せずソケットで直接接続するもの"""
+
+    name = "sync_socket"
+
+    def open(self) -> Any:
+        return ConnectHandler(self.device, timeout=10, transport="socket")
+
+
+class AsyncStack:
+    """telnetlib3版。並列数はセマフォで制限する"""
+
+    name = "telnetlib3"
+
+    def __init__(self, device: dict[str, str]) -> None:
+        self.device = device
+
+    async def open(self) -> Any:
+        conn = ConnectHandlerAsync(self.device, timeout=10)
+        await conn.telnet_initialize()
+        return conn
+
+    async def close(self, conn: Any) -> None:
+        conn.disconnect()
+
+    def run(self, sessions: int, concurrency: int, work: Callable[[Any], Any]) -> tuple[float, list[float]]:
+        async def main() -> tuple[float, list[float]]:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def session() -> list[float]:
+                async with semaphore:
+                    conn = await self.open()
+                    try:
+                        return await work(conn)
+                    finally:
+                        await self.close(conn)
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(session() for _ in range(sessions)))
+            return time.perf_counter() - start, [value for result in results for value in result]
+
+        return asyncio.run(main())
+
+    def commands(self, count: int, use_textfsm: bool) -> Callable[[Any], Any]:
+        async def work(conn: Any) -> list[float]:
+            latencies = []
+            for _ in range(count):
+                start = time.perf_counter()
+                await conn.send_command(COMMAND, use_textfsm=use_textfsm, read_timeout=10)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+        return work
+
+    def hold(self, sessions: int) -> tuple[int, Optional[int]]:
+        async def main() -> tuple[int, Optional[int]]:
+            gc.collect()
+            rss_before = rss_bytes()
+            tracemalloc.start()
+            conns = [await self.open() for _ in range(sessions)]
+            heap = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            rss_after = rss_bytes()
+            for conn in conns:
+                await self.close(conn)
+            rss = None if rss_before is None or rss_after is None else rss_after - rss_before
+            return heap, rss
+
+        return asyncio.run(main())
+
+
+class AsyncPexpectStack(AsyncStack):
+    """非同期pexpect版(ベンダクラスがないため基底クラスをそのまま使う)"""
+
+    name = "async_pexpect"
+
+    async def open(self) -> Any:
+        device = Device(**self.device)
+        conn = AsyncPexpectConnection(device, timeout=10)
+        await conn.telnet_initialize()
+        return conn
+
+    async def close(self, conn: Any) -> None:
+        # child.close()は子プロセスの終了を待つためスレッドで実行する
+        await asyncio.get_running_loop().run_in_executor(None, conn.disconnect)
+
+
+def no_work(conn: Any) -> list[float]:
+    return []
+
+
+async def async_no_work(conn: Any) -> list[float]:
+    return []
+
+
+def bench_stack(stack: Any, args: argparse.Namespace) -> dict[str, Any]:
+    is_async = isinstance(stack, AsyncStack)
+    result: dict[str, Any] = {}
+
+    elapsed, _ = stack.run(args.sessions, args.concurrency, async_no_work if is_async else no_work)
+    result["sessions"] = {
+        "count": args.sessions,
+        "concurrency": args.concurrency,
+        "elapsed_s": elapsed,
+        "per_second": args.sessions / elapsed,
+    }
+
+    elapsed, latencies = stack.run(args.concurrency, args.concurrency, stack.commands(args.commands, False))
+    result["commands"] = latency_summary(latencies, elapsed)
+
+    elapsed, latencies = stack.run(args.concurrency, args.concurrency, stack.commands(args.commands, True))
+    result["textfsm"] = latency_summary(latencies, elapsed)
+    result["textfsm"]["overhead_p50_ms"] = result["textfsm"]["p50_ms"] - result["commands"]["p50_ms"]
+
+    heap, rss = stack.hold(args.hold)
+    result["memory"] = {
+        "sessions": args.hold,
+        "python_heap_per_session": heap // args.hold,
+        "rss_per_session": None if rss is None else rss // args.hold,
+    }
+    return result
+
+
+def bench_parse(rows: int, repeat: int) -> dict[str, Any]:
+    """TextFSM解析単体の処理時間(テンプレートはキャッシュ済みの状態で計測)"""
+    raw_output = make_output(rows)
+    result: dict[str, Any] = {"rows": rows}
+    for name, compact in (("dicts", False), ("compact", True)):
+        get_structured_data_textfsm(raw_output, platform="cisco_telnet", command=COMMAND, compact=compact)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            get_structured_data_textfsm(raw_output, platform="cisco_telnet", command=COMMAND, compact=compact)
+        elapsed = (time.perf_counter() - start) / repeat
+        result[f"{name}_ms"] = elapsed * 1000
+        result[f"{name}_rows_per_second"] = rows / elapsed
+    return result
+
+
+# (項目のパス, 大きいほど良いか)
+COMPARED_METRICS = (
+    (("sessions", "per_second"), True),
+    (("commands", "per_second"), True),
+    (("commands", "p50_ms"), False),
+    (("commands", "p99_ms"), False),
+    (("textfsm", "p50_ms"), False),
+    (("memory", "python_heap_per_session"), False),
+)
+
+
+def compare(current: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    """baselineに対してtoleranceを超えて悪化した項目を返却する"""
+    regressions = []
+    for stack, result in current["stacks"].items():
+        base = baseline.get("stacks", {}).get(stack)
+        if base is None:
+            continue
+        for (section, key), higher_is_better in COMPARED_METRICS:
+            new, old = result[section].get(key), base.get(section, {}).get(key)
+            if not new or not old:
+                continue
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            if change > tolerance:
+                regressions.append(f"{stack}.{section}.{key}: {old:.3f} -> {new:.3f} ({change:+.0%})")
+
+    parse, base_parse = current.get("parse", {}), baseline.get("parse", {})
+    for key in ("dicts_ms", "compact_ms"):
+        new, old = parse.get(key), base_parse.get(key)
+        if new and old and (new - old) / old > tolerance:
+            regressions.append(f"parse.{key}: {old:.3f} -> {new:.3f} ({(new - old) / old:+.0%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23)
+    parser.add_argument("--stacks", nargs="+", choices=STACKS, default=list(STACKS))
+    parser.add_argument("--vendor", choices=("cisco", "apresia"), default="cisco")
+    parser.add_argument("--sessions", type=int, default=20, help="sessions計測で張るセッション数")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--commands", type=int, default=10, help="1セッションあたりのコマンド数")
+    parser.add_argument("--hold", type=int, default=10, help="memory計測で同時に張るセッション数")
+    parser.add_argument("--rows", type=int, default=500, help="コマンド出力の行数")
+    parser.add_argument("--latency", type=float, default=0.0, help="コマンド応答の遅延(秒)")
+    parser.add_argument("--bandwidth", type=float, default=None, help="送信速度の上限(バイト/秒)")
+    parser.add_argument("--fragment", type=int, default=None, help="1回の送信の最大バイト数")
+    parser.add_argument("--parse-repeat", type=int, default=20)
+    parser.add_argument("--output", help="結果を書き出すJSONファイル。省略時は標準出力")
+    parser.add_argument("--baseline", help="比較対象の結果JSONファイル")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="悪化とみなす変化率")
+    args = parser.parse_args()
+
+    os.environ["NET_TEXTFSM"] = TEMPLATE_DIR
+    clear_template_cache()
+
+    device = FakeDevice(
+        vendor=args.vendor,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        fragment_size=args.fragment,
+        # 非同期pexpect版はterminal length 0を送らないため、全実装でページャを無効にそろえる
+        pager_lines=0,
+        outputs={COMMAND: make_output(args.rows)},
+    )
+    server = ServerThread(device, args.host, args.port).start()
+    device_dict = {
+        "ip": args.host,
+        "device_type": f"{args.vendor}_telnet",
+        "username": device.username,
+        "password": device.password,
+        "enable": device.enable_password,
+        "port": args.port,
+    }
+    stack_classes = {"sync_pexpect": SyncStack, "sync_socket": SyncSocketStack, "async_pexpect": AsyncPexpectStack, "telnetlib3": AsyncStack}
+
+    report: dict[str, Any] = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "pexnetlib": pexnetlib.__version__,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "stacks": {},
+    }
+    try:
+        for name in args.stacks:
+            print(f"running {name} ...", file=sys.stderr)
+            report["stacks"][name] = bench_stack(stack_classes[name](device_dict), args)
+        report["parse"] = bench_parse(args.rows, args.parse_repeat)
+    finally:
+        server.stop()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,18 @@ from pexnetlib.base_connection import BaseConnection
 from pexnetlib.async_base_connection import AsyncBaseConnection
 from pexnetlib.vender.cisco_connection import CiscoConnection, CiscoConnectionAsync
 from pexnetlib.vender.apresia_connection import ApresiaConnection, ApresiaConnectionAsync
+from pexnetlib.vender.replay_connection import ReplayConnection, ReplayConnectionAsync
 
 CLASS_MAPPER_SYNC: dict[str, Type[BaseConnection]] = {
 	"cisco_telnet": CiscoConnection,
-	"apresia_telnet": ApresiaConnection
+	"apresia_telnet": ApresiaConnection,
+	"cisco_replay": ReplayConnection,
+	"apresia_replay": ReplayConnection
 }
 
 CLASS_MAPPER_ASYNC: dict[str, Type[AsyncBaseConnection]] = {
 	"cisco_telnet": CiscoConnectionAsync,
-	"apresia_telnet": ApresiaConnectionAsync
+	"apresia_telnet": ApresiaConnectionAsync,
+	"cisco_replay": ReplayConnectionAsync,
+	"apresia_replay": ReplayConnectionAsync
 }
\ No newline at end of file
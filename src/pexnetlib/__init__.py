@@ -1,6 +1,16 @@
 from pexnetlib.dispatcher import ConnectHandler, ConnectHandlerAsync
 from pexnetlib.base_connection import BaseConnection
 from pexnetlib.async_base_connection import AsyncBaseConnection
+from pexnetlib.fleet import run_fleet
+from pexnetlib.sharding import run_sharded
+from pexnetlib.multiplexer import Multiplexer, run_multiplexed
+from pexnetlib.pool import SessionPool, AsyncSessionPool
+from pexnetlib.table import ResultTable
+from pexnetlib.transcript import TranscriptManager
+from pexnetlib.instrumentation import HistogramCollector, Span, add_global_hook
+from pexnetlib.store import ResultStore
+from pexnetlib.change_cache import ChangeCache
+from pexnetlib.replay import ReplayArchive, ReplayArchiveWriter, set_replay_archive
 __version__ = "0.1.0"
 
-__all__ = ("ConnectHandler", "ConnectHandlerAsync", "BaseConnection", "AsyncBaseConnection")
+__all__ = ("ConnectHandler", "ConnectHandlerAsync", "BaseConnection", "AsyncBaseConnection", "run_fleet", "run_sharded", "Multiplexer", "run_multiplexed", "SessionPool", "AsyncSessionPool", "ResultTable", "TranscriptManager", "HistogramCollector", "Span", "add_global_hook", "ReplayArchive", "ReplayArchiveWriter", "set_replay_archive", "ResultStore", "ChangeCache")
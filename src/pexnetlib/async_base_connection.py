@@ -1,16 +1,54 @@
-import re
-import telnetlib3
+import asyncio
+from concurrent.futures import Executor
 from telnetlib3 import TelnetReaderUnicode
-from datetime import datetime, timedelta
-from typing import Any, Union, Generator, cast
-
+from typing import Any, AsyncIterator, BinaryIO, Iterable, Match, Optional, Pattern, Union, Generator, cast
+
+from pexnetlib.instrumentation import (
+    SPAN_AUTHENTICATE,
+    SPAN_COMMAND,
+    SPAN_CONNECT,
+    SPAN_FIND_PROMPT,
+    SPAN_INITIALIZE,
+    SPAN_LOGIN_PROMPT,
+    SPAN_PARSE,
+    SPAN_TCP_CONNECT,
+    Instrumented,
+    SpanHook,
+    get_global_hooks,
+)
+from pexnetlib.change_cache import ChangeCache, ChangeResult
+from pexnetlib.connect import open_telnet_async
 from pexnetlib.log import log
 from pexnetlib.logging_io import AsyncLogginIO
+from pexnetlib.matcher import StreamMatcher, compile_pattern
 from pexnetlib.model import Device
-from pexnetlib.textfsm_util import get_structured_data_textfsm
+from pexnetlib.pager import PagerDetector, pager_detector, pager_pattern_for, pager_remnant_step
+from pexnetlib.prompt import (
+    MODE_USER,
+    build_prompt_regex,
+    parse_prompt,
+    prompt_mode,
+    split_submode,
+)
+from pexnetlib.sanitizer import Sanitizer, SanitizeStep
+from pexnetlib.streaming import OutputStream
+from pexnetlib.table import ResultTable
+from pexnetlib.transcript import TranscriptManager
+from pexnetlib.textfsm_util import (
+    aiter_structured_data_textfsm,
+    get_structured_data_textfsm_async,
+    get_structured_data_textfsm_batch_async,
+)
 from pexnetlib.exception import ConnectionException, AuthenticationException, AsyncExpectTimeoutException
 
-class AsyncBaseConnection:
+class AsyncBaseConnection(Instrumented):
+    # 装置固有の出力整形処理。ベンダクラスで上書きする
+    sanitize_steps: tuple[SanitizeStep, ...] = ()
+    # ログイン後に実行するコマンド
+    init_commands: tuple[str, ...] = ()
+    # 装置がページャ(--More--)を表示するか。init_commandsでページャを無効にするベンダクラスはFalseにする
+    paging: bool = True
+
     def __init__(
         self,
         device: Device,
@@ -23,7 +61,12 @@ class AsyncBaseConnection:
         hostname="",
         prompt="",
         crlf=False,
-        ansi=False
+        ansi=False,
+        session_log: Optional[BinaryIO] = None,
+        transcript: Optional[TranscriptManager] = None,
+        hooks: Iterable[SpanHook] = (),
+        change_cache: Optional[ChangeCache] = None,
+        pager: Optional[bool] = None,
     ) -> None:
         # クラス変数を定義
         self.device = device
@@ -35,10 +78,38 @@ class AsyncBaseConnection:
         self.enable_prompt = enable_prompt
         self.hostname = hostname
         self.prompt = prompt
+        # 直前のプロンプトから判定したモード(user/enable/config-ifなど)
+        self.mode = MODE_USER
         self.crlf = crlf
         self.ansi = ansi
+        # 受信した生データをそのまま書き出す先(ファイルなど)
+        # transcriptを指定した場合はセッション専用のTranscriptWriterを作成して閉じるまで管理する
+        self._owns_session_log = session_log is None and transcript is not None
+        if self._owns_session_log:
+            session_log = transcript.open(device.ip)
+        self.session_log = session_log
+        # 出力中のページャ(--More--)に空白を送って読み進める。Noneの場合はクラスのpagingに従う
+        if pager is None:
+            pager = self.paging
+        self.pager_pattern = pager_pattern_for(device.device_type) if pager else None
+        steps = self.sanitize_steps
+        if self.pager_pattern is not None:
+            steps = (pager_remnant_step(self.pager_pattern), *steps)
+        self.sanitizer = Sanitizer(ansi=ansi, steps=steps)
+        # TextFSM解析に使うExecutor。Noneの場合はtextfsm_util.set_parse_executorの設定に従う
+        self.parse_executor: Optional[Executor] = None
+        # 計測結果(Span)を受け取るフック。空の場合は計測しない
+        self.hooks = [*get_global_hooks(), *hooks]
+        # 指定した場合は出力が前回から変化していなければTextFSMの解析を省略する
+        self.change_cache = change_cache
+        # 直前のコマンドの変化検出の結果
+        self.last_change: Optional[ChangeResult] = None
         self.reader = None
         self.writer = None
+        # 前回のexpectでパターンより後ろに受信していたデータ
+        self._pending = ""
+        # 直前のexpectで受信した文字数とチャンク数
+        self._last_read = (0, 0)
 
     def __await__(self) -> Generator[Any, None, "AsyncBaseConnection"]:
         async def wrapper() -> "AsyncBaseConnection":
@@ -54,41 +125,49 @@ class AsyncBaseConnection:
         self.disconnect()
     
     async def telnet_initialize(self) -> None:
-        await self.connect()
-        self.hostname, self.prompt = await self.find_prompt(self.user_prompt)
-        await self.initialize()
+        with self.span(SPAN_CONNECT):
+            await self.connect()
+        with self.span(SPAN_FIND_PROMPT):
+            self.hostname, self.prompt = await self.find_prompt(self.user_prompt)
+        with self.span(SPAN_INITIALIZE):
+            await self.initialize()
 
 
     async def connect(self) -> None:
-        reader, writer = await telnetlib3.open_connection(host=self.device.ip, port=23, encoding="utf-8")
+        with self.span(SPAN_TCP_CONNECT):
+            reader, writer = await open_telnet_async(self.device, self.timeout)
         if reader and writer:
-            self.reader = AsyncLogginIO(cast(TelnetReaderUnicode, reader), log)
+            self.reader = AsyncLogginIO(
+                cast(TelnetReaderUnicode, reader), log, sink=self.session_log
+            )
             self.writer = writer 
         else:
             raise RuntimeError
 
-        try:
-            # ログインにユーザネームが必要な場合
-            if self.use_username:
-                await self.expect(f"{self.login_prompt}", read_timeout=self.timeout)
-            else:
-                await self.expect(f"{self.password_prompt}", read_timeout=self.timeout)
+        with self.span(SPAN_LOGIN_PROMPT):
+            try:
+                # ログインにユーザネームが必要な場合
+                if self.use_username:
+                    await self.expect(f"{self.login_prompt}", read_timeout=self.timeout)
+                else:
+                    await self.expect(f"{self.password_prompt}", read_timeout=self.timeout)
 
-        except AsyncExpectTimeoutException:
-            # ログインプロンプトが返ってこないのはtelnet接続失敗と判断する
-            raise ConnectionException(self.device.ip, self.device.device_type)
+            except AsyncExpectTimeoutException:
+                # ログインプロンプトが返ってこないのはtelnet接続失敗と判断する
+                raise ConnectionException(self.device.ip, self.device.device_type)
 
-        if self.use_username:
-            await self.sendline(self.device.username)
-            await self.expect(f"{self.password_prompt}", read_timeout=self.timeout)
+        with self.span(SPAN_AUTHENTICATE):
+            if self.use_username:
+                await self.sendline(self.device.username)
+                await self.expect(f"{self.password_prompt}", read_timeout=self.timeout)
 
-        await self.sendline(self.device.password)
-        try:
-            await self.expect(f"{self.user_prompt}", read_timeout=self.timeout)
+            await self.sendline(self.device.password)
+            try:
+                await self.expect(f"{self.user_prompt}", read_timeout=self.timeout)
 
-        except AsyncExpectTimeoutException:
-            # ユーザプロンプトが返ってこないのはログイン認証の失敗と判断する
-            raise AuthenticationException(self.device.ip, self.device.device_type)
+            except AsyncExpectTimeoutException:
+                # ユーザプロンプトが返ってこないのはログイン認証の失敗と判断する
+                raise AuthenticationException(self.device.ip, self.device.device_type)
 
     async def sendline(self, command: str) -> None:
         # writerが生成されている場合のみ
@@ -102,53 +181,86 @@ class AsyncBaseConnection:
 
         self.writer.write(command_bytes)
 
-    async def expect(self, pattern: str, read_timeout=30, reg=False) -> str:
-        data = ""
-        buffer = ""
-        start = datetime.now()
-        pattern_bytes = pattern
+    async def expect(
+        self,
+        pattern: Union[str, Pattern[str]],
+        read_timeout=30,
+        reg=False,
+        deadline: Optional[float] = None,
+    ) -> str:
+        """patternを受信するまで読み込む
+
+        read_timeout: データが届かない状態が続いた場合のタイムアウト(秒)
+        deadline: 受信の有無にかかわらずコマンド全体に許す時間(秒)
+        """
+        matcher = StreamMatcher(pattern, reg=reg)
+        pager = pager_detector(self.pager_pattern, binary=False)
+        loop = asyncio.get_running_loop()
+        last_received = loop.time()
+        give_up = None if deadline is None else last_received + deadline
 
         # readerが生成されている場合のみ
         if not self.reader:
             raise RuntimeError
 
-        while True:
-            chunk = await self.reader.read(1024)
+        # 前回の残りデータにパターンが含まれていれば読み込まずに返す
+        pending, self._pending = self._pending, ""
+        matched = bool(pending) and matcher.feed(pending)
+
+        while not matched:
+            now = loop.time()
+            remaining = read_timeout - (now - last_received)
+            if give_up is not None:
+                remaining = min(remaining, give_up - now)
+            if remaining <= 0:
+                raise AsyncExpectTimeoutException(matcher.getvalue()[-4096:])
+
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(1024), remaining)
+            except asyncio.TimeoutError:
+                raise AsyncExpectTimeoutException(matcher.getvalue()[-4096:])
+
             if chunk:
-                data += chunk
-                buffer = (buffer + chunk)[-4096:]
-                start = datetime.now()
-                if reg:
-                    if re.search(pattern_bytes, chunk):
-                        break
-                else:
-                    if pattern_bytes in chunk:
-                        break
+                last_received = loop.time()
+                matched = matcher.feed(chunk)
+                if not matched:
+                    self._answer_pager(pager, chunk)
 
-            if datetime.now() - start > timedelta(seconds=read_timeout):
-                raise AsyncExpectTimeoutException(chunk)
+            elif self.reader.at_eof():
+                # 切断された場合は待っても応答が来ないため即座に打ち切る
+                raise AsyncExpectTimeoutException(matcher.getvalue()[-4096:])
 
         # ログを全部出力するため
         await self.reader.flush()
-        raw_data = data
+        raw_data, self._pending = matcher.split()
+        self._last_read = (matcher.size, matcher.chunk_count)
+        self._on_prompt(pattern, matcher.match)
         return raw_data
 
+    def _answer_pager(self, pager: Optional[PagerDetector], chunk: str) -> None:
+        """受信データの末尾がページャであれば空白を送信して続きを表示させる"""
+        if pager is not None and pager.feed(chunk):
+            self.writer.write(" ")
+
     async def find_prompt(self, current_prompt: str) -> tuple[str, str]:
         """ホスト名を含めたプロンプトを取得"""
         await self.sendline("")
         raw_data = await self.expect(current_prompt)
-        hostname = self.sanitize_output(
+        text = self.sanitize_output(
             raw_data, command="", pattern=current_prompt, echo=True
         )
-        prompt = hostname + current_prompt
+        # configモードで見つけた場合もホスト名は括弧の前だけにする
+        hostname, submode = split_submode(text)
+        prompt = text + current_prompt
+        self.mode = prompt_mode(submode, current_prompt, self.enable_prompt)
 
         return hostname, prompt
 
-    async def check_prompt(self, prompt_key: str) -> bool:
+    async def check_prompt(self, prompt_key: str, read_timeout=30) -> bool:
         """特定のモードへ移行できたか確認"""
         await self.sendline("")
         try:
-            await self.expect(prompt_key)
+            await self.expect(prompt_key, read_timeout=read_timeout)
 
         except AsyncExpectTimeoutException:
             return False
@@ -157,29 +269,69 @@ class AsyncBaseConnection:
 
     async def initialize(self) -> None:
         """装置ログイン後に必要なコマンドを実行する"""
-        # self.send_command('terminal length ')
-        pass
+        for command in self.init_commands:
+            await self.send_command(command)
 
     async def enable(self) -> None:
         """enableモードへ遷移する"""
         pass
 
+    @property
+    def textfsm_platform(self) -> str:
+        """TextFSMのindexを引くときのPlatform名"""
+        return self.device.device_type
+
+    @property
+    def prompt_regex(self) -> Optional[Pattern[str]]:
+        """ホスト名から作成した、ユーザ/enable/configモードのプロンプトに一致する正規表現"""
+        if not self.hostname:
+            return None
+        return build_prompt_regex(self.hostname, self.user_prompt, self.enable_prompt)
+
+    def _pipelined_prompt(self, prompt: Union[str, Pattern[str]], next_command: str) -> Union[str, Pattern[str]]:
+        """次のコマンドを送信済みの場合のプロンプト。プロンプトの直後に次のコマンドのエコーバックが続く"""
+        if prompt is not self.prompt_regex:
+            return prompt
+        return build_prompt_regex(self.hostname, self.user_prompt, self.enable_prompt, echo=next_command)
+
+    def _command_prompt(self, prompt: str, reg: bool) -> tuple[Union[str, Pattern[str]], bool]:
+        """コマンドの完了を判定するプロンプト。指定がなければprompt_regexを使う"""
+        if prompt:
+            return prompt, reg
+        regex = self.prompt_regex
+        if regex is None:
+            return self.prompt, reg
+        return regex, True
+
+    def _on_prompt(self, pattern: Union[str, Pattern[str]], match: Optional[Match[Any]]) -> None:
+        # プロンプトの正規表現(prompt_regex、連続送信中はエコーバックを含むもの)で待った場合は、
+        # 一致したプロンプトから現在のモードとプロンプトを更新する
+        if match is None or isinstance(pattern, str):
+            return
+        text = match.group(0)
+        if isinstance(text, bytes):
+            text = text.decode(errors="ignore")
+        parsed = parse_prompt(pattern, text, self.enable_prompt)
+        if parsed is not None:
+            self.mode, self.prompt = parsed
+
     def sanitize_output(
-        self, raw_data: str, command: str, pattern: str, echo: bool
+        self, raw_data: str, command: str, pattern: Union[str, Pattern[str]], echo: bool, reg: bool = False
     ) -> str:
-        if self.ansi:
-            ansi_escape = re.compile(r"\x1B(?:[@-Z\\-_]|\[0-?*[ -/]*[@-~])")
-            raw_data = ansi_escape.sub("", raw_data)
-
-        if echo:
-            raw_data = raw_data.replace(command, "")
-            raw_data = (
-                raw_data.replace(f"!{pattern}", "")
-                .replace(f"!!{pattern}", "")
-                .replace(pattern, "")
-            )
+        prompt_pattern = compile_pattern(pattern, True) if reg else pattern
+        return self.sanitizer.sanitize(raw_data, command=command, pattern=prompt_pattern, echo=echo)
+
+    def _check_change(self, command: str, output: str) -> Optional[ChangeResult]:
+        """change_cacheが有効な場合に、整形後の出力を前回の出力と比較する"""
+        if self.change_cache is None:
+            return None
+        self.last_change = self.change_cache.check(self.device.ip, command, output)
+        return self.last_change
 
-        return raw_data.strip()
+    def _store_parsed(self, command: str, structured_data: Any) -> None:
+        # 解析できなかった場合(文字列のまま)はキャッシュしない
+        if self.change_cache is not None and not isinstance(structured_data, str):
+            self.change_cache.store_parsed(self.device.ip, command, structured_data)
 
     async def send_command(
         self,
@@ -188,25 +340,222 @@ class AsyncBaseConnection:
         read_timeout: int = 30,
         prompt: str = "",
         reg: bool = False,
-    ) -> Union[str, list[Any], dict[str, Any]]:
-        """コマンドを実行して結果を返却"""
-        prompt_str = prompt or self.prompt
-        await self.sendline(f"{command}")
-        raw_data = await self.expect(f"{prompt_str}", read_timeout=read_timeout, reg=reg)
-        raw_data = self.sanitize_output(
-            raw_data, command=command, pattern=prompt_str, echo=True
-        )
+        deadline: Optional[float] = None,
+        compact: bool = False,
+    ) -> Union[str, list[Any], dict[str, Any], ResultTable]:
+        """コマンドを実行して結果を返却
+
+        compact: use_textfsm=Trueの場合に、dictのリストの代わりに列指向のResultTableを返す
+        """
+        prompt_str, reg = self._command_prompt(prompt, reg)
+        with self.span(SPAN_COMMAND, command) as span:
+            await self.sendline(f"{command}")
+            raw_data = await self.expect(
+                prompt_str, read_timeout=read_timeout, reg=reg, deadline=deadline
+            )
+            span.bytes, span.chunks = self._last_read
+            raw_data = self.sanitize_output(
+                raw_data, command=command, pattern=prompt_str, echo=True, reg=reg
+            )
 
+            change = self._check_change(command, raw_data)
+            if use_textfsm:
+                if change is not None and change.snapshot is not None:
+                    return change.parsed(compact)
+                # 解析中も他セッションのI/Oが進むようExecutor上で実行する
+                with self.span(SPAN_PARSE, command) as parse_span:
+                    structured_data = await get_structured_data_textfsm_async(
+                        raw_data,
+                        platform=self.textfsm_platform,
+                        command=command,
+                        template=None,
+                        executor=self.parse_executor,
+                        compact=compact,
+                    )
+                span.parse_time = parse_span.duration
+                self._store_parsed(command, structured_data)
+                return structured_data
+
+        return raw_data
+
+    async def send_command_iter(
+        self,
+        command: str,
+        use_textfsm: bool = False,
+        read_timeout: int = 30,
+        prompt: str = "",
+        reg: bool = False,
+        chunk_size: Optional[int] = None,
+        deadline: Optional[float] = None,
+    ) -> AsyncIterator[Union[str, dict[str, Any]]]:
+        """コマンドを実行し、出力を受信しながら1行ずつ(chunk_size指定時はチャンクごとに)返す
+
+        出力全体をメモリに保持しないため、巨大な出力をそのままファイルやパーサへ流せる。
+        途中で読むのをやめた場合、残りの出力は次のexpectで読み捨てられずに残る点に注意。
+        use_textfsm=Trueの場合は受信した行を逐次解析し、レコード(dict)を確定した順に返す。
+        """
         if use_textfsm:
-            return get_structured_data_textfsm(
-                raw_data,
-                platform=self.device.device_type,
+            lines = self._iter_output(command, read_timeout, prompt, reg, None, deadline)
+            async for record in aiter_structured_data_textfsm(
+                lines,
+                platform=self.textfsm_platform,
                 command=command,
-                template=None,
+                executor=self.parse_executor,
+            ):
+                yield record
+        else:
+            lines = self._iter_output(command, read_timeout, prompt, reg, chunk_size, deadline)
+            async for line in lines:
+                yield line
+
+    async def _iter_output(
+        self,
+        command: str,
+        read_timeout: int,
+        prompt: str,
+        reg: bool,
+        chunk_size: Optional[int],
+        deadline: Optional[float],
+    ) -> AsyncIterator[str]:
+        prompt_str, reg = self._command_prompt(prompt, reg)
+        stream = OutputStream(
+            command, prompt_str, reg=reg, sanitizer=self.sanitizer, chunk_size=chunk_size
+        )
+        pager = pager_detector(self.pager_pattern, binary=False)
+        loop = asyncio.get_running_loop()
+        last_received = loop.time()
+        give_up = None if deadline is None else last_received + deadline
+
+        # readerが生成されている場合のみ
+        if not self.reader:
+            raise RuntimeError
+
+        with self.span(SPAN_COMMAND, command) as span:
+            await self.sendline(f"{command}")
+            pending, self._pending = self._pending, ""
+            for line in stream.feed(pending):
+                yield line
+
+            while not stream.done:
+                now = loop.time()
+                remaining = read_timeout - (now - last_received)
+                if give_up is not None:
+                    remaining = min(remaining, give_up - now)
+                if remaining <= 0:
+                    raise AsyncExpectTimeoutException(stream.partial_line)
+
+                try:
+                    chunk = await asyncio.wait_for(self.reader.read(1024), remaining)
+                except asyncio.TimeoutError:
+                    raise AsyncExpectTimeoutException(stream.partial_line)
+
+                if chunk:
+                    last_received = loop.time()
+                    lines = stream.feed(chunk)
+                    # 呼び出し側の処理を待たずにページャへ応答しておく
+                    if not stream.done:
+                        self._answer_pager(pager, chunk)
+                    for line in lines:
+                        yield line
+
+                elif self.reader.at_eof():
+                    raise AsyncExpectTimeoutException(stream.partial_line)
+
+            await self.reader.flush()
+            self._pending = stream.remainder
+            self._on_prompt(prompt_str, stream.matcher.match)
+            span.bytes, span.chunks = stream.matcher.size, stream.matcher.chunk_count
+
+    async def send_commands(
+        self,
+        commands: list[str],
+        use_textfsm: bool = False,
+        read_timeout: int = 30,
+        prompt: str = "",
+        reg: bool = False,
+        window: Optional[int] = None,
+        compact: bool = False,
+    ) -> list[Union[str, list[Any], dict[str, Any], ResultTable]]:
+        """複数のコマンドを応答を待たずに連続送信し、プロンプトで区切って結果を返却
+
+        window: 応答待ちのまま送信しておくコマンド数の上限。Noneの場合はすべて先に送信する
+                ページャを処理する場合(pager_patternがある場合)は、先に送信したコマンドが
+                ページャへのキー入力として消費されるため常に1件ずつ送信する。
+                その分コマンドごとに往復の待ち時間がかかるため、連続送信したい場合は
+                init_commandsでページャを無効にしたクラス(paging = False)を使うか、pager=Falseを指定する
+        """
+        prompt_str, reg = self._command_prompt(prompt, reg)
+        window = len(commands) if window is None else max(1, window)
+        if self.pager_pattern is not None:
+            window = 1
+        sent = 0
+        while sent < min(window, len(commands)):
+            await self.sendline(commands[sent])
+            sent += 1
+
+        outputs: list[Union[str, list[Any], dict[str, Any], ResultTable]] = []
+        for index, command in enumerate(commands):
+            # 次のコマンドを送信済みの場合、プロンプトの後ろにはそのエコーバックが続く
+            pattern = self._pipelined_prompt(prompt_str, commands[index + 1]) if index + 1 < sent else prompt_str
+            # 送信は先行しているため、計測は前のコマンドの受信完了からの区間になる
+            with self.span(SPAN_COMMAND, command) as span:
+                raw_data = await self.expect(pattern, read_timeout=read_timeout, reg=reg)
+                span.bytes, span.chunks = self._last_read
+            # 1件受信するごとに次のコマンドを送信してwindow件の送信済み状態を保つ
+            if sent < len(commands):
+                await self.sendline(commands[sent])
+                sent += 1
+
+            outputs.append(
+                self.sanitize_output(
+                    raw_data, command=command, pattern=prompt_str, echo=True, reg=reg
+                )
             )
 
-        return raw_data
+        changes = [self._check_change(command, raw_data) for command, raw_data in zip(commands, outputs)]
+        if use_textfsm:
+            # 前回から変化のない出力はキャッシュした解析結果を使い、残りだけをまとめて解析する
+            targets = [
+                i for i, change in enumerate(changes) if change is None or change.snapshot is None
+            ]
+            for i, change in enumerate(changes):
+                if change is not None and change.snapshot is not None:
+                    outputs[i] = change.parsed(compact)
+            items = [
+                {
+                    "raw_output": outputs[i],
+                    "platform": self.textfsm_platform,
+                    "command": commands[i],
+                    "compact": compact,
+                }
+                for i in targets
+            ]
+            # まとめて解析するため、解析時間は全コマンド分で1つのスパンになる
+            with self.span(SPAN_PARSE):
+                parsed = await get_structured_data_textfsm_batch_async(
+                    items, executor=self.parse_executor
+                )
+            for i, structured_data in zip(targets, parsed):
+                outputs[i] = structured_data
+                self._store_parsed(commands[i], structured_data)
+
+        return outputs
+
+    async def parse_outputs(self, outputs: dict[str, str]) -> dict[str, Any]:
+        """コマンドと出力の組をまとめてTextFSMで解析する"""
+        items = [
+            {"raw_output": raw_data, "platform": self.textfsm_platform, "command": command}
+            for command, raw_data in outputs.items()
+        ]
+        parsed = await get_structured_data_textfsm_batch_async(
+            items, executor=self.parse_executor
+        )
+        return dict(zip(outputs.keys(), parsed))
 
     def disconnect(self) -> None:
+        if self.reader:
+            self.reader.close()
         if self.writer:
-            self.writer.close()
\ No newline at end of file
+            self.writer.close()
+        if self._owns_session_log and self.session_log is not None:
+            self.session_log.close()
\ No newline at end of file
@@ -1,17 +1,41 @@
-import re
-from datetime import datetime, timedelta
-from typing import Any, Union, Generator
+import asyncio
+import os
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, BinaryIO, Match, Optional, Pattern, Union, Generator
 from pexpect import spawn
 from pexpect.exceptions import TIMEOUT
 
+from pexnetlib.connect import telnet_command
 from pexnetlib.log import log
 from pexnetlib.logging_io import LoggingIO
+from pexnetlib.matcher import StreamMatcher, compile_pattern
 from pexnetlib.model import Device
-from pexnetlib.textfsm_util import get_structured_data_textfsm
+from pexnetlib.pager import PagerDetector, pager_detector, pager_pattern_for, pager_remnant_step
+from pexnetlib.prompt import (
+    MODE_USER,
+    build_prompt_regex,
+    encode_pattern,
+    parse_prompt,
+    prompt_mode,
+    split_submode,
+)
+from pexnetlib.sanitizer import Sanitizer, SanitizeStep
+from pexnetlib.table import ResultTable
+from pexnetlib.transcript import TranscriptManager
+from pexnetlib.textfsm_util import (
+    get_structured_data_textfsm_async,
+    get_structured_data_textfsm_batch_async,
+)
 from pexnetlib.exception import ConnectionException, AuthenticationException
 
 
 class AsyncBaseConnection:
+    # 装置固有の出力整形処理。ベンダクラスで上書きする
+    sanitize_steps: tuple[SanitizeStep, ...] = ()
+    # 装置がページャ(--More--)を表示するか。init_commandsでページャを無効にするベンダクラスはFalseにする
+    paging: bool = True
+
     def __init__(
         self,
         device: Device,
@@ -24,7 +48,10 @@ class AsyncBaseConnection:
         hostname="",
         prompt="",
         crlf=False,
-        ansi=False
+        ansi=False,
+        session_log: Optional[BinaryIO] = None,
+        transcript: Optional[TranscriptManager] = None,
+        pager: Optional[bool] = None,
     ) -> None:
         # クラス変数を定義
         self.device = device
@@ -36,8 +63,26 @@ class AsyncBaseConnection:
         self.enable_prompt = enable_prompt
         self.hostname = hostname
         self.prompt = prompt
+        # 直前のプロンプトから判定したモード(user/enable/config-ifなど)
+        self.mode = MODE_USER
         self.crlf = crlf
         self.ansi = ansi
+        # 受信した生データをそのまま書き出す先(ファイルなど)
+        # transcriptを指定した場合はセッション専用のTranscriptWriterを作成して閉じるまで管理する
+        self._owns_session_log = session_log is None and transcript is not None
+        if self._owns_session_log:
+            session_log = transcript.open(device.ip)
+        self.session_log = session_log
+        # 出力中のページャ(--More--)に空白を送って読み進める。Noneの場合はクラスのpagingに従う
+        if pager is None:
+            pager = self.paging
+        self.pager_pattern = pager_pattern_for(device.device_type) if pager else None
+        steps = self.sanitize_steps
+        if self.pager_pattern is not None:
+            steps = (pager_remnant_step(self.pager_pattern), *steps)
+        self.sanitizer = Sanitizer(ansi=ansi, steps=steps)
+        # TextFSM解析に使うExecutor。Noneの場合はtextfsm_util.set_parse_executorの設定に従う
+        self.parse_executor: Optional[Executor] = None
         self.child = None
 
     def __await__(self) -> Generator[Any, None, "AsyncBaseConnection"]:
@@ -51,7 +96,9 @@ class AsyncBaseConnection:
         return self
 
     async def __aexit__(self, exc_type, exc, tb) -> None:
-        self.disconnect()
+        # child.close()は子プロセスの終了を待つためイベントループの外で実行する
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.disconnect)
     
     async def telnet_initialize(self) -> None:
         # 接続と初期化
@@ -61,8 +108,13 @@ class AsyncBaseConnection:
 
 
     async def connect(self) -> None:
-        self.child = spawn("telnet " + self.device.ip, timeout=self.timeout)
-        loggingio = LoggingIO(log)
+        # fork/execでイベントループを止めないようスレッドプールでspawnする
+        loop = asyncio.get_running_loop()
+        self.child = await loop.run_in_executor(
+            None, partial(spawn, telnet_command(self.device.ip, self.device.port), timeout=self.timeout)
+        )
+        # 背圧はイベントループを止めないようexpectでdrain()を待つ
+        loggingio = LoggingIO(log, sink=self.session_log, wait_sink=False)
         self.child.logfile_read = loggingio
 
         try:
@@ -98,55 +150,94 @@ class AsyncBaseConnection:
             command = command + "\r\n"
         self.child.sendline(command)
 
-    async def expect(self, pattern: str, read_timeout=30, reg=False) -> str:
-        data = b""
-        buffer = b""
-        start = datetime.now()
-        pattern_bytes = pattern.encode()
+    async def read_chunk(self, size: int = 1024, timeout: float = 1) -> bytes:
+        """ptyが読み込み可能になるまでイベントループ上で待機して読み込む
 
+        待機中は他のセッションに制御を譲る。timeout秒以内にデータが来なければ空bytesを返す。
+        """
         # childが生成されている場合のみ
         if not self.child:
             raise RuntimeError
 
+        try:
+            # 既にデータが届いていればそのまま読み込む
+            return self.child.read_nonblocking(size=size, timeout=0)
+        except TIMEOUT:
+            pass
+
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        fd = self.child.child_fd
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            return b""
+        finally:
+            loop.remove_reader(fd)
+
+        try:
+            return self.child.read_nonblocking(size=size, timeout=0)
+        except TIMEOUT:
+            return b""
+
+    async def expect(self, pattern: Union[str, Pattern[str]], read_timeout=30, reg=False) -> str:
+        matcher = StreamMatcher(
+            pattern.encode() if isinstance(pattern, str) else encode_pattern(pattern), reg=reg
+        )
+        pager = pager_detector(self.pager_pattern, binary=True)
+        loop = asyncio.get_running_loop()
+        last_received = loop.time()
+
+        # childが生成されている場合のみ
+        if not self.child:
+            raise RuntimeError
+
+        # トランスクリプトの書き込みが追いつかない場合は受信を待たせる
+        drain = getattr(self.session_log, "drain", None)
         while True:
-            try:
-                chunk = self.child.read_nonblocking(size=1024, timeout=1)
-                if chunk:
-                    data += chunk
-                    buffer = (buffer + chunk)[-4096:]
-                    start = datetime.now()
-                    if reg:
-                        if re.search(pattern, chunk):
-                            break
-                    else:
-                        if pattern_bytes in chunk:
-                            break
-
-            except TIMEOUT:
-                if datetime.now() - start > timedelta(seconds=read_timeout):
-                    raise
-
-                continue
-
-        raw_data = data.decode(encoding="utf-8", errors="ignore")
+            remaining = read_timeout - (loop.time() - last_received)
+            if remaining <= 0:
+                raise TIMEOUT("Timeout exceeded.")
+
+            chunk = await self.read_chunk(size=1024, timeout=remaining)
+            if chunk:
+                last_received = loop.time()
+                if matcher.feed(chunk):
+                    break
+                self._answer_pager(pager, chunk)
+                if drain is not None:
+                    await drain()
+
+        self._on_prompt(pattern, matcher.match)
+        raw_data = matcher.getvalue().decode(encoding="utf-8", errors="ignore")
         return raw_data
 
+    def _answer_pager(self, pager: Optional[PagerDetector], chunk: bytes) -> None:
+        """受信データの末尾がページャであれば空白を送信して続きを表示させる"""
+        if pager is not None and pager.feed(chunk):
+            # spawn.sendは送信前にdelaybeforesend秒スリープしてイベントループを止めるため直接書き込む
+            os.write(self.child.child_fd, b" ")
+
     async def find_prompt(self, current_prompt: str) -> tuple[str, str]:
         """ホスト名を含めたプロンプトを取得"""
         await self.sendline("")
         raw_data = await self.expect(current_prompt)
-        hostname = self.sanitize_output(
+        text = self.sanitize_output(
             raw_data, command="", pattern=current_prompt, echo=True
         )
-        prompt = hostname + current_prompt
+        # configモードで見つけた場合もホスト名は括弧の前だけにする
+        hostname, submode = split_submode(text)
+        prompt = text + current_prompt
+        self.mode = prompt_mode(submode, current_prompt, self.enable_prompt)
 
         return hostname, prompt
 
-    async def check_prompt(self, prompt_key: str) -> bool:
+    async def check_prompt(self, prompt_key: str, read_timeout=30) -> bool:
         """特定のモードへ移行できたか確認"""
         await self.sendline("")
         try:
-            await self.expect(prompt_key)
+            await self.expect(prompt_key, read_timeout=read_timeout)
 
         except TIMEOUT:
             return False
@@ -162,22 +253,39 @@ class AsyncBaseConnection:
         """enableモードへ遷移する"""
         pass
 
+    @property
+    def prompt_regex(self) -> Optional[Pattern[str]]:
+        """ホスト名から作成した、ユーザ/enable/configモードのプロンプトに一致する正規表現"""
+        if not self.hostname:
+            return None
+        return build_prompt_regex(self.hostname, self.user_prompt, self.enable_prompt)
+
+    def _command_prompt(self, prompt: str, reg: bool) -> tuple[Union[str, Pattern[str]], bool]:
+        """コマンドの完了を判定するプロンプト。指定がなければprompt_regexを使う"""
+        if prompt:
+            return prompt, reg
+        regex = self.prompt_regex
+        if regex is None:
+            return self.prompt, reg
+        return regex, True
+
+    def _on_prompt(self, pattern: Union[str, Pattern[str]], match: Optional[Match[Any]]) -> None:
+        # プロンプトの正規表現(prompt_regex、連続送信中はエコーバックを含むもの)で待った場合は、
+        # 一致したプロンプトから現在のモードとプロンプトを更新する
+        if match is None or isinstance(pattern, str):
+            return
+        text = match.group(0)
+        if isinstance(text, bytes):
+            text = text.decode(errors="ignore")
+        parsed = parse_prompt(pattern, text, self.enable_prompt)
+        if parsed is not None:
+            self.mode, self.prompt = parsed
+
     def sanitize_output(
-        self, raw_data: str, command: str, pattern: str, echo: bool
+        self, raw_data: str, command: str, pattern: Union[str, Pattern[str]], echo: bool, reg: bool = False
     ) -> str:
-        if self.ansi:
-            ansi_escape = re.compile(r"\x1B(?:[@-Z\\-_]|\[0-?*[ -/]*[@-~])")
-            raw_data = ansi_escape.sub("", raw_data)
-
-        if echo:
-            raw_data = raw_data.replace(command, "")
-            raw_data = (
-                raw_data.replace(f"!{pattern}", "")
-                .replace(f"!!{pattern}", "")
-                .replace(pattern, "")
-            )
-
-        return raw_data.strip()
+        prompt_pattern = compile_pattern(pattern, True) if reg else pattern
+        return self.sanitizer.sanitize(raw_data, command=command, pattern=prompt_pattern, echo=echo)
 
     async def send_command(
         self,
@@ -186,25 +294,47 @@ class AsyncBaseConnection:
         read_timeout: int = 30,
         prompt: str = "",
         reg: bool = False,
-    ) -> Union[str, list[Any], dict[str, Any]]:
-        """コマンドを実行して結果を返却"""
-        prompt_str = prompt or self.prompt
+        compact: bool = False,
+    ) -> Union[str, list[Any], dict[str, Any], ResultTable]:
+        """コマンドを実行して結果を返却
+
+        compact: use_textfsm=Trueの場合に、dictのリストの代わりに列指向のResultTableを返す
+        """
+        prompt_str, reg = self._command_prompt(prompt, reg)
         await self.sendline(f"{command}")
-        raw_data = await self.expect(f"{prompt_str}", read_timeout=read_timeout, reg=reg)
+        raw_data = await self.expect(prompt_str, read_timeout=read_timeout, reg=reg)
         raw_data = self.sanitize_output(
-            raw_data, command=command, pattern=prompt_str, echo=True
+            raw_data, command=command, pattern=prompt_str, echo=True, reg=reg
         )
 
         if use_textfsm:
-            return get_structured_data_textfsm(
+            # 解析中も他セッションのI/Oが進むようExecutor上で実行する
+            return await get_structured_data_textfsm_async(
                 raw_data,
                 platform=self.device.device_type,
                 command=command,
                 template=None,
+                executor=self.parse_executor,
+                compact=compact,
             )
 
         return raw_data
 
+    async def parse_outputs(self, outputs: dict[str, str]) -> dict[str, Any]:
+        """コマンドと出力の組をまとめてTextFSMで解析する"""
+        items = [
+            {"raw_output": raw_data, "platform": self.device.device_type, "command": command}
+            for command, raw_data in outputs.items()
+        ]
+        parsed = await get_structured_data_textfsm_batch_async(
+            items, executor=self.parse_executor
+        )
+        return dict(zip(outputs.keys(), parsed))
+
     def disconnect(self) -> None:
         if self.child:
+            if self.child.logfile_read:
+                self.child.logfile_read.close()
             self.child.close()
+        if self._owns_session_log and self.session_log is not None:
+            self.session_log.close()
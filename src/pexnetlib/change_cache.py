@@ -0,0 +1,216 @@
+import difflib
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Union
+
+from pexnetlib.log import log
+from pexnetlib.store import decode_parsed, encode_parsed
+
+
+@dataclass
+class ChangeResult:
+    """前回の実行結果と比較した結果"""
+
+    ip: str
+    command: str
+    changed: bool
+    digest: str
+    previous_digest: Optional[str] = None
+    # 変化した行だけのunified diff(初回および変化なしの場合は空)
+    diff: list[str] = field(default_factory=list)
+    # 変化がない場合に、前回の解析結果のスナップショット(列指向のJSON。未解析ならNone)
+    snapshot: Optional[str] = None
+
+    def parsed(self, compact: bool = False) -> Any:
+        """前回の解析結果を返す。呼び出し側が変更してもキャッシュに影響しないよう毎回新しく作る"""
+        if self.snapshot is None:
+            return None
+        return decode_parsed(self.snapshot, compact)
+
+
+class _Entry:
+    __slots__ = ("digest", "output", "snapshot", "timestamp")
+
+    def __init__(self, digest: str, output: str, snapshot: Optional[str], timestamp: float) -> None:
+        self.digest = digest
+        self.output = output
+        self.snapshot = snapshot
+        self.timestamp = timestamp
+
+
+def output_hash(output: str) -> str:
+    return hashlib.blake2b(output.encode(), digest_size=16).hexdigest()
+
+
+def line_diff(old: str, new: str, ip: str = "", command: str = "") -> list[str]:
+    """前後で一致する行を除いてからunified diffを作成する
+
+    設定の大半は変化しないため、差分のある区間だけをdifflibに渡す。
+    """
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    start = 0
+    limit = min(len(old_lines), len(new_lines))
+    while start < limit and old_lines[start] == new_lines[start]:
+        start += 1
+    end = 0
+    while (
+        end < limit - start
+        and old_lines[len(old_lines) - 1 - end] == new_lines[len(new_lines) - 1 - end]
+    ):
+        end += 1
+
+    diff = difflib.unified_diff(
+        old_lines[start:len(old_lines) - end],
+        new_lines[start:len(new_lines) - end],
+        fromfile=f"{ip} {command} (previous)",
+        tofile=f"{ip} {command}",
+        lineterm="",
+        n=0,
+    )
+    # 切り出した区間の行番号を元の行番号に戻す
+    result = []
+    for line in diff:
+        if line.startswith("@@"):
+            line = _shift_hunk(line, start)
+        result.append(line)
+    return result
+
+
+def _shift_hunk(header: str, offset: int) -> str:
+    # "@@ -a,b +c,d @@" の開始行にoffsetを加える
+    parts = header.split(" ")
+    for i in (1, 2):
+        sign, body = parts[i][0], parts[i][1:]
+        first, _, count = body.partition(",")
+        first = str(int(first) + offset)
+        parts[i] = sign + first + ("," + count if count else "")
+    return " ".join(parts)
+
+
+class ChangeCache:
+    """(IPアドレス, コマンド)ごとに前回の出力のハッシュと解析結果を保持するキャッシュ
+
+    接続クラスのchange_cacheに指定すると、整形後の出力が前回と同じ場合はTextFSMの解析を省略し
+    キャッシュした解析結果を返す。変化した場合は行単位の差分を作成する。
+    max_entries件、または保持する出力の合計がmax_bytesを超えた場合は最も古く参照したものから捨てる。
+    pathを指定した場合はsave()/close()でファイルに保存し、次回の作成時に読み込む。
+    複数プロセスから同じpathを使う場合は最後に保存した内容が残る点に注意。
+    """
+
+    def __init__(
+        self,
+        path: Union[str, os.PathLike, None] = None,
+        max_entries: int = 4096,
+        max_bytes: int = 256 * 1024 * 1024,
+        on_change: Optional[Callable[[ChangeResult], None]] = None,
+    ) -> None:
+        self.path = None if path is None else os.fspath(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_change = on_change
+        self._entries: "OrderedDict[tuple[str, str], _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if self.path is not None and os.path.exists(self.path):
+            self._load()
+
+    def __enter__(self) -> "ChangeCache":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """保持している出力の合計文字数"""
+        return self._bytes
+
+    def check(self, ip: str, command: str, output: str) -> ChangeResult:
+        """出力を前回と比較し、キャッシュを今回の出力で更新する"""
+        digest = output_hash(output)
+        key = (ip, command)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.digest == digest:
+                self._entries.move_to_end(key)
+                entry.timestamp = time.time()
+                return ChangeResult(ip, command, False, digest, digest, snapshot=entry.snapshot)
+
+            previous = entry
+            if previous is not None:
+                self._bytes -= len(previous.output)
+            self._entries[key] = _Entry(digest, output, None, time.time())
+            self._entries.move_to_end(key)
+            self._bytes += len(output)
+            self._evict()
+
+        result = ChangeResult(ip, command, True, digest)
+        if previous is not None:
+            result.previous_digest = previous.digest
+            result.diff = line_diff(previous.output, output, ip, command)
+        if self.on_change is not None:
+            self.on_change(result)
+        return result
+
+    def store_parsed(self, ip: str, command: str, parsed: Any) -> None:
+        """直前にcheckした出力の解析結果を保存する
+
+        返却済みのオブジェクトと共有しないよう、列指向のJSONに変換したスナップショットを保持する。
+        """
+        snapshot = encode_parsed(parsed).decode()
+        with self._lock:
+            entry = self._entries.get((ip, command))
+            if entry is not None:
+                entry.snapshot = snapshot
+
+    def invalidate(self, ip: str, command: Optional[str] = None) -> None:
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == ip and command in (None, key[1])]
+            for key in keys:
+                self._bytes -= len(self._entries.pop(key).output)
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= len(entry.output)
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)["entries"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # 壊れたファイルや旧形式のファイルは読み捨てて空のキャッシュから始める
+            log.debug(f"{self.path}: cannot load change cache: {e!r}")
+            return
+        for ip, command, digest, output, snapshot, timestamp in entries:
+            self._entries[(ip, command)] = _Entry(digest, output, snapshot, timestamp)
+            self._bytes += len(output)
+        self._evict()
+
+    def save(self) -> None:
+        """キャッシュをファイルに保存する(一時ファイルに書いてから置き換える)"""
+        if self.path is None:
+            return
+        with self._lock:
+            entries = [
+                [ip, command, entry.digest, entry.output, entry.snapshot, entry.timestamp]
+                for (ip, command), entry in self._entries.items()
+            ]
+        temp = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump({"entries": entries}, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp, self.path)
+
+    def close(self) -> None:
+        self.save()
@@ -0,0 +1,231 @@
+import asyncio
+import errno
+import os
+import random
+import selectors
+import socket
+import time
+from typing import Any, Iterator, Optional
+
+import telnetlib3
+
+from pexnetlib.exception import ConnectionException
+from pexnetlib.log import log
+from pexnetlib.model import Device
+
+# 複数アドレスへ接続する際、次のアドレスへの接続を開始するまでの間隔(秒)。RFC 8305の推奨値
+DEFAULT_STAGGER = 0.25
+# 再試行の待ち時間の初期値と上限(秒)
+DEFAULT_BACKOFF = 0.2
+MAX_BACKOFF = 5.0
+DEFAULT_PORT = 23
+
+
+def device_addresses(device: Device) -> list[str]:
+    """ipと予備のアドレスを重複なく優先順に返す"""
+    addresses = [device.ip, *device.addresses]
+    return list(dict.fromkeys(address for address in addresses if address))
+
+
+def connect_timeout_of(device: Device, timeout: Optional[float]) -> Optional[float]:
+    return device.connect_timeout if device.connect_timeout is not None else timeout
+
+
+def needs_probe(device: Device) -> bool:
+    """telnetコマンドを起動する前にTCP接続を確認する必要があるか
+
+    予備のアドレス、接続タイムアウト、再試行のいずれかを指定した場合に確認する。
+    """
+    return bool(device.addresses) or device.connect_timeout is not None or device.connect_retries > 0
+
+
+def telnet_command(address: str, port: int) -> str:
+    # ポートを明示するとtelnetコマンドがオプションのネゴシエーションを始めないため、23番は省略する
+    if port == DEFAULT_PORT:
+        return f"telnet {address}"
+    return f"telnet {address} {port}"
+
+
+def backoff_delays(retries: int, backoff: float = DEFAULT_BACKOFF) -> Iterator[float]:
+    """再試行ごとの待ち時間(指数関数的に伸ばし、同時刻に集中しないよう揺らぎを加える)"""
+    for attempt in range(retries):
+        delay = min(MAX_BACKOFF, backoff * (2 ** attempt))
+        yield delay * random.uniform(0.5, 1.0)
+
+
+def _resolve(addresses: list[str], port: int) -> list[tuple[Any, ...]]:
+    # 名前解決の結果はアドレスファミリが交互になるよう並べ替える(RFC 8305)
+    by_family: dict[int, list[tuple[Any, ...]]] = {}
+    for address in addresses:
+        try:
+            infos = socket.getaddrinfo(address, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            log.debug(f"{address}: {e}")
+            continue
+        for family, socktype, proto, _, sockaddr in infos:
+            by_family.setdefault(family, []).append((family, socktype, proto, sockaddr, address))
+
+    candidates = []
+    queues = list(by_family.values())
+    while any(queues):
+        for queue in queues:
+            if queue:
+                candidates.append(queue.pop(0))
+    return candidates
+
+
+def open_socket(
+    addresses: list[str],
+    port: int = DEFAULT_PORT,
+    connect_timeout: Optional[float] = None,
+    stagger: float = DEFAULT_STAGGER,
+) -> tuple[socket.socket, str]:
+    """複数のアドレスへ少しずつずらして並行に接続し、最初に成功したソケットを返す
+
+    1つのアドレスへの接続が失敗した場合はstaggerを待たずに次のアドレスへ進む。
+    connect_timeout秒以内にどこにも接続できなければsocket.timeoutを送出する。
+    """
+    candidates = _resolve(addresses, port)
+    if not candidates:
+        raise OSError(errno.EHOSTUNREACH, f"cannot resolve {addresses}")
+
+    selector = selectors.DefaultSelector()
+    pending: dict[socket.socket, str] = {}
+    deadline = None if connect_timeout is None else time.monotonic() + connect_timeout
+    next_start = time.monotonic()
+    error: Optional[OSError] = None
+    try:
+        while True:
+            now = time.monotonic()
+            if candidates and (not pending or now >= next_start):
+                family, socktype, proto, sockaddr, address = candidates.pop(0)
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(False)
+                code = sock.connect_ex(sockaddr)
+                if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    error = OSError(code, os.strerror(code))
+                    sock.close()
+                    continue
+                pending[sock] = address
+                selector.register(sock, selectors.EVENT_WRITE)
+                next_start = now + stagger
+                continue
+
+            if not pending:
+                raise error or OSError(errno.EHOSTUNREACH, f"cannot connect to {addresses}")
+
+            wait = None if deadline is None else deadline - now
+            if candidates:
+                wait = next_start - now if wait is None else min(wait, next_start - now)
+            if deadline is not None and now >= deadline:
+                raise socket.timeout(f"connect to {addresses}:{port} timed out")
+
+            for key, _ in selector.select(None if wait is None else max(0.0, wait)):
+                sock = key.fileobj
+                selector.unregister(sock)
+                address = pending.pop(sock)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code:
+                    error = OSError(code, os.strerror(code))
+                    sock.close()
+                    continue
+                sock.setblocking(True)
+                return sock, address
+
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
+
+
+def connect_device(
+    device: Device,
+    timeout: Optional[float] = None,
+    stagger: float = DEFAULT_STAGGER,
+    backoff: float = DEFAULT_BACKOFF,
+) -> tuple[socket.socket, str]:
+    """装置のアドレスへTCP接続する。失敗した場合はconnect_retries回まで待ち時間を伸ばしながら再試行する
+
+    すべて失敗した場合はConnectionExceptionを送出する。
+    """
+    addresses = device_addresses(device)
+    connect_timeout = connect_timeout_of(device, timeout)
+    delays = backoff_delays(device.connect_retries, backoff)
+    while True:
+        try:
+            return open_socket(addresses, device.port, connect_timeout, stagger)
+        except OSError as e:
+            delay = next(delays, None)
+            log.debug(f"{device.ip}: connect failed: {e!r}")
+            if delay is None:
+                raise ConnectionException(device.ip, device.device_type)
+            time.sleep(delay)
+
+
+async def _open_telnet(address: str, port: int, connect_timeout: Optional[float]) -> tuple[Any, Any]:
+    # open_connectionのconnect_timeout引数は古いtelnetlib3にないためwait_forで打ち切る
+    # (TCP接続に加えてオプションのネゴシエーションの待ち時間も含まれる)
+    return await asyncio.wait_for(
+        telnetlib3.open_connection(host=address, port=port, encoding="utf-8"), connect_timeout
+    )
+
+
+async def open_telnet_async(
+    device: Device,
+    timeout: Optional[float] = None,
+    stagger: float = DEFAULT_STAGGER,
+    backoff: float = DEFAULT_BACKOFF,
+) -> tuple[Any, Any]:
+    """telnetlib3で装置へ接続し(reader, writer)を返す。connect_deviceの非同期版
+
+    複数のアドレスがある場合はstaggerずつずらして並行に接続し、最初に成功したものを使う。
+    """
+    addresses = device_addresses(device)
+    connect_timeout = connect_timeout_of(device, timeout)
+    delays = backoff_delays(device.connect_retries, backoff)
+    while True:
+        try:
+            return await _race(addresses, device.port, connect_timeout, stagger)
+        except (OSError, asyncio.TimeoutError) as e:
+            delay = next(delays, None)
+            log.debug(f"{device.ip}: connect failed: {e!r}")
+            if delay is None:
+                raise ConnectionException(device.ip, device.device_type)
+            await asyncio.sleep(delay)
+
+
+async def _race(
+    addresses: list[str], port: int, connect_timeout: Optional[float], stagger: float
+) -> tuple[Any, Any]:
+    if len(addresses) == 1:
+        return await _open_telnet(addresses[0], port, connect_timeout)
+
+    tasks: list["asyncio.Task[tuple[Any, Any]]"] = []
+    error: Optional[BaseException] = None
+    remaining = list(addresses)
+    try:
+        while remaining or tasks:
+            if remaining:
+                tasks.append(asyncio.ensure_future(_open_telnet(remaining.pop(0), port, connect_timeout)))
+            # 次のアドレスを始めるまでの間に成功/失敗したものを確認する
+            done, _ = await asyncio.wait(
+                tasks,
+                timeout=stagger if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                tasks.remove(task)
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error or OSError(errno.EHOSTUNREACH, f"cannot connect to {addresses}")
+
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                _, writer = await task
+                writer.close()
+            except (asyncio.CancelledError, Exception):
+                pass
@@ -10,7 +10,7 @@ platforms.sort()
 platforms_str = "\n".join(platforms)
 platforms_str = "\n" + platforms_str
 
-def ConnectHandler(device_dict: dict, timeout=30, use_username: bool = True) -> BaseConnection:
+def ConnectHandler(device_dict: dict, timeout=30, use_username: bool = True, **kwargs) -> BaseConnection:
     device = Device(**device_dict)
     device_type = device.device_type
 
@@ -19,12 +19,12 @@ def ConnectHandler(device_dict: dict, timeout=30, use_username: bool = True) ->
 
     try:
         ConnectionClass = CLASS_MAPPER_SYNC[device_type]
-        return ConnectionClass(device, timeout=timeout, use_username=use_username)
+        return ConnectionClass(device, timeout=timeout, use_username=use_username, **kwargs)
     
     except KeyError:
         raise ValueError(f"Unsupported device type: {device_type}")
 
-def ConnectHandlerAsync(device_dict: dict, timeout=30, use_username: bool = True) -> AsyncBaseConnection:
+def ConnectHandlerAsync(device_dict: dict, timeout=30, use_username: bool = True, **kwargs) -> AsyncBaseConnection:
     device = Device(**device_dict)
     device_type = device.device_type
 
@@ -33,7 +33,7 @@ def ConnectHandlerAsync(device_dict: dict, timeout=30, use_username: bool = True
 
     try:
         ConnectionClass = CLASS_MAPPER_ASYNC[device_type]
-        return ConnectionClass(device, timeout=timeout, use_username=use_username)
+        return ConnectionClass(device, timeout=timeout, use_username=use_username, **kwargs)
     
     except KeyError:
         raise ValueError(f"Unsupported device type: {device_type}")
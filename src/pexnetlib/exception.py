@@ -30,3 +30,14 @@ class AuthenticationException(PexnetlibBaseException):
 
     def __str__(self) -> str:
         return f"ホストへのログインに失敗 IP: {self.ipaddr} device_type: {self.device_type}"
+
+
+class ReplayMissException(PexnetlibBaseException):
+    """再生用アーカイブに記録がない"""
+
+    def __init__(self, ipaddr, command) -> None:
+        self.ipaddr = ipaddr
+        self.command = command
+
+    def __str__(self) -> str:
+        return f"アーカイブにコマンドの記録がありません IP: {self.ipaddr} command: {self.command}"
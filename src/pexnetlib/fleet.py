@@ -0,0 +1,145 @@
+import asyncio
+from typing import Any, AsyncIterator, Iterable, Iterator, Optional
+
+from pexnetlib.async_base_connection import AsyncBaseConnection
+from pexnetlib.dispatcher import ConnectHandlerAsync
+from pexnetlib.log import log
+from pexnetlib.model import FleetResult, check_commands, command_stage
+
+# ワーカー終了の通知用
+_DONE = object()
+
+
+async def _timed(result: FleetResult, stage: str, coro) -> Any:
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        return await coro
+    finally:
+        result.timings[stage] = loop.time() - start
+
+
+async def _run_device(
+    device_dict: dict,
+    commands: list[str],
+    result: FleetResult,
+    timeout: int,
+    use_username: bool,
+    use_textfsm: bool,
+    read_timeout: int,
+) -> None:
+    conn: Optional[AsyncBaseConnection] = None
+    try:
+        conn = ConnectHandlerAsync(device_dict, timeout=timeout, use_username=use_username)
+        await _timed(result, "connect", conn.connect())
+        conn.hostname, conn.prompt = await _timed(
+            result, "find_prompt", conn.find_prompt(conn.user_prompt)
+        )
+        await _timed(result, "initialize", conn.initialize())
+
+        for command in commands:
+            result.outputs[command] = await _timed(
+                result,
+                command_stage(command),
+                conn.send_command(command, use_textfsm=use_textfsm, read_timeout=read_timeout),
+            )
+
+    finally:
+        if conn is not None:
+            conn.disconnect()
+
+
+async def _worker(
+    devices: Iterator[dict],
+    commands: list[str],
+    queue: "asyncio.Queue[Any]",
+    per_host_timeout: Optional[float],
+    **kwargs: Any,
+) -> None:
+    # 共有イテレータから1台ずつ取り出すため、同時に存在するタスクはワーカー数までに収まる
+    loop = asyncio.get_running_loop()
+    try:
+        for device_dict in devices:
+            result = FleetResult(
+                ip=device_dict.get("ip", ""), device_type=device_dict.get("device_type", "")
+            )
+            start = loop.time()
+            try:
+                await asyncio.wait_for(
+                    _run_device(device_dict, commands, result, **kwargs), per_host_timeout
+                )
+
+            except asyncio.TimeoutError:
+                result.error = "TimeoutError"
+                result.error_message = f"per_host_timeout ({per_host_timeout}s) exceeded"
+
+            except Exception as e:
+                # 1台の失敗でバッチ全体を止めない
+                result.error = type(e).__name__
+                result.error_message = str(e)
+                log.debug(f"{result.ip}: {result.error}: {result.error_message}")
+
+            result.timings["total"] = loop.time() - start
+            await queue.put(result)
+
+    except Exception as e:
+        # 装置リスト自体の異常などは呼び出し側へ伝える
+        await queue.put(e)
+        return
+
+    await queue.put(_DONE)
+
+
+async def run_fleet(
+    devices: Iterable[dict],
+    commands: list[str],
+    concurrency: int = 50,
+    per_host_timeout: Optional[float] = None,
+    timeout: int = 30,
+    use_username: bool = True,
+    use_textfsm: bool = False,
+    read_timeout: int = 30,
+) -> AsyncIterator[FleetResult]:
+    """複数装置にコマンドを並列実行し、完了した装置から順に結果を返す
+
+    同時接続数はconcurrencyで制限され、装置ごとの失敗はFleetResult.errorに格納される。
+    コマンドの所要時間はtimings[command_stage(command)]に格納される。重複したコマンドはValueErrorになる。
+
+        async for result in run_fleet(devices, ["show version"], concurrency=100):
+            print(result.ip, result.ok)
+    """
+    commands = check_commands(commands)
+    device_iter = iter(devices)
+    queue: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=concurrency)
+    workers = [
+        asyncio.ensure_future(
+            _worker(
+                device_iter,
+                commands,
+                queue,
+                per_host_timeout,
+                timeout=timeout,
+                use_username=use_username,
+                use_textfsm=use_textfsm,
+                read_timeout=read_timeout,
+            )
+        )
+        for _ in range(max(1, concurrency))
+    ]
+
+    try:
+        running = len(workers)
+        while running:
+            item = await queue.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    finally:
+        # 呼び出し側がループを途中で抜けた場合は残りを打ち切る
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
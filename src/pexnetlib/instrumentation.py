@@ -0,0 +1,279 @@
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from pexnetlib.log import log
+
+# 接続の各段階で計測するスパン名
+SPAN_CONNECT = "connect"
+SPAN_TCP_CONNECT = "tcp_connect"
+SPAN_LOGIN_PROMPT = "login_prompt"
+SPAN_AUTHENTICATE = "authenticate"
+SPAN_FIND_PROMPT = "find_prompt"
+SPAN_INITIALIZE = "initialize"
+SPAN_COMMAND = "command"
+SPAN_PARSE = "parse"
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Span:
+    """1つの処理区間の計測結果"""
+
+    __slots__ = (
+        "name", "ip", "device_type", "command", "start", "duration",
+        "bytes", "chunks", "parse_time", "error",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        ip: str,
+        device_type: str,
+        start: float,
+        duration: float,
+        command: str = "",
+        bytes: int = 0,
+        chunks: int = 0,
+        parse_time: float = 0.0,
+        error: Optional[str] = None,
+    ) -> None:
+        self.name = name
+        self.ip = ip
+        self.device_type = device_type
+        self.start = start
+        self.duration = duration
+        self.command = command
+        self.bytes = bytes
+        self.chunks = chunks
+        self.parse_time = parse_time
+        self.error = error
+
+    def to_dict(self) -> dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"Span({self.name!r}, ip={self.ip!r}, command={self.command!r}, duration={self.duration:.6f})"
+
+
+SpanHook = Callable[[Span], None]
+
+# すべての接続に適用するフック
+_global_hooks: list[SpanHook] = []
+
+
+def add_global_hook(hook: SpanHook) -> None:
+    """以降に作成するすべての接続にフックを登録する"""
+    _global_hooks.append(hook)
+
+
+def remove_global_hook(hook: SpanHook) -> None:
+    _global_hooks.remove(hook)
+
+
+def get_global_hooks() -> list[SpanHook]:
+    return list(_global_hooks)
+
+
+# フック未登録時にspan()が返すダミー。値を書き込まれても発行はしない
+_NULL_SPAN = Span("", "", "", 0.0, 0.0)
+
+
+class Instrumented:
+    """接続クラスにスパンの計測処理を追加するMixin
+
+    フックが1つも登録されていない場合は時刻の取得もSpanの作成も行わない。
+    """
+
+    hooks: list[SpanHook]
+    device: Any
+
+    @contextmanager
+    def span(self, name: str, command: str = "") -> Iterator[Span]:
+        """区間を計測してフックに渡す
+
+        ブロック内でbytes/chunks/parse_timeを書き込める。
+        例外が発生した場合は例外クラス名をerrorに記録する。
+        """
+        if not self.hooks:
+            yield _NULL_SPAN
+            return
+
+        span = Span(
+            name, self.device.ip, self.device.device_type, time.perf_counter(), 0.0,
+            command=command,
+        )
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.start
+            for hook in self.hooks:
+                # フックの失敗でコマンドを失敗させたり、元の例外を隠したりしない
+                try:
+                    hook(span)
+                except Exception as e:
+                    log.debug(f"{span.ip}: span hook {hook!r} failed: {e!r}")
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count", "max", "bytes", "chunks", "errors")
+
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+        self.bytes = 0
+        self.chunks = 0
+        self.errors = 0
+
+
+class HistogramCollector:
+    """スパンの所要時間をメモリ上のヒストグラムに集計するフック
+
+    (スパン名, device_type)ごとのヒストグラムと、遅い装置を探すための装置(IP)ごとの集計を持つ。
+    接続オブジェクトのhooksに登録するか、add_global_hookで全接続に登録して使う。
+    """
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms: dict[tuple[str, str], _Histogram] = {}
+            self._devices: dict[tuple[str, str], _Histogram] = {}
+
+    def __call__(self, span: Span) -> None:
+        index = bisect.bisect_left(self.buckets, span.duration)
+        with self._lock:
+            for table, key in (
+                (self._histograms, (span.name, span.device_type)),
+                (self._devices, (span.ip, span.name)),
+            ):
+                histogram = table.get(key)
+                if histogram is None:
+                    histogram = table[key] = _Histogram(len(self.buckets) + 1)
+                histogram.counts[index] += 1
+                histogram.sum += span.duration
+                histogram.count += 1
+                histogram.max = max(histogram.max, span.duration)
+                histogram.bytes += span.bytes
+                histogram.chunks += span.chunks
+                if span.error is not None:
+                    histogram.errors += 1
+
+    def quantile(self, name: str, q: float, device_type: Optional[str] = None) -> float:
+        """ヒストグラムから分位点を推定する(該当するバケットの上限値を返す)"""
+        with self._lock:
+            counts = [0] * (len(self.buckets) + 1)
+            maximum = 0.0
+            for (span_name, span_device_type), histogram in self._histograms.items():
+                if span_name == name and device_type in (None, span_device_type):
+                    counts = [a + b for a, b in zip(counts, histogram.counts)]
+                    maximum = max(maximum, histogram.max)
+
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank:
+                return self.buckets[index] if index < len(self.buckets) else maximum
+        return maximum
+
+    def slowest_devices(self, name: str = SPAN_COMMAND, limit: int = 10) -> list[dict[str, Any]]:
+        """平均所要時間が長い順に装置を返却する"""
+        with self._lock:
+            rows = [
+                {
+                    "ip": ip,
+                    "count": histogram.count,
+                    "mean": histogram.sum / histogram.count,
+                    "max": histogram.max,
+                    "errors": histogram.errors,
+                }
+                for (ip, span_name), histogram in self._devices.items()
+                if span_name == name and histogram.count
+            ]
+        rows.sort(key=lambda row: row["mean"], reverse=True)
+        return rows[:limit]
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            spans = [
+                {
+                    "span": name,
+                    "device_type": device_type,
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "max": histogram.max,
+                    "bytes": histogram.bytes,
+                    "chunks": histogram.chunks,
+                    "errors": histogram.errors,
+                    "buckets": dict(zip([*map(str, self.buckets), "+Inf"], histogram.counts)),
+                }
+                for (name, device_type), histogram in self._histograms.items()
+            ]
+            devices = [
+                {
+                    "ip": ip,
+                    "span": name,
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "max": histogram.max,
+                    "bytes": histogram.bytes,
+                    "errors": histogram.errors,
+                }
+                for (ip, name), histogram in self._devices.items()
+            ]
+        return {"spans": spans, "devices": devices}
+
+    def to_json(self, **kwargs: Any) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix: str = "pexnetlib") -> str:
+        """Prometheusのテキスト形式で出力する(装置ごとの集計はラベル数が増えるため含めない)"""
+        lines = [
+            f"# HELP {prefix}_span_seconds Duration of connection and command spans.",
+            f"# TYPE {prefix}_span_seconds histogram",
+        ]
+        totals = []
+        with self._lock:
+            for (name, device_type), histogram in sorted(self._histograms.items()):
+                labels = f'span="{_escape(name)}",device_type="{_escape(device_type)}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_span_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_span_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{prefix}_span_seconds_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{prefix}_span_seconds_count{{{labels}}} {histogram.count}")
+                totals.append((labels, histogram))
+
+        for metric, attr, help_text in (
+            ("received_bytes_total", "bytes", "Bytes received from devices."),
+            ("received_chunks_total", "chunks", "Read calls that returned data."),
+            ("span_errors_total", "errors", "Spans that ended with an exception."),
+        ):
+            lines.append(f"# HELP {prefix}_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_{metric} counter")
+            for labels, histogram in totals:
+                lines.append(f"{prefix}_{metric}{{{labels}}} {getattr(histogram, attr)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
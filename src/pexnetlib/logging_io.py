@@ -1,42 +1,200 @@
 import logging
+from typing import BinaryIO, Optional
 from telnetlib3 import TelnetReaderUnicode
+
+
+class RingBuffer:
+    """容量を固定したバイト列のリングバッファ。溢れた場合は古いデータから捨てる"""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._view = memoryview(bytearray(capacity))
+        self._start = 0
+        self.size = 0
+        # 容量を超えて捨てたバイト数
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def write(self, data: bytes) -> None:
+        length = len(data)
+        capacity = self.capacity
+        if length >= capacity:
+            self.dropped += self.size + length - capacity
+            self._view[:] = memoryview(data)[length - capacity:]
+            self._start = 0
+            self.size = capacity
+            return
+
+        overflow = self.size + length - capacity
+        if overflow > 0:
+            self.consume(overflow)
+            self.dropped += overflow
+
+        source = memoryview(data)
+        end = (self._start + self.size) % capacity
+        first = min(length, capacity - end)
+        self._view[end:end + first] = source[:first]
+        if first < length:
+            self._view[:length - first] = source[first:]
+        self.size += length
+
+    def getvalue(self) -> bytes:
+        end = self._start + self.size
+        if end <= self.capacity:
+            return self._view[self._start:end].tobytes()
+        return self._view[self._start:].tobytes() + self._view[:end - self.capacity].tobytes()
+
+    def consume(self, length: int) -> None:
+        """先頭からlengthバイトを捨てる"""
+        length = min(length, self.size)
+        self._start = (self._start + length) % self.capacity
+        self.size -= length
+        if not self.size:
+            self._start = 0
+
+    def clear(self) -> None:
+        self.consume(self.size)
+
+
 class LoggingIO:
-    """pexpectのログ出力をロガーに吐き出すためのクラス"""
+    """pexpectのログ出力をロガーに吐き出すためのクラス
 
-    def __init__(self, logger: logging.Logger) -> None:
+    受信データはバイト列のままリングバッファに溜め、ログ出力時に一度だけデコードする。
+    ロガーがDEBUGを出力しない場合はバッファリングも行わない。
+    sinkを指定した場合は受信した生データをblock_sizeごとにまとめて書き込む。
+    sinkがwait_writable()を持つ場合(TranscriptWriter)は書き込み後に呼び出して背圧をかける。
+    イベントループ上で使う場合はwait_sink=Falseとし、呼び出し側でdrain()を待つこと。
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        max_buffer: int = 65536,
+        sink: Optional[BinaryIO] = None,
+        block_size: int = 65536,
+        wait_sink: bool = True,
+    ) -> None:
         self.logger = logger
-        self.buffer = ""
+        self.buffer = RingBuffer(max_buffer)
+        self.sink = sink
+        self.block_size = block_size
+        self._wait = getattr(sink, "wait_writable", None) if wait_sink else None
+        self._raw = bytearray()
+        self._newline = False
 
     def write(self, b: bytes) -> None:
-        self.buffer += b.decode()
+        if self.sink is not None:
+            self._raw += b
+            if len(self._raw) >= self.block_size:
+                self._write_sink()
+                if self._wait is not None:
+                    self._wait()
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.buffer.write(b)
+            if b"\n" in b:
+                self._newline = True
 
     def flush(self) -> None:
-        if "\n" in self.buffer:
-            self.logger.debug(self.buffer)
-            self.buffer = ""
+        # pexpectはwriteのたびにflushを呼ぶため、改行を受信していなければ何もしない
+        if not self._newline:
+            return
+        self._newline = False
+        data = self.buffer.getvalue()
+        newline = data.rfind(b"\n")
+        if newline < 0:
+            return
+        # 行の途中までは次の出力にまわす
+        self.buffer.consume(newline + 1)
+        self.logger.debug(data[:newline + 1].decode(errors="replace"))
+
+    def close(self) -> None:
+        """残りのデータを出力する。sink自体は閉じない"""
+        if self.buffer.size:
+            data = self.buffer.getvalue()
+            self.buffer.clear()
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(data.decode(errors="replace"))
+        if self.sink is not None:
+            self._write_sink()
+            self.sink.flush()
+
+    def _write_sink(self) -> None:
+        if self._raw and self.sink is not None:
+            self.sink.write(self._raw)
+            self._raw = bytearray()
+
 
 class AsyncLogginIO:
-    """telnetlib3のTelnetReaderの出力をロガーに吐き出すためのクラス"""
-    def __init__(self, reader: TelnetReaderUnicode, logger: logging.Logger):
+    """telnetlib3のTelnetReaderの出力をロガーに吐き出すためのクラス
+
+    DEBUGが無効な場合は受信データを保持しない。
+    ログ用のバッファとsinkへの書き込み方針はLoggingIOと同じ。
+    """
+    def __init__(
+        self,
+        reader: TelnetReaderUnicode,
+        logger: logging.Logger,
+        max_buffer: int = 65536,
+        sink: Optional[BinaryIO] = None,
+        block_size: int = 65536,
+    ):
         self._reader = reader
         self.logger = logger
-        self.buffer = ""
+        self.buffer = RingBuffer(max_buffer)
+        self.sink = sink
+        self.block_size = block_size
+        self._raw: list[str] = []
+        self._raw_size = 0
+        self._drain = getattr(sink, "drain", None)
 
     async def read(self, n: int = -1) -> str:
         data = await self._reader.read(n)
-        self.buffer += data
-        if "\n" in data:
-            self.logger.debug(f"{self.buffer}")
-            self.buffer = ""
+        if not data:
+            return data
+
+        if self.sink is not None:
+            self._raw.append(data)
+            self._raw_size += len(data)
+            if self._raw_size >= self.block_size:
+                self._write_sink()
+                if self._drain is not None:
+                    await self._drain()
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.buffer.write(data.encode())
+            if "\n" in data:
+                self._emit()
         return data
 
     async def flush(self):
-        if self.buffer:
-            self.logger.debug(self.buffer)
-            self.buffer = ""
+        if self.buffer.size:
+            self._emit()
+
+    def close(self) -> None:
+        """残りのデータを出力する。sink自体は閉じない"""
+        if self.buffer.size:
+            self._emit()
+        if self.sink is not None:
+            self._write_sink()
+            self.sink.flush()
+
+    def _emit(self) -> None:
+        data = self.buffer.getvalue()
+        self.buffer.clear()
+        self.logger.debug(data.decode(errors="replace"))
+
+    def _write_sink(self) -> None:
+        if self._raw and self.sink is not None:
+            # 受信したチャンクはまとめて一度だけエンコードする
+            self.sink.write("".join(self._raw).encode())
+            self._raw = []
+            self._raw_size = 0
 
     def at_eof(self) -> bool:
         return self._reader.at_eof()
 
     def __getattr__(self, name):
-        return getattr(self._reader, name)
\ No newline at end of file
+        return getattr(self._reader, name)
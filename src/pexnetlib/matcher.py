@@ -0,0 +1,93 @@
+import re
+from functools import lru_cache
+from typing import AnyStr, Generic, Optional, Pattern, Union
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(
+    pattern: Union[str, bytes, Pattern], reg: bool = False
+) -> Optional[Pattern]:
+    """正規表現パターンをコンパイルして返却する。リテラル指定の場合はNoneを返す"""
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    if reg:
+        return re.compile(pattern)
+    return None
+
+
+class StreamMatcher(Generic[AnyStr]):
+    """チャンク境界をまたいでパターンを検出するインクリメンタルマッチャー
+
+    受信したチャンクはリストに溜めて最後に一度だけ連結する。
+    パターンの探索は「前回までの末尾ウィンドウ + 今回のチャンク」に限定するため、
+    出力サイズに対して線形時間で動作する。
+    collect=Falseの場合はチャンクを保持せず、一致位置の検出だけを行う。
+    """
+
+    def __init__(
+        self,
+        pattern: Union[AnyStr, Pattern[AnyStr]],
+        reg: bool = False,
+        window: int = 4096,
+        collect: bool = True,
+    ) -> None:
+        self.regex = compile_pattern(pattern, reg)
+        if self.regex is not None:
+            self.literal = None
+            self._empty = self.regex.pattern[:0]
+            # 正規表現は一致長が不定なのでwindow分の末尾を保持する
+            self._keep = window
+        else:
+            self.literal = pattern
+            self._empty = pattern[:0]
+            # リテラルは「パターン長 - 1」だけ保持すれば境界をまたいだ一致を拾える
+            self._keep = len(pattern) - 1
+
+        self.collect = collect
+        self._chunks: list[AnyStr] = []
+        self._tail = self._empty
+        self.size = 0
+        self.chunk_count = 0
+        self.match: Optional[re.Match] = None
+        self.start = -1
+        self.end = -1
+
+    def feed(self, chunk: AnyStr) -> bool:
+        """チャンクを追加し、パターンに一致した場合Trueを返す"""
+        if self.collect:
+            self._chunks.append(chunk)
+        self.chunk_count += 1
+
+        scan = self._tail + chunk
+        base = self.size - len(self._tail)
+        self.size += len(chunk)
+
+        if self.regex is not None:
+            match = self.regex.search(scan)
+            if match:
+                self.match = match
+                self.start = base + match.start()
+                self.end = base + match.end()
+                return True
+        else:
+            index = scan.find(self.literal)
+            if index >= 0:
+                self.start = base + index
+                self.end = self.start + len(self.literal)
+                return True
+
+        self._tail = scan[-self._keep:] if self._keep > 0 else self._empty
+        return False
+
+    def getvalue(self) -> AnyStr:
+        """受信したデータ全体を返却する"""
+        if len(self._chunks) > 1:
+            self._chunks = [self._empty.join(self._chunks)]
+        return self._chunks[0] if self._chunks else self._empty
+
+    def split(self) -> tuple[AnyStr, AnyStr]:
+        """一致箇所の末尾までのデータと、それ以降に受信していた残りを返却する"""
+        data = self.getvalue()
+        if self.end < 0:
+            return data, self._empty
+        return data[:self.end], data[self.end:]
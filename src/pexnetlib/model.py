@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Optional
 
 @dataclass
 class Device:
@@ -7,3 +8,41 @@ class Device:
   password: str
   enable: str
   device_type: str
+  # 接続先のポート
+  port: int = 23
+  # TCP接続のタイムアウト(秒)。Noneの場合は接続クラスのtimeoutを使う
+  connect_timeout: Optional[float] = None
+  # TCP接続に失敗した場合の再試行回数(待ち時間は指数関数的に伸ばす)
+  connect_retries: int = 0
+  # ipの他に接続を試す管理アドレス(IPv6/予備系など)。並行して接続し最初に成功したものを使う
+  addresses: list[str] = field(default_factory=list)
+
+@dataclass
+class FleetResult:
+  """1台分の実行結果"""
+  ip: str
+  device_type: str
+  outputs: dict[str, Any] = field(default_factory=dict)
+  # ステージ名(connect/find_prompt/initialize/total)とコマンド(command_stageのキー)ごとの所要時間(秒)
+  timings: dict[str, float] = field(default_factory=dict)
+  error: Optional[str] = None
+  error_message: str = ""
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+# timingsでコマンドの所要時間に付ける接頭辞。connect/totalなどのステージ名と衝突しないようにする
+COMMAND_STAGE_PREFIX = "cmd:"
+
+def command_stage(command: str) -> str:
+  """FleetResult.timingsでコマンドの所要時間を格納するキー"""
+  return COMMAND_STAGE_PREFIX + command
+
+def check_commands(commands: Iterable[str]) -> list[str]:
+  """FleetResult.outputsはコマンドをキーにするため、重複したコマンドはValueErrorにする"""
+  commands = list(commands)
+  duplicates = sorted({command for command in commands if commands.count(command) > 1})
+  if duplicates:
+    raise ValueError(f"duplicate commands: {duplicates}")
+  return commands
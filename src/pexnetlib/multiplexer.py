@@ -0,0 +1,520 @@
+import errno
+import inspect
+import selectors
+import socket
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, Optional, Pattern, Type
+
+from pexpect.exceptions import EOF
+
+from pexnetlib.base_connection import BaseConnection
+from pexnetlib.CLASS_MAPPER import CLASS_MAPPER_SYNC
+from pexnetlib.connect import DEFAULT_BACKOFF, backoff_delays, connect_timeout_of, device_addresses
+from pexnetlib.exception import AuthenticationException, ConnectionException
+from pexnetlib.log import log
+from pexnetlib.matcher import StreamMatcher
+from pexnetlib.model import Device, FleetResult, check_commands, command_stage
+from pexnetlib.pager import PagerDetector, pager_detector, pager_pattern_for, pager_remnant_step
+from pexnetlib.prompt import build_prompt_regex, encode_pattern, parse_prompt
+from pexnetlib.sanitizer import Sanitizer
+from pexnetlib.telnet import TelnetSocket
+from pexnetlib.textfsm_util import get_structured_data_textfsm
+
+# セッションの状態
+STATE_CONNECTING = "connecting"
+STATE_LOGIN = "login"
+STATE_FIND_PROMPT = "find_prompt"
+STATE_INITIALIZE = "initialize"
+STATE_COMMAND = "command"
+STATE_DONE = "done"
+
+# タイムアウトを確認する間隔(秒)
+_SCAN_INTERVAL = 0.05
+# ホスト名の名前解決に使うスレッド数の上限
+_RESOLVER_THREADS = 8
+
+
+def _constructor_defaults(cls: Type[BaseConnection]) -> dict[str, Any]:
+    """接続クラスの__init__の既定値(login_promptなど)を集める
+
+    ベンダクラスは__init__の引数でプロンプトを変えているため、
+    インスタンスを作らずに同じ値を使えるようMROをさかのぼって既定値を取得する。
+    """
+    defaults: dict[str, Any] = {}
+    for klass in reversed(cls.__mro__):
+        init = klass.__dict__.get("__init__")
+        if init is None:
+            continue
+        for name, parameter in inspect.signature(init).parameters.items():
+            if parameter.default is not inspect.Parameter.empty:
+                defaults[name] = parameter.default
+    return defaults
+
+
+def _resolve(address: str, port: int, numeric: bool = False) -> tuple:
+    """接続に使うアドレス情報(family, type, proto, canonname, sockaddr)を返す
+
+    numeric=TrueではIPアドレスのみ受け付け(AI_NUMERICHOST)、DNSへの問い合わせで待たない。
+    """
+    flags = socket.AI_NUMERICHOST if numeric else 0
+    return socket.getaddrinfo(address, port, type=socket.SOCK_STREAM, flags=flags)[0]
+
+
+class _Step:
+    __slots__ = ("state", "line", "pattern", "command")
+
+    def __init__(self, state: str, line: Optional[str], pattern: Optional[str], command: str = "") -> None:
+        self.state = state
+        # 送信する行(Noneの場合は送信せずに待つ)
+        self.line = line
+        # 待つパターン(Noneの場合はfind_promptで取得したプロンプト)
+        self.pattern = pattern
+        self.command = command
+
+
+class MuxSession:
+    """1台分のセッションを ログイン → プロンプト取得 → 初期化 → コマンド の順に進める状態機械
+
+    読み込み可能になるたびにon_readableが呼ばれ、待っているパターンを受信したら次の手順へ進む。
+    """
+
+    def __init__(
+        self,
+        device: Device,
+        commands: list[str],
+        connection_class: Type[BaseConnection],
+        use_username: bool,
+        use_textfsm: bool,
+        timeout: float,
+        read_timeout: float,
+        backoff: float = DEFAULT_BACKOFF,
+    ) -> None:
+        defaults = _constructor_defaults(connection_class)
+        self.device = device
+        self.use_textfsm = use_textfsm
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        self.user_prompt: str = defaults.get("user_prompt", ">")
+        self.enable_prompt: str = defaults.get("enable_prompt", "#")
+        self.pager_pattern = pager_pattern_for(device.device_type) if connection_class.paging else None
+        sanitize_steps = connection_class.sanitize_steps
+        if self.pager_pattern is not None:
+            sanitize_steps = (pager_remnant_step(self.pager_pattern), *sanitize_steps)
+        self.sanitizer = Sanitizer(ansi=defaults.get("ansi", False), steps=sanitize_steps)
+        self.result = FleetResult(ip=device.ip, device_type=device.device_type)
+        self.state = STATE_CONNECTING
+        self.hostname = ""
+        self.prompt = ""
+        self.sock: Optional[socket.socket] = None
+        self.address = device.ip
+        self.telnet: Optional[TelnetSocket] = None
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.connect_timeout = connect_timeout_of(device, timeout)
+        # 接続先の候補(アドレス, 接続前の待ち時間)。アドレスを順に試し、一巡するごとに待ち時間を伸ばす
+        addresses = device_addresses(device)
+        self._attempts: deque[tuple[str, float]] = deque(
+            (address, delay if i == 0 else 0.0)
+            for delay in (0.0, *backoff_delays(device.connect_retries, backoff))
+            for i, address in enumerate(addresses)
+        )
+        # 次の接続を開始する時刻(Noneの場合は接続中または接続済み)
+        self.retry_at: Optional[float] = None
+        self._stage_start = self.started
+        self._matcher: Optional[StreamMatcher] = None
+        # コマンドの出力を待つ間だけページャに応答する
+        self._pager: Optional[PagerDetector] = None
+
+        login_prompt = defaults.get("login_prompt", "Username")
+        password_prompt = defaults.get("password_prompt", "assword")
+        steps = []
+        if use_username:
+            steps.append(_Step(STATE_LOGIN, None, login_prompt))
+            steps.append(_Step(STATE_LOGIN, device.username, password_prompt))
+        else:
+            steps.append(_Step(STATE_LOGIN, None, password_prompt))
+        steps.append(_Step(STATE_LOGIN, device.password, self.user_prompt))
+        steps.append(_Step(STATE_FIND_PROMPT, "", self.user_prompt))
+        steps.extend(_Step(STATE_INITIALIZE, command, None, command) for command in connection_class.init_commands)
+        steps.extend(_Step(STATE_COMMAND, command, None, command) for command in commands)
+        self._steps = deque(steps)
+        self._step: Optional[_Step] = None
+
+    def schedule_connect(self) -> bool:
+        """次の接続先があればretry_atを設定してTrueを返す。接続中のソケットは閉じる"""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if not self._attempts:
+            return False
+        self.retry_at = time.monotonic() + self._attempts[0][1]
+        return True
+
+    def next_address(self) -> str:
+        """次の接続先を取り出す。名前解決と接続の完了はconnect_timeoutまで待つ"""
+        self.address, _ = self._attempts.popleft()
+        self.retry_at = None
+        self.deadline = time.monotonic() + (
+            self.connect_timeout if self.connect_timeout is not None else self.timeout
+        )
+        return self.address
+
+    def start_connect(self, addrinfo: tuple) -> socket.socket:
+        """ノンブロッキングで接続を開始する。接続の完了は書き込み可能になったことで検知する"""
+        family, socktype, proto, _, sockaddr = addrinfo
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(False)
+        code = sock.connect_ex(sockaddr)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise ConnectionException(self.device.ip, self.device.device_type)
+        self.sock = sock
+        return sock
+
+    def on_connected(self) -> None:
+        if self.sock is None or self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            raise ConnectionException(self.device.ip, self.device.device_type)
+        # 送信もノンブロッキングのまま行い、送り切れない分はEVENT_WRITEで続きを送る
+        self.telnet = TelnetSocket(
+            self.address,
+            port=self.device.port,
+            timeout=self.read_timeout,
+            sock=self.sock,
+            nonblocking=True,
+        )
+        self._next_step()
+
+    @property
+    def events(self) -> int:
+        """selectorで待つイベント。未送信のデータがあれば書き込み可能も待つ"""
+        if self.state == STATE_CONNECTING:
+            return selectors.EVENT_WRITE
+        if self.telnet is not None and self.telnet.has_pending_output:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def on_writable(self) -> None:
+        if self.telnet is not None:
+            self.telnet.flush()
+
+    def on_readable(self) -> None:
+        if self.telnet is None:
+            return
+        try:
+            data = self.telnet.receive()
+        except EOF:
+            # ログイン中に切断された場合はタイムアウトと同じく接続/認証の失敗として扱う
+            if self.state == STATE_LOGIN:
+                self.on_timeout()
+            raise
+        if data:
+            self.deadline = time.monotonic() + self._wait_timeout()
+            self._feed(data)
+
+    def on_timeout(self) -> None:
+        if self.state == STATE_CONNECTING or (self.state == STATE_LOGIN and self._is_first_step()):
+            # ログインプロンプトが返ってこないのはtelnet接続失敗と判断する
+            raise ConnectionException(self.device.ip, self.device.device_type)
+        if self.state == STATE_LOGIN:
+            raise AuthenticationException(self.device.ip, self.device.device_type)
+        raise TimeoutError(f"{self.state} timed out ({self._step.command if self._step else ''})")
+
+    def _is_first_step(self) -> bool:
+        return self._step is not None and self._step.line is None
+
+    def _wait_timeout(self) -> float:
+        return self.timeout if self.state in (STATE_CONNECTING, STATE_LOGIN) else self.read_timeout
+
+    def _feed(self, data: bytes) -> None:
+        while self._matcher is not None and data:
+            if not self._matcher.feed(data):
+                if self._pager is not None and self.telnet is not None and self._pager.feed(data):
+                    self.telnet.send(b" ")
+                return
+            output, data = self._matcher.split()
+            self._on_matched(output.decode("utf-8", errors="ignore"))
+            # パターンより後ろのデータは次の手順のマッチャーに渡す
+            self._next_step()
+
+    def _on_matched(self, raw_data: str) -> None:
+        step = self._step
+        if step is None:
+            return
+        now = time.monotonic()
+        match = self._matcher.match if self._matcher is not None else None
+        if step.pattern is None and match is not None:
+            # configモードへの移行などでプロンプトが変わった場合に、コマンドを終えたプロンプトへ追従する
+            parsed = parse_prompt(
+                self.prompt_regex, match.group(0).decode("utf-8", errors="ignore"), self.enable_prompt
+            )
+            if parsed is not None:
+                _, self.prompt = parsed
+        if step.state == STATE_FIND_PROMPT:
+            self.hostname = self.sanitizer.sanitize(
+                raw_data, command="", pattern=self.user_prompt, echo=True
+            )
+            self.prompt = self.hostname + self.user_prompt
+        elif step.state == STATE_COMMAND:
+            output: Any = self.sanitizer.sanitize(
+                raw_data, command=step.command, pattern=self.prompt_regex, echo=True
+            )
+            if self.use_textfsm:
+                output = get_structured_data_textfsm(
+                    output, platform=self.device.device_type, command=step.command, template=None
+                )
+            self.result.outputs[step.command] = output
+            self.result.timings[command_stage(step.command)] = now - self._stage_start
+            self._stage_start = now
+
+        next_state = self._steps[0].state if self._steps else STATE_DONE
+        if step.state != next_state and step.state != STATE_COMMAND:
+            # fleet.pyと同じステージ名で所要時間を記録する(ログイン完了までをconnectとする)
+            stage = "connect" if step.state == STATE_LOGIN else step.state
+            self.result.timings[stage] = now - self._stage_start
+            self._stage_start = now
+
+    def _next_step(self) -> None:
+        if not self._steps:
+            self._step = None
+            self._matcher = None
+            self.state = STATE_DONE
+            return
+
+        step = self._step = self._steps.popleft()
+        self.state = step.state
+        if step.pattern is not None:
+            self._matcher = StreamMatcher(step.pattern.encode())
+            self._pager = None
+        else:
+            self._matcher = StreamMatcher(encode_pattern(self.prompt_regex))
+            self._pager = pager_detector(self.pager_pattern, binary=True)
+        self.deadline = time.monotonic() + self._wait_timeout()
+        if step.line is not None and self.telnet is not None:
+            self.telnet.sendline(step.line)
+
+    @property
+    def prompt_regex(self) -> Pattern[str]:
+        """find_promptで取得したホスト名から作成したプロンプトの正規表現"""
+        return build_prompt_regex(self.hostname, self.user_prompt, self.enable_prompt)
+
+    @property
+    def done(self) -> bool:
+        return self.state == STATE_DONE
+
+    def close(self) -> None:
+        if self.telnet is not None:
+            self.telnet.close()
+        elif self.sock is not None:
+            self.sock.close()
+
+
+class Multiplexer:
+    """1スレッドのselectorsループで多数の同期セッションを同時に進める
+
+    スレッドやasyncioを使わずに、数千台の装置へコマンドを実行できる。
+    接続はtransport="socket"と同じTelnetSocketを使い、ベンダごとのプロンプトや
+    初期化コマンド(init_commands)、出力の整形はCLASS_MAPPER_SYNCの接続クラスの設定に従う。
+    Deviceのaddresses/connect_retriesは接続に失敗するたびに順に試す(並行には接続しない)。
+    ホスト名の名前解決はループを止めないよう別スレッドで行う(IPアドレスはそのまま接続する)。
+
+        for result in Multiplexer(concurrency=500).run(devices, ["show version"]):
+            print(result.ip, result.ok)
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 256,
+        timeout: float = 30,
+        use_username: bool = True,
+        use_textfsm: bool = False,
+        read_timeout: float = 30,
+    ) -> None:
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.use_username = use_username
+        self.use_textfsm = use_textfsm
+        self.read_timeout = read_timeout
+
+    def _create(self, device_dict: dict, commands: list[str]) -> MuxSession:
+        device = Device(**device_dict)
+        try:
+            connection_class = CLASS_MAPPER_SYNC[device.device_type]
+        except KeyError:
+            raise ValueError(f"Unsupported device type: {device.device_type}")
+        return MuxSession(
+            device,
+            commands,
+            connection_class,
+            use_username=self.use_username,
+            use_textfsm=self.use_textfsm,
+            timeout=self.timeout,
+            read_timeout=self.read_timeout,
+        )
+
+    def run(self, devices: Iterable[dict], commands: list[str]) -> Iterator[FleetResult]:
+        """装置ごとの結果を完了した順に返す。装置ごとの失敗はFleetResult.errorに格納される"""
+        commands = check_commands(commands)
+        device_iter = iter(devices)
+        selector = selectors.DefaultSelector()
+        sessions: set[MuxSession] = set()
+        # 接続の再試行を待っているセッション
+        waiting: set[MuxSession] = set()
+        finished: deque[FleetResult] = deque()
+        # 名前解決中のセッション。スレッドはホスト名が現れた場合のみ作成する
+        resolving: dict[MuxSession, Future] = {}
+        resolver: Optional[ThreadPoolExecutor] = None
+        exhausted = False
+        last_scan = time.monotonic()
+
+        def finish(session: MuxSession, error: Optional[BaseException] = None) -> None:
+            if session.sock is not None:
+                try:
+                    selector.unregister(session.sock)
+                except (KeyError, ValueError):
+                    pass
+            session.close()
+            sessions.discard(session)
+            waiting.discard(session)
+            resolving.pop(session, None)
+            result = session.result
+            if error is not None:
+                result.error = type(error).__name__
+                result.error_message = str(error)
+                log.debug(f"{result.ip}: {result.error}: {result.error_message}")
+            result.timings["total"] = time.monotonic() - session.started
+            finished.append(result)
+
+        def start(session: MuxSession) -> None:
+            nonlocal resolver
+            address = session.next_address()
+            try:
+                addrinfo = _resolve(address, session.device.port, numeric=True)
+            except socket.gaierror:
+                # ホスト名はDNSの応答を待つ間に他のセッションを止めないよう別スレッドで解決する
+                if resolver is None:
+                    resolver = ThreadPoolExecutor(_RESOLVER_THREADS, thread_name_prefix="pexnetlib-resolve")
+                resolving[session] = resolver.submit(_resolve, address, session.device.port)
+                return
+            connect(session, addrinfo)
+
+        def connect(session: MuxSession, addrinfo: tuple) -> None:
+            try:
+                sock = session.start_connect(addrinfo)
+            except Exception as e:
+                retry(session, e)
+                return
+            selector.register(sock, selectors.EVENT_WRITE, session)
+
+        def retry(session: MuxSession, error: BaseException) -> None:
+            # 接続に失敗した場合は次のアドレス(または待ち時間の後の再試行)へ進む
+            if session.sock is not None:
+                try:
+                    selector.unregister(session.sock)
+                except (KeyError, ValueError):
+                    pass
+            # 名前解決がタイムアウトした場合は結果を待たずに次へ進む
+            resolving.pop(session, None)
+            if not session.schedule_connect():
+                finish(session, error)
+            elif session.retry_at is not None and session.retry_at <= time.monotonic():
+                start(session)
+            else:
+                waiting.add(session)
+
+        try:
+            while True:
+                # 同時セッション数がconcurrencyになるまで新しい装置の接続を開始する
+                while not exhausted and len(sessions) < self.concurrency:
+                    device_dict = next(device_iter, None)
+                    if device_dict is None:
+                        exhausted = True
+                        break
+                    session = self._create(device_dict, commands)
+                    sessions.add(session)
+                    if session.schedule_connect():
+                        start(session)
+                    else:
+                        finish(session, ValueError(f"no address for {session.device.ip}"))
+
+                while finished:
+                    yield finished.popleft()
+
+                if exhausted and not sessions:
+                    return
+
+                for key, events in selector.select(_SCAN_INTERVAL):
+                    session = key.data
+                    try:
+                        if session.state == STATE_CONNECTING:
+                            try:
+                                session.on_connected()
+                            except Exception as e:
+                                retry(session, e)
+                                continue
+                        else:
+                            if events & selectors.EVENT_WRITE:
+                                session.on_writable()
+                            if events & selectors.EVENT_READ:
+                                session.on_readable()
+                    except Exception as e:
+                        finish(session, e)
+                        continue
+                    if session.done:
+                        finish(session)
+                    elif session.events != key.events:
+                        selector.modify(key.fileobj, session.events, session)
+
+                for session in [s for s, future in resolving.items() if future.done()]:
+                    future = resolving.pop(session)
+                    try:
+                        addrinfo = future.result()
+                    except Exception as e:
+                        retry(session, e)
+                        continue
+                    connect(session, addrinfo)
+
+                now = time.monotonic()
+                if now - last_scan >= _SCAN_INTERVAL:
+                    last_scan = now
+                    for session in [s for s in waiting if s.retry_at is not None and s.retry_at <= now]:
+                        waiting.discard(session)
+                        start(session)
+                    for session in [s for s in sessions if s.deadline <= now and s not in waiting]:
+                        try:
+                            session.on_timeout()
+                        except ConnectionException as e:
+                            if session.state == STATE_CONNECTING:
+                                retry(session, e)
+                            else:
+                                finish(session, e)
+                        except Exception as e:
+                            finish(session, e)
+
+        finally:
+            # 呼び出し側がループを途中で抜けた場合は残りを打ち切る
+            for session in list(sessions):
+                session.close()
+            selector.close()
+            if resolver is not None:
+                resolver.shutdown(wait=False, cancel_futures=True)
+
+
+def run_multiplexed(
+    devices: Iterable[dict],
+    commands: list[str],
+    concurrency: int = 256,
+    timeout: float = 30,
+    use_username: bool = True,
+    use_textfsm: bool = False,
+    read_timeout: float = 30,
+) -> Iterator[FleetResult]:
+    """Multiplexerで複数装置にコマンドを実行し、完了した装置から順に結果を返す(run_fleetの同期版)"""
+    return Multiplexer(
+        concurrency=concurrency,
+        timeout=timeout,
+        use_username=use_username,
+        use_textfsm=use_textfsm,
+        read_timeout=read_timeout,
+    ).run(devices, commands)
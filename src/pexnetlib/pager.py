@@ -0,0 +1,73 @@
+import re
+from functools import lru_cache, partial
+from typing import AnyStr, Generic, Optional, Pattern
+
+from pexnetlib.prompt import encode_pattern
+from pexnetlib.sanitizer import PAGER_PATTERN, SanitizeStep, strip_pager_remnants
+
+# ベンダごとのページャの表示。device_typeの"_"より前(cisco_telnetならcisco)で引く
+PAGER_PATTERNS = {
+    "cisco": r" ?--More-- ?",
+    "apresia": PAGER_PATTERN,
+    "juniper": r"---\(more(?: \d+%)?\)---",
+    "huawei": r" *-+ More -+ *",
+}
+# 表にないベンダで使うパターン
+DEFAULT_PAGER_PATTERN = PAGER_PATTERN
+# ページャを検出するために保持する最終行の長さの上限
+_LINE_LIMIT = 256
+
+
+def pager_pattern_for(device_type: str) -> str:
+    """device_typeに対応するページャのパターンを返す"""
+    vendor = device_type.split("_", 1)[0]
+    return PAGER_PATTERNS.get(vendor, DEFAULT_PAGER_PATTERN)
+
+
+@lru_cache(maxsize=64)
+def pager_regex(pattern: str) -> Pattern[str]:
+    """受信データの末尾でキー入力を待っているページャに一致する正規表現"""
+    return re.compile(rf"(?:{pattern})[^\S\r\n]*\Z")
+
+
+def pager_remnant_step(pattern: str) -> SanitizeStep:
+    """patternのページャの表示を取り除く整形処理(strip_pager_remnants)を返す"""
+    return partial(strip_pager_remnants, pattern=pattern)
+
+
+class PagerDetector(Generic[AnyStr]):
+    """受信中のデータからキー入力待ちのページャを検出する
+
+    ページャは装置がキー入力を待つため必ず受信データの末尾に現れる。
+    最終行(最後の改行より後ろ)だけを保持して照合するため、出力サイズによらずチャンクごとの処理は一定。
+    """
+
+    def __init__(self, pattern: Pattern[AnyStr]) -> None:
+        self.regex = pattern
+        self._empty = pattern.pattern[:0]
+        self._newline = b"\n" if isinstance(self._empty, bytes) else "\n"
+        self._line = self._empty
+        # 応答したページャの数
+        self.count = 0
+
+    def feed(self, chunk: AnyStr) -> bool:
+        """チャンクを追加し、末尾がページャになった場合Trueを返す(呼び出し側でキーを送信する)"""
+        newline = chunk.rfind(self._newline)
+        line = chunk[newline + 1:] if newline >= 0 else self._line + chunk
+        if not self.regex.search(line):
+            self._line = line[-_LINE_LIMIT:]
+            return False
+        # 応答済みのページャに再度一致しないよう最終行を捨てる
+        self._line = self._empty
+        self.count += 1
+        return True
+
+
+def pager_detector(pattern: Optional[str], binary: bool) -> Optional[PagerDetector]:
+    """ページャの処理が無効(patternがNone)の場合はNoneを返す"""
+    if pattern is None:
+        return None
+    regex = pager_regex(pattern)
+    if binary:
+        return PagerDetector(encode_pattern(regex))
+    return PagerDetector(regex)
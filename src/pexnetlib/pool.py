@@ -0,0 +1,430 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from pexnetlib.async_base_connection import AsyncBaseConnection
+from pexnetlib.base_connection import BaseConnection
+from pexnetlib.dispatcher import ConnectHandler, ConnectHandlerAsync
+from pexnetlib.log import log
+
+PoolKey = tuple[str, str, str, str, str]
+
+
+class _PooledSession:
+    """プール内の1セッション"""
+
+    def __init__(self, key: PoolKey, conn: Any) -> None:
+        self.key = key
+        self.conn = conn
+        now = time.monotonic()
+        self.last_used = now
+        self.last_checked = now
+
+
+class _BasePool:
+    """同期/非同期プール共通の管理処理。ロックは呼び出し側で取得する
+
+    max_per_device: 1台あたりに同時に張るセッション数の上限
+    max_idle: プール全体で保持する待機中セッション数の上限(超えた分は最も古いものから切断)
+    idle_ttl: 貸し出されないまま経過した場合に切断するまでの秒数
+    keepalive_interval: 待機中セッションの生存確認を行う間隔(秒)
+    health_check_after: 貸し出し時、この秒数以上確認していなければプロンプトを確認する
+    """
+
+    def __init__(
+        self,
+        max_per_device: int = 1,
+        max_idle: int = 64,
+        idle_ttl: float = 300,
+        keepalive_interval: float = 60,
+        health_check_after: float = 30,
+        check_timeout: float = 5,
+        timeout: int = 30,
+        use_username: bool = True,
+    ) -> None:
+        self.max_per_device = max_per_device
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
+        self.keepalive_interval = keepalive_interval
+        self.health_check_after = health_check_after
+        self.check_timeout = check_timeout
+        self.timeout = timeout
+        self.use_username = use_username
+        # 待機中セッション(古い順)と装置ごとの索引
+        self._idle: "OrderedDict[int, _PooledSession]" = OrderedDict()
+        self._idle_by_key: dict[PoolKey, list[_PooledSession]] = {}
+        # 装置ごとのセッション数(待機中 + 貸し出し中 + 接続中)
+        self._sessions: dict[PoolKey, int] = {}
+        self._closed = False
+
+    @staticmethod
+    def make_key(device_dict: dict) -> PoolKey:
+        return (
+            device_dict["ip"],
+            device_dict["device_type"],
+            device_dict.get("username", ""),
+            device_dict.get("password", ""),
+            device_dict.get("enable", ""),
+        )
+
+    def _take_idle(self, key: PoolKey) -> Optional[_PooledSession]:
+        entries = self._idle_by_key.get(key)
+        if not entries:
+            return None
+        # 直近に使ったセッションから貸し出す
+        entry = entries.pop()
+        if not entries:
+            del self._idle_by_key[key]
+        del self._idle[id(entry)]
+        return entry
+
+    def _put_idle(self, entry: _PooledSession) -> list[_PooledSession]:
+        """待機中に戻し、上限を超えて追い出したセッションを返却する"""
+        self._idle[id(entry)] = entry
+        self._idle_by_key.setdefault(entry.key, []).append(entry)
+        evicted = []
+        while len(self._idle) > self.max_idle:
+            _, oldest = self._idle.popitem(last=False)
+            self._idle_by_key[oldest.key].remove(oldest)
+            if not self._idle_by_key[oldest.key]:
+                del self._idle_by_key[oldest.key]
+            evicted.append(oldest)
+        return evicted
+
+    def _take_due(self, now: float) -> tuple[list[_PooledSession], list[_PooledSession]]:
+        """期限切れのセッションと生存確認が必要なセッションを待機中から取り出す"""
+        expired = []
+        due = []
+        for entry in list(self._idle.values()):
+            if now - entry.last_used >= self.idle_ttl:
+                expired.append(entry)
+            elif now - entry.last_checked >= self.keepalive_interval:
+                due.append(entry)
+            else:
+                continue
+            del self._idle[id(entry)]
+            self._idle_by_key[entry.key].remove(entry)
+            if not self._idle_by_key[entry.key]:
+                del self._idle_by_key[entry.key]
+        return expired, due
+
+    def _take_all_idle(self) -> list[_PooledSession]:
+        entries = list(self._idle.values())
+        self._idle.clear()
+        self._idle_by_key.clear()
+        return entries
+
+    def _forget(self, key: PoolKey) -> None:
+        self._sessions[key] -= 1
+        if not self._sessions[key]:
+            del self._sessions[key]
+
+    def _needs_check(self, entry: _PooledSession, now: float) -> bool:
+        return now - entry.last_checked >= self.health_check_after
+
+    def stats(self) -> dict[str, int]:
+        return {"idle": len(self._idle), "sessions": sum(self._sessions.values())}
+
+
+class SessionPool(_BasePool):
+    """ログイン済みの同期セッションを装置ごとに保持し、ジョブ間で再利用するプール
+
+        with SessionPool(idle_ttl=600) as pool:
+            with pool.lease(device_dict) as conn:
+                conn.send_command("show version")
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+        self._keepalive_thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def __enter__(self) -> "SessionPool":
+        self.start_keepalive()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _check(self, entry: _PooledSession) -> bool:
+        try:
+            healthy = entry.conn.check_prompt(entry.conn.prompt, read_timeout=self.check_timeout)
+        except Exception:
+            healthy = False
+        entry.last_checked = time.monotonic()
+        return healthy
+
+    def _discard(self, entry: _PooledSession) -> None:
+        try:
+            entry.conn.disconnect()
+        except Exception:
+            pass
+        with self._cond:
+            self._forget(entry.key)
+            self._cond.notify_all()
+
+    def acquire(self, device_dict: dict, wait_timeout: Optional[float] = None) -> _PooledSession:
+        key = self.make_key(device_dict)
+        deadline = None if wait_timeout is None else time.monotonic() + wait_timeout
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("SessionPool is closed")
+                    entry = self._take_idle(key)
+                    if entry is not None:
+                        break
+                    if self._sessions.get(key, 0) < self.max_per_device:
+                        self._sessions[key] = self._sessions.get(key, 0) + 1
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"no session available for {key[0]}")
+                    self._cond.wait(remaining)
+
+            if entry is None:
+                try:
+                    conn = ConnectHandler(device_dict, timeout=self.timeout, use_username=self.use_username)
+                except BaseException:
+                    with self._cond:
+                        self._forget(key)
+                        self._cond.notify_all()
+                    raise
+                return _PooledSession(key, conn)
+
+            if self._needs_check(entry, time.monotonic()) and not self._check(entry):
+                # 切断されていたセッションは捨てて取り直す
+                log.debug(f"{key[0]}: pooled session is not healthy, reconnecting")
+                self._discard(entry)
+                continue
+
+            return entry
+
+    def release(self, entry: _PooledSession, reuse: bool = True) -> None:
+        if not reuse or self._closed:
+            self._discard(entry)
+            return
+
+        entry.last_used = time.monotonic()
+        with self._cond:
+            evicted = self._put_idle(entry)
+            self._cond.notify_all()
+        for old in evicted:
+            self._discard(old)
+
+    @contextmanager
+    def lease(self, device_dict: dict, wait_timeout: Optional[float] = None) -> Iterator[BaseConnection]:
+        """セッションを借りる。例外で抜けた場合は状態が不明なためセッションを破棄する"""
+        entry = self.acquire(device_dict, wait_timeout=wait_timeout)
+        try:
+            yield entry.conn
+        except BaseException:
+            self.release(entry, reuse=False)
+            raise
+        self.release(entry)
+
+    def keepalive(self) -> None:
+        """期限切れセッションの切断と、待機中セッションの生存確認を行う"""
+        with self._cond:
+            expired, due = self._take_due(time.monotonic())
+        for entry in expired:
+            self._discard(entry)
+        for entry in due:
+            if self._check(entry):
+                with self._cond:
+                    evicted = self._put_idle(entry)
+                    self._cond.notify_all()
+                for old in evicted:
+                    self._discard(old)
+            else:
+                self._discard(entry)
+
+    def start_keepalive(self) -> None:
+        """バックグラウンドスレッドで定期的にkeepaliveを実行する"""
+        if self._keepalive_thread is not None:
+            return
+
+        def run() -> None:
+            while not self._stop.wait(min(self.keepalive_interval, self.idle_ttl)):
+                self.keepalive()
+
+        self._keepalive_thread = threading.Thread(target=run, name="pexnetlib-keepalive", daemon=True)
+        self._keepalive_thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._keepalive_thread is not None:
+            self._keepalive_thread.join()
+            self._keepalive_thread = None
+        with self._cond:
+            self._closed = True
+            entries = self._take_all_idle()
+        for entry in entries:
+            self._discard(entry)
+
+
+class AsyncSessionPool(_BasePool):
+    """ログイン済みの非同期セッションを装置ごとに保持し、ジョブ間で再利用するプール
+
+        async with AsyncSessionPool(idle_ttl=600) as pool:
+            async with pool.lease(device_dict) as conn:
+                await conn.send_command("show version")
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._cond: Optional[asyncio.Condition] = None
+        self._keepalive_task: Optional["asyncio.Task[None]"] = None
+
+    async def __aenter__(self) -> "AsyncSessionPool":
+        self.start_keepalive()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    @property
+    def cond(self) -> asyncio.Condition:
+        # イベントループ上で初めて使われた時点で生成する
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def _check(self, entry: _PooledSession) -> bool:
+        try:
+            healthy = await entry.conn.check_prompt(entry.conn.prompt, read_timeout=self.check_timeout)
+        except Exception:
+            healthy = False
+        entry.last_checked = time.monotonic()
+        return healthy
+
+    async def _discard(self, entry: _PooledSession) -> None:
+        try:
+            entry.conn.disconnect()
+        except Exception:
+            pass
+        async with self.cond:
+            self._forget(entry.key)
+            self.cond.notify_all()
+
+    async def acquire(self, device_dict: dict, wait_timeout: Optional[float] = None) -> _PooledSession:
+        key = self.make_key(device_dict)
+        loop = asyncio.get_running_loop()
+        deadline = None if wait_timeout is None else loop.time() + wait_timeout
+
+        async def wait_for_slot() -> Optional[_PooledSession]:
+            async with self.cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("AsyncSessionPool is closed")
+                    entry = self._take_idle(key)
+                    if entry is not None:
+                        return entry
+                    if self._sessions.get(key, 0) < self.max_per_device:
+                        self._sessions[key] = self._sessions.get(key, 0) + 1
+                        return None
+                    # タイムアウトは待機だけに掛ける。枠を確保した後に打ち切ると枠が返却されなくなるため
+                    remaining = None if deadline is None else deadline - loop.time()
+                    if remaining is not None and remaining <= 0:
+                        raise asyncio.TimeoutError(f"no session available for {key[0]}")
+                    try:
+                        await asyncio.wait_for(self.cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        # ロックを取り直した状態で戻るため、ループの先頭で空きを確認してから打ち切る
+                        pass
+
+        while True:
+            entry = await wait_for_slot()
+            if entry is None:
+                try:
+                    conn = await ConnectHandlerAsync(
+                        device_dict, timeout=self.timeout, use_username=self.use_username
+                    )
+                except BaseException:
+                    async with self.cond:
+                        self._forget(key)
+                        self.cond.notify_all()
+                    raise
+                return _PooledSession(key, conn)
+
+            if self._needs_check(entry, time.monotonic()) and not await self._check(entry):
+                # 切断されていたセッションは捨てて取り直す
+                log.debug(f"{key[0]}: pooled session is not healthy, reconnecting")
+                await self._discard(entry)
+                continue
+
+            return entry
+
+    async def release(self, entry: _PooledSession, reuse: bool = True) -> None:
+        if not reuse or self._closed:
+            await self._discard(entry)
+            return
+
+        entry.last_used = time.monotonic()
+        async with self.cond:
+            evicted = self._put_idle(entry)
+            self.cond.notify_all()
+        for old in evicted:
+            await self._discard(old)
+
+    @asynccontextmanager
+    async def lease(
+        self, device_dict: dict, wait_timeout: Optional[float] = None
+    ) -> AsyncIterator[AsyncBaseConnection]:
+        """セッションを借りる。例外で抜けた場合は状態が不明なためセッションを破棄する"""
+        entry = await self.acquire(device_dict, wait_timeout=wait_timeout)
+        try:
+            yield entry.conn
+        except BaseException:
+            await self.release(entry, reuse=False)
+            raise
+        await self.release(entry)
+
+    async def keepalive(self) -> None:
+        """期限切れセッションの切断と、待機中セッションの生存確認を行う"""
+        async with self.cond:
+            expired, due = self._take_due(time.monotonic())
+        for entry in expired:
+            await self._discard(entry)
+
+        async def check(entry: _PooledSession) -> None:
+            if await self._check(entry):
+                async with self.cond:
+                    evicted = self._put_idle(entry)
+                    self.cond.notify_all()
+                for old in evicted:
+                    await self._discard(old)
+            else:
+                await self._discard(entry)
+
+        await asyncio.gather(*(check(entry) for entry in due))
+
+    def start_keepalive(self) -> None:
+        """イベントループ上のタスクで定期的にkeepaliveを実行する"""
+        if self._keepalive_task is not None:
+            return
+
+        async def run() -> None:
+            while True:
+                await asyncio.sleep(min(self.keepalive_interval, self.idle_ttl))
+                try:
+                    await self.keepalive()
+                except Exception as e:
+                    log.debug(f"keepalive failed: {e}")
+
+        self._keepalive_task = asyncio.ensure_future(run())
+
+    async def close(self) -> None:
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            await asyncio.gather(self._keepalive_task, return_exceptions=True)
+            self._keepalive_task = None
+        async with self.cond:
+            self._closed = True
+            entries = self._take_all_idle()
+        for entry in entries:
+            await self._discard(entry)
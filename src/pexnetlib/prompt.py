@@ -0,0 +1,64 @@
+import re
+from functools import lru_cache
+from typing import Optional, Pattern
+
+# プロンプトから判定したモード
+MODE_USER = "user"
+MODE_ENABLE = "enable"
+MODE_CONFIG = "config"
+
+
+@lru_cache(maxsize=1024)
+def build_prompt_regex(
+    hostname: str, user_prompt: str = ">", enable_prompt: str = "#", echo: str = ""
+) -> Pattern[str]:
+    """ホスト名からユーザ/enable/configモードのプロンプトにまとめて一致する正規表現を作成する
+
+    "host>"、"host#"、"host(config)#"、"host(config-if)#" などに一致する。
+    コマンドの出力中の同じ文字列に一致しないよう、行頭かつ受信データの末尾にあるものに限定する。
+    echo: 連続送信で次のコマンドを送信済みの場合に指定する。
+          プロンプトの直後にそのコマンドのエコーバックが続く場合にも一致する
+    """
+    terminators = "|".join(re.escape(prompt) for prompt in dict.fromkeys((user_prompt, enable_prompt)))
+    follow = rf"(?:\Z|{re.escape(echo.strip())})" if echo.strip() else r"\Z"
+    return re.compile(
+        rf"(?m)^[^\S\r\n]*(?P<hostname>{re.escape(hostname)})"
+        rf"(?:\((?P<submode>[^)\r\n]*)\))?(?P<terminator>{terminators})(?=[^\S\r\n]*{follow})"
+    )
+
+
+@lru_cache(maxsize=1024)
+def encode_pattern(pattern: Pattern[str]) -> Pattern[bytes]:
+    """文字列の正規表現をバイト列用に変換する(pexpect版のexpectで使う)"""
+    return re.compile(pattern.pattern.encode(), pattern.flags & ~re.UNICODE)
+
+
+_SUBMODE_RE = re.compile(r"^(?P<hostname>.*?)(?:\((?P<submode>[^)]*)\))?$")
+
+
+def split_submode(text: str) -> tuple[str, str]:
+    """"host(config-if)" を ("host", "config-if") に分ける。括弧がなければsubmodeは空文字"""
+    match = _SUBMODE_RE.match(text)
+    assert match is not None
+    return match.group("hostname"), match.group("submode") or ""
+
+
+def prompt_mode(submode: Optional[str], terminator: str, enable_prompt: str = "#") -> str:
+    """プロンプトの括弧内の文字列と末尾の記号からモードを判定する
+
+    configモードの場合は括弧内の文字列("config"、"config-if"など)を返す。
+    """
+    if submode:
+        return submode
+    if terminator == enable_prompt:
+        return MODE_ENABLE
+    return MODE_USER
+
+
+def parse_prompt(regex: Pattern[str], text: str, enable_prompt: str = "#") -> Optional[tuple[str, str]]:
+    """受信したプロンプトから(モード, プロンプト文字列)を返す。一致しない場合はNone"""
+    match = regex.search(text)
+    if match is None:
+        return None
+    mode = prompt_mode(match.group("submode"), match.group("terminator"), enable_prompt)
+    return mode, match.group(0).strip()
@@ -0,0 +1,273 @@
+import codecs
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+from typing import Any, Optional, Union
+
+from pexpect.exceptions import EOF
+
+from pexnetlib.exception import ReplayMissException
+from pexnetlib.model import FleetResult
+
+# アーカイブの形式
+#   MAGIC | 出力データ(連結) | インデックス(JSON) | フッタ(インデックスの位置と長さ + FOOTER_MAGIC)
+# インデックスは {ip: {"device_type": ..., "hostname": ..., "commands": {command: [offset, length]}}}
+MAGIC = b"PXREPLAY1\n"
+FOOTER_MAGIC = b"PXRIDX1\n"
+_FOOTER = struct.Struct("<QQ8s")
+
+
+def _normalize(command: str) -> str:
+    return " ".join(command.split())
+
+
+class ReplayArchiveWriter:
+    """装置ごとのコマンド出力を再生用のアーカイブファイルに書き込む
+
+    同じ(装置, コマンド)を複数回追加した場合は後から追加した出力が有効になる。
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]) -> None:
+        self.path = os.fspath(path)
+        self._file = open(self.path, "wb")
+        self._file.write(MAGIC)
+        self._index: dict[str, dict[str, Any]] = {}
+
+    def __enter__(self) -> "ReplayArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def add(
+        self,
+        ip: str,
+        command: str,
+        output: Union[str, bytes],
+        device_type: str = "",
+        hostname: str = "",
+    ) -> None:
+        """整形済みの出力を1件追加する"""
+        data = output.encode() if isinstance(output, str) else output
+        entry = self._index.setdefault(ip, {"device_type": "", "hostname": "", "commands": {}})
+        if device_type:
+            entry["device_type"] = device_type
+        if hostname:
+            entry["hostname"] = hostname
+        entry["commands"][_normalize(command)] = [self._file.tell(), len(data)]
+        self._file.write(data)
+
+    def add_result(self, result: FleetResult, device_type: str = "", hostname: str = "") -> None:
+        """run_fleetの結果のうち、文字列の出力をすべて追加する"""
+        for command, output in result.outputs.items():
+            if isinstance(output, str):
+                self.add(result.ip, command, output, device_type=device_type, hostname=hostname)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        index = json.dumps(self._index, ensure_ascii=False).encode()
+        offset = self._file.tell()
+        self._file.write(index)
+        self._file.write(_FOOTER.pack(offset, len(index), FOOTER_MAGIC))
+        self._file.close()
+
+
+class ReplayArchive:
+    """ReplayArchiveWriterで作成したアーカイブをメモリマップして読み出す
+
+    出力はインデックスの(装置, コマンド)からバイト位置を引いてmmapから直接切り出す。
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]) -> None:
+        self.path = os.fspath(path)
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC or len(self._mmap) < len(MAGIC) + _FOOTER.size:
+            self._mmap.close()
+            raise ValueError(f"not a replay archive: {self.path}")
+        offset, length, footer = _FOOTER.unpack_from(self._mmap, len(self._mmap) - _FOOTER.size)
+        if footer != FOOTER_MAGIC:
+            self._mmap.close()
+            raise ValueError(f"replay archive is not closed: {self.path}")
+        self._index: dict[str, dict[str, Any]] = json.loads(self._mmap[offset:offset + length])
+
+    def __enter__(self) -> "ReplayArchive":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def devices(self) -> list[str]:
+        return list(self._index)
+
+    def commands(self, ip: str) -> list[str]:
+        return list(self._index.get(ip, {}).get("commands", {}))
+
+    def device_info(self, ip: str) -> dict[str, str]:
+        """記録時のdevice_typeとhostnameを返す"""
+        entry = self._index.get(ip, {})
+        return {"device_type": entry.get("device_type", ""), "hostname": entry.get("hostname", "")}
+
+    def get_bytes(self, ip: str, command: str) -> memoryview:
+        """出力をコピーせずにmmap上のビューとして返す"""
+        try:
+            offset, length = self._index[ip]["commands"][_normalize(command)]
+        except KeyError:
+            raise ReplayMissException(ip, command)
+        return memoryview(self._mmap)[offset:offset + length]
+
+    def get(self, ip: str, command: str) -> str:
+        with self.get_bytes(ip, command) as view:
+            return str(view, "utf-8", errors="ignore")
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+_archives: dict[str, ReplayArchive] = {}
+_archives_lock = threading.Lock()
+_default_archive: Optional[ReplayArchive] = None
+
+
+def open_archive(path: Union[str, os.PathLike]) -> ReplayArchive:
+    """アーカイブを開く。同じパスは1度だけmmapしてプロセス内で共有する"""
+    path = os.path.abspath(path)
+    with _archives_lock:
+        archive = _archives.get(path)
+        if archive is None:
+            archive = _archives[path] = ReplayArchive(path)
+        return archive
+
+
+def set_replay_archive(archive: Union[ReplayArchive, str, os.PathLike, None]) -> None:
+    """archiveを指定しなかった再生用接続が使うアーカイブを設定する
+
+    run_fleetやSessionPoolなど、接続クラスに引数を渡せない経路から使う場合に設定する。
+    """
+    global _default_archive
+    if archive is None or isinstance(archive, ReplayArchive):
+        _default_archive = archive
+    else:
+        _default_archive = open_archive(archive)
+
+
+def resolve_archive(archive: Union[ReplayArchive, str, os.PathLike, None]) -> ReplayArchive:
+    if archive is None:
+        if _default_archive is None:
+            raise ValueError("replay archive is not set. pass archive= or call set_replay_archive()")
+        return _default_archive
+    if isinstance(archive, ReplayArchive):
+        return archive
+    return open_archive(archive)
+
+
+class ReplayTransport:
+    """アーカイブの出力を装置の応答として返す擬似的な端末
+
+    送信された行に対して エコー + 記録済みの出力 + プロンプト を受信バッファに積む。
+    出力はmmap上のビューのまま保持し、読み出し時にsizeごとに切り出す。
+    """
+
+    def __init__(self, archive: ReplayArchive, ip: str, hostname: str, prompt_char: str = ">") -> None:
+        self.archive = archive
+        self.ip = ip
+        self.hostname = hostname
+        self.prompt_char = prompt_char
+        self._buffer: deque[memoryview] = deque()
+        self.closed = False
+
+    def send(self, line: str) -> None:
+        command = line.strip()
+        prompt = f"{self.hostname}{self.prompt_char}".encode()
+        if not command:
+            self._buffer.append(memoryview(b"\r\n" + prompt))
+            return
+
+        output = self.archive.get_bytes(self.ip, command)
+        self._buffer.append(memoryview(command.encode() + b"\r\n"))
+        if len(output):
+            self._buffer.append(output)
+        self._buffer.append(memoryview(b"\r\n" + prompt))
+
+    def read(self, size: int) -> bytes:
+        buffer = self._buffer
+        if not buffer:
+            return b""
+        head = buffer[0]
+        if len(head) <= size:
+            buffer.popleft()
+            return head.tobytes()
+        buffer[0] = head[size:]
+        return head[:size].tobytes()
+
+    def at_eof(self) -> bool:
+        return self.closed or not self._buffer
+
+    def close(self) -> None:
+        self.closed = True
+        self._buffer.clear()
+
+
+class ReplayChild:
+    """BaseConnectionのchild(pexpect.spawn)の代わりに使う再生用の端末"""
+
+    def __init__(self, transport: ReplayTransport) -> None:
+        self.transport = transport
+        self.logfile_read = None
+
+    def sendline(self, s: str = "") -> int:
+        self.transport.send(s)
+        return len(s) + 1
+
+    def read_nonblocking(self, size: int = 1, timeout: Optional[float] = -1) -> bytes:
+        data = self.transport.read(size)
+        if not data:
+            # 記録にない応答を待っても届くことはないため、タイムアウトを待たずに打ち切る
+            raise EOF("replay transport has no more data")
+        if self.logfile_read is not None:
+            self.logfile_read.write(data)
+            self.logfile_read.flush()
+        return data
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class ReplayReader:
+    """AsyncBaseConnectionのreaderの代わりに使う再生用のReader"""
+
+    def __init__(self, transport: ReplayTransport) -> None:
+        self.transport = transport
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+    async def read(self, n: int = -1) -> str:
+        return self._decoder.decode(self.transport.read(n if n > 0 else 1 << 30))
+
+    async def flush(self) -> None:
+        pass
+
+    def at_eof(self) -> bool:
+        return self.transport.at_eof()
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class ReplayWriter:
+    """AsyncBaseConnectionのwriterの代わりに使う再生用のWriter"""
+
+    def __init__(self, transport: ReplayTransport) -> None:
+        self.transport = transport
+
+    def write(self, data: str) -> None:
+        # send_commandsは複数行をまとめて書き込まないが、念のため行ごとに扱う
+        for line in data.splitlines():
+            self.transport.send(line)
+
+    def close(self) -> None:
+        self.transport.close()
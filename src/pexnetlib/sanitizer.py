@@ -0,0 +1,123 @@
+import re
+from functools import lru_cache
+from typing import Callable, Iterable, Optional, Pattern, Union
+
+SanitizeStep = Callable[[str], str]
+
+ANSI_ESCAPE = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+_BACKSPACE = re.compile(r"[^\x08\n]\x08")
+# 一般的なページャの表示("--More--"、"-- More --"、"--(more 50%)--"など)
+PAGER_PATTERN = r" *-+ ?\(?[Mm]ore(?: \d+%)?\)? ?-+ *"
+# キー入力後にページャの表示を消すための制御文字(バックスペース+空白、またはCR+空白)
+_PAGER_ERASE = r"(?:\x08+ *\x08*|\r +\r)?"
+_EXEC_TIMESTAMP = re.compile(
+    r"^(?:Load for five secs:.*|Time source is .*|No time source, .*)(?:\r?\n|$)", re.MULTILINE
+)
+
+
+def strip_backspaces(text: str) -> str:
+    """バックスペースとその直前の文字を取り除く"""
+    while "\x08" in text:
+        replaced = _BACKSPACE.sub("", text)
+        if replaced == text:
+            return text.replace("\x08", "")
+        text = replaced
+    return text
+
+
+@lru_cache(maxsize=64)
+def _pager_remnant(pattern: str) -> Pattern[str]:
+    return re.compile(rf"(?:{pattern}){_PAGER_ERASE}")
+
+
+def strip_pager_remnants(text: str, pattern: Optional[str] = None) -> str:
+    """ページャ(--More--)の表示と、それを消すための制御文字を取り除く
+
+    pattern: ページャの表示の正規表現。省略時はPAGER_PATTERN
+    """
+    if "ore" not in text:
+        return text
+    return _pager_remnant(pattern or PAGER_PATTERN).sub("", text)
+
+
+def strip_exec_timestamp(text: str) -> str:
+    """terminal exec prompt timestampで出力されるLoad for/Time sourceの行を取り除く"""
+    if "Load for" not in text and "ime source" not in text:
+        return text
+    return _EXEC_TIMESTAMP.sub("", text)
+
+
+class Sanitizer:
+    """コマンド出力の整形処理
+
+    ANSIエスケープの除去と装置ごとの追加処理(steps)を行った後、
+    先頭のエコーバック行と末尾のプロンプトだけを取り除く。
+    """
+
+    def __init__(self, ansi: bool = False, steps: Iterable[SanitizeStep] = ()) -> None:
+        self.ansi = ansi
+        self.steps = list(steps)
+
+    def add_step(self, step: SanitizeStep) -> None:
+        self.steps.append(step)
+
+    def clean(self, text: str) -> str:
+        """ANSIエスケープの除去と追加処理のみを行う"""
+        if self.ansi and "\x1b" in text:
+            text = ANSI_ESCAPE.sub("", text)
+        for step in self.steps:
+            text = step(text)
+        return text
+
+    def sanitize(
+        self, raw_data: str, command: str, pattern: Union[str, Pattern], echo: bool
+    ) -> str:
+        text = self.clean(raw_data)
+        if echo:
+            text = strip_echo(text, command)
+            text = strip_trailing_prompt(text, pattern)
+        return text.strip()
+
+
+def strip_echo(text: str, command: str) -> str:
+    """先頭のエコーバック行を取り除く。ローカルエコーと装置のエコーが重なった場合は2行まで"""
+    command = command.strip()
+    for _ in range(2):
+        newline = text.find("\n")
+        if newline < 0 or not text[:newline].strip().endswith(command):
+            break
+        text = text[newline + 1:]
+        if not command:
+            break
+    return text
+
+
+def strip_trailing_prompt(text: str, pattern: Union[str, Pattern]) -> str:
+    """末尾のプロンプトを取り除く。プロンプト行のホスト名部分(プロンプト前の文字列)は残す"""
+    if not pattern:
+        return text
+
+    head, newline, last = text.rpartition("\n")
+    index = _rfind(last, pattern)
+    if index < 0:
+        # プロンプトが最終行にない場合は全体から探す
+        head, newline = "", ""
+        last = text
+        index = _rfind(last, pattern)
+        if index < 0:
+            return text
+
+    prefix = last[:index]
+    # "!"だけが残る場合は旧実装と同様にプロンプトの一部として扱う
+    if not prefix.strip(" !\r"):
+        prefix = ""
+    return head + newline + prefix
+
+
+def _rfind(text: str, pattern: Union[str, Pattern]) -> int:
+    if isinstance(pattern, str):
+        return text.rfind(pattern)
+    index = -1
+    for match in pattern.finditer(text):
+        index = match.start()
+    return index
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import multiprocessing
+from dataclasses import asdict
+from queue import Empty
+from typing import Any, Iterable, Iterator, Optional
+
+from pexnetlib.dispatcher import ConnectHandler
+from pexnetlib.fleet import run_fleet
+from pexnetlib.model import FleetResult, check_commands, command_stage
+
+
+def pack_result(result: FleetResult) -> bytes:
+    """プロセス間転送用にFleetResultをJSON + zlibで圧縮する"""
+    return zlib.compress(
+        json.dumps(asdict(result), ensure_ascii=False, separators=(",", ":")).encode(), 1
+    )
+
+
+def unpack_result(data: bytes) -> FleetResult:
+    return FleetResult(**json.loads(zlib.decompress(data)))
+
+
+def _run_device_sync(
+    device_dict: dict,
+    commands: list[str],
+    timeout: int,
+    use_username: bool,
+    use_textfsm: bool,
+    read_timeout: int,
+) -> FleetResult:
+    result = FleetResult(
+        ip=device_dict.get("ip", ""), device_type=device_dict.get("device_type", "")
+    )
+    start = time.monotonic()
+    try:
+        # 同期版は接続・プロンプト取得・初期化をコンストラクタ内で行う
+        with ConnectHandler(device_dict, timeout=timeout, use_username=use_username) as conn:
+            result.timings["connect"] = time.monotonic() - start
+            for command in commands:
+                command_start = time.monotonic()
+                result.outputs[command] = conn.send_command(
+                    command, use_textfsm=use_textfsm, read_timeout=read_timeout
+                )
+                result.timings[command_stage(command)] = time.monotonic() - command_start
+
+    except Exception as e:
+        result.error = type(e).__name__
+        result.error_message = str(e)
+
+    result.timings["total"] = time.monotonic() - start
+    return result
+
+
+def _shard_worker(
+    shard_id: int,
+    shard: list[tuple[int, dict]],
+    commands: list[str],
+    queue: Any,
+    use_async: bool,
+    concurrency: int,
+    per_host_timeout: Optional[float],
+    kwargs: dict[str, Any],
+) -> None:
+    """ワーカープロセスの本体。1台終わるごとに (shard_id, index, 圧縮済み結果) を送る"""
+    if use_async:
+        async def consume() -> None:
+            # run_fleetは完了順に返すため、IPとの対応付けに元のインデックスを辿る
+            pending: dict[str, list[int]] = {}
+            for index, device_dict in shard:
+                pending.setdefault(device_dict.get("ip", ""), []).append(index)
+
+            async for result in run_fleet(
+                [device_dict for _, device_dict in shard],
+                commands,
+                concurrency=concurrency,
+                per_host_timeout=per_host_timeout,
+                **kwargs,
+            ):
+                queue.put((shard_id, pending[result.ip].pop(0), pack_result(result)))
+
+        # ワーカーごとに独立したイベントループを持つ
+        asyncio.run(consume())
+
+    else:
+        for index, device_dict in shard:
+            result = _run_device_sync(device_dict, commands, **kwargs)
+            queue.put((shard_id, index, pack_result(result)))
+
+    queue.put((shard_id, None, None))
+
+
+def _drain(queue: Any) -> list[tuple[int, Optional[int], Optional[bytes]]]:
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            return items
+
+
+def run_sharded(
+    devices: Iterable[dict],
+    commands: list[str],
+    processes: Optional[int] = None,
+    use_async: bool = False,
+    concurrency: int = 50,
+    per_host_timeout: Optional[float] = None,
+    timeout: int = 30,
+    use_username: bool = True,
+    use_textfsm: bool = False,
+    read_timeout: int = 30,
+) -> Iterator[FleetResult]:
+    """装置リストを複数プロセスに分割して実行し、完了した装置から順に結果を返す
+
+    use_async=Falseの場合は各プロセスで同期版コネクションを1台ずつ、
+    Trueの場合は各プロセスのイベントループでrun_fleetをconcurrency並列で実行する。
+    TextFSMの解析もワーカー側で行うため、CPUコア数分まで処理を分散できる。
+    per_host_timeoutはrun_fleetに渡すため、use_async=Trueの場合のみ指定できる(それ以外はValueError)。
+
+        for result in run_sharded(devices, ["show version"], processes=8, use_textfsm=True):
+            print(result.ip, result.ok)
+    """
+    if per_host_timeout is not None and not use_async:
+        # 同期版は1台ずつブロッキングで実行するため装置単位の打ち切りができない
+        raise ValueError("per_host_timeout requires use_async=True")
+    commands = check_commands(commands)
+    indexed = list(enumerate(devices))
+    if not indexed:
+        return
+
+    processes = max(1, min(processes or os.cpu_count() or 1, len(indexed)))
+    shards = [indexed[i::processes] for i in range(processes)]
+    kwargs = {
+        "timeout": timeout,
+        "use_username": use_username,
+        "use_textfsm": use_textfsm,
+        "read_timeout": read_timeout,
+    }
+
+    queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=_shard_worker,
+            args=(shard_id, shard, commands, queue, use_async, concurrency, per_host_timeout, kwargs),
+            daemon=True,
+        )
+        for shard_id, shard in enumerate(shards)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # ワーカーが異常終了した場合に未完了の装置を特定するため
+    outstanding = [{index for index, _ in shard} for shard in shards]
+    running = set(range(len(workers)))
+    try:
+        while running:
+            dead: list[int] = []
+            try:
+                items = [queue.get(timeout=1)]
+            except Empty:
+                dead = [shard_id for shard_id in running if not workers[shard_id].is_alive()]
+                if not dead:
+                    continue
+                # 終了の直前に送られた結果と完了通知を取りこぼさないよう、キューを読み切ってから判定する
+                items = _drain(queue)
+
+            for shard_id, index, data in items:
+                if index is None:
+                    running.discard(shard_id)
+                    continue
+                outstanding[shard_id].discard(index)
+                yield unpack_result(data)
+
+            for shard_id in dead:
+                if shard_id not in running:
+                    continue
+                # 完了通知なしに終了したワーカーの残りはエラーとして返す
+                running.discard(shard_id)
+                for index in sorted(outstanding[shard_id]):
+                    device_dict = indexed[index][1]
+                    yield FleetResult(
+                        ip=device_dict.get("ip", ""),
+                        device_type=device_dict.get("device_type", ""),
+                        error="WorkerCrashed",
+                        error_message=f"worker exited with code {workers[shard_id].exitcode}",
+                    )
+
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
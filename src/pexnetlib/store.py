@@ -0,0 +1,285 @@
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional, Union
+
+from pexnetlib.model import FleetResult
+from pexnetlib.table import ResultTable
+
+# ディレクトリ構成
+#   index.log       追記型のインデックス(1行1レコードのJSON)
+#   seg-000001.dat  出力本体を連結したセグメントファイル
+# セグメントにはブロブ(生の出力または解析結果のJSON)を内容のハッシュ単位で1度だけ書き込み、
+# index.logには {"blob": ハッシュ, "seg": 番号, "off": 位置, "len": 長さ} と
+# {"ip": ..., "command": ..., "ts": ..., "raw": ハッシュ, "parsed": ハッシュ} を書き込む順に追記する。
+INDEX_FILE = "index.log"
+SEGMENT_FORMAT = "seg-{:06d}.dat"
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@dataclass(frozen=True)
+class StoreEntry:
+    """ストアに記録した1回分のコマンド実行結果"""
+
+    ip: str
+    command: str
+    timestamp: float
+    device_type: str
+    raw: Optional[str]
+    parsed: Optional[str]
+
+
+def encode_parsed(parsed: Any) -> bytes:
+    """解析結果を列指向のJSONに変換する。dictのリストもキーが揃っていれば列に変換する"""
+    if isinstance(parsed, ResultTable):
+        body: Any = {"header": list(parsed.header), "columns": parsed.columns}
+    elif (
+        isinstance(parsed, list)
+        and parsed
+        and all(isinstance(row, dict) for row in parsed)
+        and all(row.keys() == parsed[0].keys() for row in parsed)
+    ):
+        header = list(parsed[0])
+        body = {"header": header, "columns": [[row[key] for row in parsed] for key in header]}
+    else:
+        body = {"value": parsed}
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def decode_parsed(data: Union[str, bytes, memoryview], compact: bool) -> Any:
+    """encode_parsedの逆変換。呼び出しごとに新しいオブジェクトを返す"""
+    body = json.loads(data if isinstance(data, str) else bytes(data))
+    if "value" in body:
+        return body["value"]
+    table = ResultTable(body["header"], body["columns"])
+    return table if compact else table.to_dicts()
+
+
+class ResultStore:
+    """コマンドの出力と解析結果をセグメントファイルに蓄積するストア
+
+    同じ内容の出力はハッシュで重複排除し、1度だけ書き込む。
+    読み出しはセグメントをmmapし、コピーせずにmemoryviewで返す。
+    インデックスは開いた時点でメモリに読み込み、装置・コマンド・時刻で検索する。
+    書き込みは1プロセスから行うこと(スレッド間ではロックで排他する)。
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, os.PathLike],
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+    ) -> None:
+        self.directory = os.fspath(directory)
+        self.segment_size = segment_size
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # ハッシュ -> (セグメント番号, 位置, 長さ)
+        self._blobs: dict[str, tuple[int, int, int]] = {}
+        # (ip, command) -> 時刻順のエントリ
+        self._entries: dict[tuple[str, str], list[StoreEntry]] = {}
+        # 二分探索用に_entriesと同じ順序で時刻だけを保持する
+        self._times: dict[tuple[str, str], list[float]] = {}
+        self._maps: dict[int, mmap.mmap] = {}
+        self._segment = 1
+        self._segment_file = None
+        self._load_index()
+        self._index_file = open(os.path.join(self.directory, INDEX_FILE), "a", encoding="utf-8")
+
+    def __enter__(self) -> "ResultStore":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def _load_index(self) -> None:
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で終了した最終行は無視する
+                    continue
+                if "blob" in record:
+                    self._blobs[record["blob"]] = (record["seg"], record["off"], record["len"])
+                    self._segment = max(self._segment, record["seg"])
+                else:
+                    self._add_entry(
+                        StoreEntry(
+                            record["ip"], record["command"], record["ts"],
+                            record.get("device_type", ""), record.get("raw"), record.get("parsed"),
+                        )
+                    )
+
+    def _add_entry(self, entry: StoreEntry) -> None:
+        key = (entry.ip, entry.command)
+        entries = self._entries.setdefault(key, [])
+        times = self._times.setdefault(key, [])
+        index = bisect.bisect_right(times, entry.timestamp)
+        entries.insert(index, entry)
+        times.insert(index, entry.timestamp)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, SEGMENT_FORMAT.format(segment))
+
+    def _write_blob(self, data: bytes) -> str:
+        digest = content_hash(data)
+        if digest in self._blobs:
+            return digest
+
+        if self._segment_file is None:
+            self._segment_file = open(self._segment_path(self._segment), "ab")
+        offset = self._segment_file.tell()
+        if offset and offset + len(data) > self.segment_size:
+            self._segment_file.close()
+            self._segment += 1
+            self._segment_file = open(self._segment_path(self._segment), "ab")
+            offset = 0
+        self._segment_file.write(data)
+        # インデックスより先に本体をファイルへ書き出しておく
+        self._segment_file.flush()
+        self._blobs[digest] = (self._segment, offset, len(data))
+        self._write_index({"blob": digest, "seg": self._segment, "off": offset, "len": len(data)})
+        return digest
+
+    def _write_index(self, record: dict[str, Any]) -> None:
+        self._index_file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def put(
+        self,
+        ip: str,
+        command: str,
+        raw: Optional[str] = None,
+        parsed: Any = None,
+        timestamp: Optional[float] = None,
+        device_type: str = "",
+    ) -> StoreEntry:
+        """出力(raw)と解析結果(parsed)を記録する。どちらか一方だけでもよい"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            raw_hash = None if raw is None else self._write_blob(raw.encode())
+            parsed_hash = None if parsed is None else self._write_blob(encode_parsed(parsed))
+            entry = StoreEntry(ip, command, timestamp, device_type, raw_hash, parsed_hash)
+            self._write_index(
+                {
+                    "ip": ip, "command": command, "ts": timestamp, "device_type": device_type,
+                    "raw": raw_hash, "parsed": parsed_hash,
+                }
+            )
+            self._index_file.flush()
+            self._add_entry(entry)
+        return entry
+
+    def put_result(self, result: FleetResult, timestamp: Optional[float] = None) -> list[StoreEntry]:
+        """run_fleetの結果を記録する。文字列の出力はraw、それ以外は解析結果として扱う"""
+        timestamp = time.time() if timestamp is None else timestamp
+        entries = []
+        for command, output in result.outputs.items():
+            if isinstance(output, str):
+                entry = self.put(result.ip, command, raw=output, timestamp=timestamp, device_type=result.device_type)
+            else:
+                entry = self.put(result.ip, command, parsed=output, timestamp=timestamp, device_type=result.device_type)
+            entries.append(entry)
+        return entries
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.flush()
+            self._index_file.flush()
+
+    def devices(self) -> list[str]:
+        return sorted({ip for ip, _ in self._entries})
+
+    def commands(self, ip: str) -> list[str]:
+        return sorted(command for entry_ip, command in self._entries if entry_ip == ip)
+
+    def history(self, ip: str, command: str) -> list[StoreEntry]:
+        """時刻順のエントリを返却する"""
+        return list(self._entries.get((ip, command), ()))
+
+    def latest(self, ip: str, command: str, at: Optional[float] = None) -> Optional[StoreEntry]:
+        """at時点(Noneの場合は最新)のエントリを返却する"""
+        entries = self._entries.get((ip, command))
+        if not entries:
+            return None
+        if at is None:
+            return entries[-1]
+        index = bisect.bisect_right(self._times[(ip, command)], at)
+        return entries[index - 1] if index else None
+
+    def query(
+        self,
+        ip: Optional[str] = None,
+        command: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> Iterator[StoreEntry]:
+        """条件に一致するエントリを(ip, command)ごとに時刻順で返す"""
+        for (entry_ip, entry_command), entries in self._entries.items():
+            if ip is not None and entry_ip != ip:
+                continue
+            if command is not None and entry_command != command:
+                continue
+            times = self._times[(entry_ip, entry_command)]
+            start = 0 if since is None else bisect.bisect_left(times, since)
+            end = len(entries) if until is None else bisect.bisect_right(times, until)
+            yield from entries[start:end]
+
+    def read_blob(self, digest: str) -> memoryview:
+        """ブロブをmmap上のビューとして返す(コピーしない)"""
+        segment, offset, length = self._blobs[digest]
+        if not length:
+            return memoryview(b"")
+        buffer = self._maps.get(segment)
+        if buffer is None or len(buffer) < offset + length:
+            with self._lock:
+                # 書き込み中のセグメントは伸びているためマップし直す
+                if self._segment_file is not None and segment == self._segment:
+                    self._segment_file.flush()
+                with open(self._segment_path(segment), "rb") as f:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # 古いマップはビューが残っている可能性があるため閉じずに参照を外すだけにする
+                self._maps[segment] = buffer
+        return memoryview(buffer)[offset:offset + length]
+
+    def get_raw_bytes(self, entry: StoreEntry) -> Optional[memoryview]:
+        return None if entry.raw is None else self.read_blob(entry.raw)
+
+    def get_raw(self, entry: StoreEntry) -> Optional[str]:
+        view = self.get_raw_bytes(entry)
+        return None if view is None else str(view, "utf-8", errors="ignore")
+
+    def get_parsed(self, entry: StoreEntry, compact: bool = False) -> Any:
+        """解析結果を返却する。compact=Trueの場合は表形式の結果をResultTableで返す"""
+        if entry.parsed is None:
+            return None
+        return decode_parsed(self.read_blob(entry.parsed), compact)
+
+    def stats(self) -> dict[str, int]:
+        """エントリ数、ブロブ数(重複排除後)、ブロブの合計バイト数"""
+        return {
+            "entries": sum(len(entries) for entries in self._entries.values()),
+            "blobs": len(self._blobs),
+            "bytes": sum(length for _, _, length in self._blobs.values()),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+                self._segment_file = None
+            if not self._index_file.closed:
+                self._index_file.close()
+            self._maps.clear()
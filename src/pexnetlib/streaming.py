@@ -0,0 +1,119 @@
+from typing import Optional, Pattern, Union
+
+from pexnetlib.matcher import StreamMatcher
+from pexnetlib.sanitizer import Sanitizer
+
+
+class OutputStream:
+    """受信中のコマンド出力を行単位に切り出す
+
+    出力全体は保持せず、未完成の最終行だけをバッファする。
+    先頭のエコーバック行と末尾のプロンプトは送り出さない。
+    chunk_sizeを指定した場合は行をまとめ、おおよそchunk_size文字ごとに返却する。
+    """
+
+    def __init__(
+        self,
+        command: str,
+        pattern: Union[str, Pattern[str]],
+        reg: bool = False,
+        sanitizer: Optional[Sanitizer] = None,
+        chunk_size: Optional[int] = None,
+    ) -> None:
+        self.command = command.strip()
+        self.matcher = StreamMatcher(pattern, reg=reg, collect=False)
+        self.sanitizer = sanitizer
+        self.chunk_size = chunk_size
+        self.done = False
+        # プロンプトより後ろに受信していたデータ
+        self.remainder = ""
+        self._buffer = ""
+        # self._bufferの先頭が受信データ全体の何文字目にあたるか
+        self._offset = 0
+        self._echo_lines = 2
+        self._started = False
+        self._blank_lines = 0
+        self._batch: list[str] = []
+        self._batch_size = 0
+
+    @property
+    def partial_line(self) -> str:
+        """受信済みで未完成の最終行(タイムアウト時の情報用)"""
+        return self._buffer
+
+    def feed(self, text: str) -> list[str]:
+        """受信データを追加し、送り出せるようになった行(またはチャンク)を返却する"""
+        if self.done:
+            self.remainder += text
+            return []
+
+        data = self._buffer + text
+        if self.matcher.feed(text):
+            self.done = True
+            start = max(0, self.matcher.start - self._offset)
+            self.remainder = data[self.matcher.end - self._offset:]
+            body = data[:start]
+            newline = body.rfind("\n")
+            complete, last = body[:newline + 1], body[newline + 1:]
+            lines = self._lines(complete)
+            # プロンプト行の前に残った文字列("!"など以外)は出力の一部として扱う
+            if last.strip(" !\r"):
+                lines.extend(self._lines(last + "\n"))
+            return self._emit(lines, final=True)
+
+        newline = data.rfind("\n")
+        if newline < 0:
+            self._buffer = data
+            return []
+
+        self._buffer = data[newline + 1:]
+        self._offset += newline + 1
+        return self._emit(self._lines(data[:newline + 1]), final=False)
+
+    def _lines(self, block: str) -> list[str]:
+        if not block:
+            return []
+        if self.sanitizer is not None:
+            block = self.sanitizer.clean(block)
+
+        lines = []
+        for line in block.split("\n")[:-1]:
+            line = line.rstrip("\r")
+            if self._echo_lines and not self._started:
+                # 先頭のエコーバック行(ローカルエコーとの重複を含め2行まで)を読み捨てる
+                self._echo_lines -= 1
+                if line.strip().endswith(self.command):
+                    if not self.command:
+                        self._echo_lines = 0
+                    continue
+                self._echo_lines = 0
+
+            # 前後の空行はsend_commandのstrip()と同様に送り出さない
+            if not line.strip():
+                if self._started:
+                    self._blank_lines += 1
+                continue
+            if self._blank_lines:
+                lines.extend([""] * self._blank_lines)
+                self._blank_lines = 0
+            self._started = True
+            lines.append(line)
+        return lines
+
+    def _emit(self, lines: list[str], final: bool) -> list[str]:
+        if self.chunk_size is None:
+            return lines
+
+        chunks = []
+        for line in lines:
+            self._batch.append(line)
+            self._batch_size += len(line) + 1
+            if self._batch_size >= self.chunk_size:
+                chunks.append("\n".join(self._batch) + "\n")
+                self._batch = []
+                self._batch_size = 0
+        if final and self._batch:
+            chunks.append("\n".join(self._batch) + "\n")
+            self._batch = []
+            self._batch_size = 0
+        return chunks
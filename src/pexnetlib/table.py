@@ -0,0 +1,104 @@
+import csv
+import io
+from typing import IO, Any, Iterable, Iterator, Optional, Sequence, Union, overload
+
+
+class ResultTable:
+    """TextFSMの解析結果を列ごとのリストで保持する軽量な表
+
+    ヘッダは1つのタプルを全行で共有し、行ごとのdictを作らないため
+    大量の行(MACアドレステーブルなど)でもメモリ使用量が小さい。
+    dictが必要な場合はイテレーションやインデックスアクセスの時点で1行ずつ作成する。
+    """
+
+    __slots__ = ("header", "columns")
+
+    def __init__(self, header: Sequence[str], columns: Sequence[list[Any]]) -> None:
+        if len(header) != len(columns):
+            raise ValueError("header and columns must have the same length")
+        self.header = tuple(header)
+        self.columns = [column if isinstance(column, list) else list(column) for column in columns]
+
+    @classmethod
+    def from_rows(cls, header: Sequence[str], rows: Iterable[Sequence[Any]]) -> "ResultTable":
+        """行のリストから作成する"""
+        rows = list(rows)
+        if not rows:
+            return cls(header, [[] for _ in header])
+        return cls(header, [list(column) for column in zip(*rows)])
+
+    def __len__(self) -> int:
+        return len(self.columns[0]) if self.columns else 0
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        header = self.header
+        for row in zip(*self.columns):
+            yield dict(zip(header, row))
+
+    @overload
+    def __getitem__(self, key: int) -> dict[str, Any]: ...
+
+    @overload
+    def __getitem__(self, key: slice) -> "ResultTable": ...
+
+    @overload
+    def __getitem__(self, key: str) -> list[Any]: ...
+
+    def __getitem__(self, key: Union[int, slice, str]) -> Any:
+        if isinstance(key, str):
+            return self.columns[self.header.index(key)]
+        if isinstance(key, slice):
+            return ResultTable(self.header, [column[key] for column in self.columns])
+        return dict(zip(self.header, (column[key] for column in self.columns)))
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, ResultTable):
+            return self.header == other.header and self.columns == other.columns
+        if isinstance(other, list):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"ResultTable(header={self.header!r}, rows={len(self)})"
+
+    def __getstate__(self) -> tuple[tuple[str, ...], list[list[Any]]]:
+        return self.header, self.columns
+
+    def __setstate__(self, state: tuple[tuple[str, ...], list[list[Any]]]) -> None:
+        self.header, self.columns = state
+
+    def rows(self) -> Iterator[tuple[Any, ...]]:
+        """行をタプルで返却する"""
+        return zip(*self.columns)
+
+    def to_dicts(self) -> list[dict[str, Any]]:
+        """従来のget_structured_data_textfsmと同じ形式(dictのリスト)に変換する"""
+        return list(self)
+
+    def to_columns(self) -> dict[str, list[Any]]:
+        """列名をキーとした列のdictを返却する(pyarrow.table/pandas.DataFrameにそのまま渡せる)"""
+        return dict(zip(self.header, self.columns))
+
+    def to_csv(self, file: Optional[IO[str]] = None) -> Optional[str]:
+        """CSVに出力する。fileを省略した場合は文字列で返却する
+
+        Listの値はCSVのセル内で空白区切りにする。
+        """
+        output = file if file is not None else io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(self.header)
+        writer.writerows(
+            [" ".join(value) if isinstance(value, list) else value for value in row]
+            for row in self.rows()
+        )
+        if file is None:
+            return output.getvalue()
+        return None
+
+    def to_arrow(self) -> Any:
+        """pyarrow.Tableに変換する(pyarrowが必要)"""
+        try:
+            import pyarrow
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError("to_arrow() requires pyarrow. `pip install pyarrow`")
+        return pyarrow.table(self.to_columns())
@@ -0,0 +1,237 @@
+import select
+import socket
+from typing import Any, Optional, Union
+
+from pexpect.exceptions import EOF, TIMEOUT
+
+# BaseConnectionのtransportに指定できる値
+TRANSPORT_SPAWN = "spawn"
+TRANSPORT_SOCKET = "socket"
+
+# Telnetのコマンド(RFC 854)
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+
+# オプション
+ECHO = 1
+SGA = 3
+
+# 受け入れるオプション。装置側のECHOとSuppress Go Aheadだけを有効にし、それ以外は断る
+_ACCEPT_WILL = frozenset((ECHO, SGA))
+_ACCEPT_DO = frozenset((SGA,))
+
+_IAC_BYTE = bytes([IAC])
+
+_STATE_DATA = 0
+_STATE_IAC = 1
+_STATE_OPTION = 2
+_STATE_SB = 3
+_STATE_SB_IAC = 4
+
+
+class TelnetSocket:
+    """外部のtelnetコマンドを起動せず、ソケット上で直接Telnetを話すトランスポート
+
+    BaseConnectionが使うpexpect.spawnのメソッド(sendline/read_nonblocking/close/logfile_read)と
+    同じ形で使える。受信データからIACシーケンスを取り除き、オプションのネゴシエーションに応答する。
+    プロセスもptyも作らないため、接続の確立が速くセッションあたりのメモリも小さい。
+    nonblocking=Trueの場合は送信データをバッファに溜め、書き込み可能になった時点でflush()で送る
+    (Multiplexerのように1スレッドで多数のセッションを扱う場合に、1台の送信待ちで全体を止めないため)。
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 23,
+        timeout: Optional[float] = 30,
+        connect_timeout: Optional[float] = None,
+        recv_size: int = 65536,
+        sock: Optional[socket.socket] = None,
+        nonblocking: bool = False,
+    ) -> None:
+        self.timeout = timeout
+        self.recv_size = recv_size
+        # 接続済みのソケット(Multiplexerでノンブロッキング接続したものなど)を渡すこともできる
+        if sock is None:
+            sock = socket.create_connection(
+                (host, port), timeout=connect_timeout if connect_timeout is not None else timeout
+            )
+        self.sock = sock
+        self.nonblocking = nonblocking
+        if nonblocking:
+            self.sock.setblocking(False)
+        else:
+            # 読み込みはselectで待つ。送信は装置が受信しない場合に止まり続けないようtimeoutを掛ける
+            self.sock.settimeout(timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.logfile_read: Any = None
+        self.closed = False
+        self.eof = False
+        self._buffer = bytearray()
+        # nonblocking=Trueの場合の未送信データ
+        self._outgoing = bytearray()
+        self._state = _STATE_DATA
+        self._command = 0
+        # オプションごとに最後に送った応答。同じ応答を繰り返してループしないようにする
+        self._replies: dict[tuple[bool, int], int] = {}
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send(self, s: Union[str, bytes]) -> int:
+        data = s.encode() if isinstance(s, str) else s
+        if IAC in data:
+            data = data.replace(_IAC_BYTE, _IAC_BYTE * 2)
+        self._write(data)
+        return len(data)
+
+    def _write(self, data: bytes) -> None:
+        if not self.nonblocking:
+            self.sock.sendall(data)
+            return
+        self._outgoing += data
+        self.flush()
+
+    @property
+    def has_pending_output(self) -> bool:
+        """nonblocking=Trueの場合に未送信のデータが残っているか"""
+        return bool(self._outgoing)
+
+    def flush(self) -> None:
+        """未送信のデータをソケットが受け付ける分だけ送信する"""
+        while self._outgoing:
+            try:
+                sent = self.sock.send(self._outgoing)
+            except (BlockingIOError, InterruptedError):
+                return
+            del self._outgoing[:sent]
+
+    def sendline(self, s: Union[str, bytes] = "") -> int:
+        data = s.encode() if isinstance(s, str) else s
+        # crlf=Trueの場合は呼び出し側で改行済み
+        if not data.endswith(b"\r\n"):
+            data += b"\r\n"
+        return self.send(data)
+
+    def read_nonblocking(self, size: int = 1, timeout: Optional[float] = -1) -> bytes:
+        """受信済みのデータを最大sizeバイト返す。timeout秒待っても届かなければTIMEOUTを送出する"""
+        if self._buffer:
+            return self._take(size)
+        if self.eof:
+            raise EOF("End Of File (EOF).")
+        if timeout == -1:
+            timeout = self.timeout
+
+        while True:
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if not readable:
+                raise TIMEOUT("Timeout exceeded.")
+            payload = self.receive()
+            if payload:
+                self._buffer += payload
+                return self._take(size)
+            # ネゴシエーションだけのパケットだった場合は待ち直す
+
+    def receive(self) -> bytes:
+        """ソケットから1回だけ読み込み、IACを取り除いたデータを返す
+
+        読み込み可能になったソケットに対して呼ぶこと。切断された場合はEOFを送出する。
+        """
+        try:
+            data = self.sock.recv(self.recv_size)
+        except (BlockingIOError, InterruptedError):
+            return b""
+        if not data:
+            self.eof = True
+            raise EOF("End Of File (EOF).")
+        return self.feed(data)
+
+    def _take(self, size: int) -> bytes:
+        if len(self._buffer) <= size:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        if self.logfile_read is not None:
+            self.logfile_read.write(data)
+            self.logfile_read.flush()
+        return data
+
+    def feed(self, data: bytes) -> bytes:
+        """受信データからIACシーケンスを取り除き、必要な応答を送信する"""
+        if self._state == _STATE_DATA and IAC not in data:
+            return data.replace(b"\r\x00", b"\r") if b"\r\x00" in data else data
+
+        out = bytearray()
+        i = 0
+        length = len(data)
+        state = self._state
+        while i < length:
+            if state == _STATE_DATA:
+                j = data.find(_IAC_BYTE, i)
+                if j < 0:
+                    out += data[i:]
+                    break
+                out += data[i:j]
+                state = _STATE_IAC
+                i = j + 1
+                continue
+
+            byte = data[i]
+            i += 1
+            if state == _STATE_IAC:
+                if byte == IAC:
+                    out.append(IAC)
+                    state = _STATE_DATA
+                elif byte in (WILL, WONT, DO, DONT):
+                    self._command = byte
+                    state = _STATE_OPTION
+                elif byte == SB:
+                    state = _STATE_SB
+                else:
+                    # NOP/GAなどは読み捨てる
+                    state = _STATE_DATA
+            elif state == _STATE_OPTION:
+                self._negotiate(self._command, byte)
+                state = _STATE_DATA
+            elif state == _STATE_SB:
+                if byte == IAC:
+                    state = _STATE_SB_IAC
+            elif state == _STATE_SB_IAC:
+                state = _STATE_DATA if byte == SE else _STATE_SB
+
+        self._state = state
+        if b"\r\x00" in out:
+            return bytes(out).replace(b"\r\x00", b"\r")
+        return bytes(out)
+
+    def _negotiate(self, command: int, option: int) -> None:
+        if command == WILL:
+            reply = DO if option in _ACCEPT_WILL else DONT
+        elif command == DO:
+            reply = WILL if option in _ACCEPT_DO else WONT
+        elif command == WONT:
+            reply = DONT
+        else:
+            reply = WONT
+
+        # 受信側(WILL/WONT)と送信側(DO/DONT)の状態を分けて管理する
+        key = (command in (WILL, WONT), option)
+        if self._replies.get(key) == reply:
+            return
+        self._replies[key] = reply
+        self._write(bytes([IAC, reply, option]))
+
+    def isalive(self) -> bool:
+        return not (self.closed or self.eof)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
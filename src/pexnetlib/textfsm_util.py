@@ -1,8 +1,203 @@
+import io
 import os
-from textfsm import clitable
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from textfsm import TextFSM, clitable
 from textfsm.clitable import CliTableError
-from pathlib import Path
-from typing import Any, Callable, Optional, Union
+from pexnetlib.table import ResultTable
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Iterable, Iterator, Optional, Union
+
+
+class CompiledTemplate:
+    """コンパイル済みのTextFSMテンプレート"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path) as template_file:
+            self.source = template_file.read()
+        self.fsm = TextFSM(io.StringIO(self.source))
+        # ヘッダの小文字化は1テンプレートにつき1回だけ行う
+        self.header = tuple(name.lower() for name in self.fsm.header)
+        self._lock = threading.Lock()
+
+    def parse(self, raw_output: str) -> list[list[Any]]:
+        """テキストを解析してレコードのリストを返却する"""
+        # TextFSMは解析中の状態を持つため同時に1スレッドだけが使う
+        with self._lock:
+            self.fsm.Reset()
+            return self.fsm.ParseText(raw_output)
+
+    def parse_to_dicts(self, raw_output: str) -> list[dict[str, Any]]:
+        header = self.header
+        return [dict(zip(header, row)) for row in self.parse(raw_output)]
+
+    def parse_to_table(self, raw_output: str) -> ResultTable:
+        rows = self.parse(raw_output)
+        table = ResultTable.from_rows(self.header, rows)
+        # 行のリストはTextFSM側に次の解析まで残るため、列に変換した後は解放する
+        del rows[:]
+        return table
+
+    def new_fsm(self) -> TextFSM:
+        """状態を共有しないTextFSMを作成する(逐次解析用)"""
+        return TextFSM(io.StringIO(self.source))
+
+
+class TextFSMStreamParser:
+    """1行ずつ与えた出力を逐次解析し、Recordが実行されるたびにレコードを返却する
+
+    出力全体とレコード全体を同時に保持しないため、大きな出力でもメモリ使用量が一定になる。
+    Fillupを使うテンプレートは確定済みのレコードを後から書き換えるため、
+    レコードをclose()まで保持してまとめて返却する。
+    """
+
+    def __init__(self, template: CompiledTemplate) -> None:
+        self.fsm = template.new_fsm()
+        self.header = template.header
+        self.count = 0
+        self._hold = bool(self.fsm.GetValuesByAttrib("Fillup"))
+        self._closed = False
+
+    @property
+    def finished(self) -> bool:
+        """テンプレートがEnd/EOF状態に遷移した、またはclose()済みの場合True"""
+        # TextFSMは終了状態に遷移しても_cur_stateを更新しないため状態名で判定する
+        return self._closed or self.fsm._cur_state_name in ("End", "EOF")
+
+    def feed(self, line: str) -> list[dict[str, Any]]:
+        """1行を解析し、新たに確定したレコードを返却する"""
+        if self.finished:
+            return []
+        rows = self.fsm.ParseText(line + "\n", eof=False)
+        if self._hold:
+            return []
+        return self._take(rows)
+
+    def close(self) -> list[dict[str, Any]]:
+        """入力の終端を通知し、残りのレコードを返却する"""
+        if self._closed:
+            return []
+        if self.fsm._cur_state_name == "End":
+            rows = self.fsm._result
+        else:
+            # EOF状態の暗黙のRecordを実行させる
+            rows = self.fsm.ParseText("", eof=True)
+        self._closed = True
+        return self._take(rows)
+
+    def _take(self, rows: list[list[Any]]) -> list[dict[str, Any]]:
+        if not rows:
+            return []
+        header = self.header
+        records = [dict(zip(header, row)) for row in rows]
+        # 返却済みのレコードはTextFSM側に残さない
+        del rows[:]
+        self.count += len(records)
+        return records
+
+    def parse_iter(self, lines: Iterable[str]) -> Iterator[dict[str, Any]]:
+        # 終了状態に遷移した後も、送り元(受信処理)を最後まで進めるため行は読み捨てる
+        for line in lines:
+            yield from self.feed(line)
+        yield from self.close()
+
+
+class TemplateRegistry:
+    """TextFSMのindexとテンプレートのプロセス共通キャッシュ
+
+    indexは最初の利用時に一度だけ読み込み、テンプレートは初回利用時にコンパイルして
+    LRUで保持する。NET_TEXTFSMが変更された場合は自動的にキャッシュを破棄する。
+    """
+
+    def __init__(self, maxsize: int = 256, lookup_maxsize: int = 4096) -> None:
+        self.maxsize = maxsize
+        self.lookup_maxsize = lookup_maxsize
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self) -> None:
+        """キャッシュを破棄する"""
+        with self._lock:
+            self._env = os.environ.get("NET_TEXTFSM")
+            self._template_dir: Optional[str] = None
+            self._cli_table: Optional[clitable.CliTable] = None
+            self._lookup: "OrderedDict[tuple[str, str], Optional[list[str]]]" = OrderedDict()
+            self._templates: "OrderedDict[str, CompiledTemplate]" = OrderedDict()
+
+    def _check_env(self) -> None:
+        if os.environ.get("NET_TEXTFSM") != self._env:
+            self.clear()
+
+    @property
+    def template_dir(self) -> str:
+        with self._lock:
+            self._check_env()
+            if self._template_dir is None:
+                self._template_dir = get_template_dir()
+            return self._template_dir
+
+    @property
+    def cli_table(self) -> clitable.CliTable:
+        """indexを読み込み済みのCliTable"""
+        with self._lock:
+            template_dir = self.template_dir
+            if self._cli_table is None:
+                self._cli_table = clitable.CliTable(
+                    os.path.join(template_dir, "index"), template_dir
+                )
+            return self._cli_table
+
+    def lookup(self, platform: str, command: str) -> Optional[list[str]]:
+        """indexから(platform, command)に該当するテンプレートのパスを返却する"""
+        key = (platform, command)
+        with self._lock:
+            self._check_env()
+            if key in self._lookup:
+                self._lookup.move_to_end(key)
+                return self._lookup[key]
+
+            cli_table = self.cli_table
+            row_idx = cli_table.index.GetRowMatch({"Command": command, "Platform": platform})
+            if row_idx:
+                templates = cli_table.index.index[row_idx]["Template"]
+                paths: Optional[list[str]] = [
+                    os.path.join(cli_table.template_dir, name)
+                    for name in templates.split(":")
+                ]
+            else:
+                paths = None
+
+            self._lookup[key] = paths
+            if len(self._lookup) > self.lookup_maxsize:
+                self._lookup.popitem(last=False)
+            return paths
+
+    def get_template(self, path: str) -> CompiledTemplate:
+        """テンプレートファイルのパスからコンパイル済みテンプレートを返却する"""
+        path = os.path.abspath(os.path.expanduser(path))
+        with self._lock:
+            self._check_env()
+            template = self._templates.get(path)
+            if template is not None:
+                self._templates.move_to_end(path)
+                return template
+
+            template = CompiledTemplate(path)
+            self._templates[path] = template
+            if len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+            return template
+
+
+# プロセス全体で共有するテンプレートキャッシュ
+template_registry = TemplateRegistry()
+
+
+def clear_template_cache() -> None:
+    """テンプレートのキャッシュを破棄する。テンプレートを差し替えた場合などに呼び出す"""
+    template_registry.clear()
 
 
 def structured_data_converter(
@@ -26,7 +221,12 @@ def get_structured_data_textfsm(
     platform: Optional[str] = None,
     command: Optional[str] = None,
     template: Optional[str] = None,
-) -> Union[str, list[dict[str, str]]]:
+    compact: bool = False,
+) -> Union[str, list[dict[str, str]], ResultTable]:
+    """TextFSMで出力を解析する。解析できない場合は出力をそのまま返却する
+
+    compact=Trueの場合はdictのリストの代わりに列指向のResultTableを返却する。
+    """
     if platform is None or command is None:
         attrs = {}
     else:
@@ -38,27 +238,226 @@ def get_structured_data_textfsm(
                 "Either 'platform/command' or 'template' must be specified."
             )
 
-        template_dir = get_template_dir()
-        index_file = os.path.join(template_dir, "index")
-        textfsm_obj = clitable.CliTable(index_file, template_dir)
-        output = _textfsm_parse(textfsm_obj, raw_output, attrs)
+        output = _registry_parse(raw_output, attrs, compact)
 
         if platform and "cisco_xe" in platform:
-            if not isinstance(output, list):
+            if isinstance(output, str):
                 attrs["Platform"] = "cisco_ios"
-                output = _textfsm_parse(textfsm_obj, raw_output, attrs)
+                output = _registry_parse(raw_output, attrs, compact)
 
         return output
 
     else:
-        template_path = Path(os.path.expanduser(template))
-        template_file = template_path.name
-        template_dir_alt = template_path.parents[0]
-        textfsm_obj = clitable.CliTable(template_dir=template_dir_alt)
+        try:
+            compiled = template_registry.get_template(template)
+        except FileNotFoundError:
+            return raw_output
+
+        return _compiled_parse(compiled, raw_output, compact)
+
+
+def _compiled_parse(
+    compiled: CompiledTemplate, raw_output: str, compact: bool
+) -> Union[str, list[dict[str, str]], ResultTable]:
+    if compact:
+        return compiled.parse_to_table(raw_output) or raw_output
+    return compiled.parse_to_dicts(raw_output) or raw_output
 
-        return _textfsm_parse(
-            textfsm_obj, raw_output, attrs, template_file=template_file
+
+def _registry_parse(
+    raw_output: str, attrs: dict[str, str], compact: bool = False
+) -> Union[str, list[dict[str, str]], ResultTable]:
+    paths = template_registry.lookup(attrs["Platform"], attrs["Command"])
+    if paths is None:
+        return raw_output
+
+    if len(paths) > 1:
+        # 複数テンプレートの結合はCliTableに任せる(indexはtextfsm側でキャッシュされる)
+        template_dir = template_registry.template_dir
+        textfsm_obj = clitable.CliTable(os.path.join(template_dir, "index"), template_dir)
+        return _textfsm_parse(textfsm_obj, raw_output, attrs, compact=compact)
+
+    try:
+        compiled = template_registry.get_template(paths[0])
+    except FileNotFoundError:
+        return raw_output
+
+    return _compiled_parse(compiled, raw_output, compact)
+
+
+def get_stream_parser(
+    platform: Optional[str] = None,
+    command: Optional[str] = None,
+    template: Optional[str] = None,
+) -> Optional[TextFSMStreamParser]:
+    """逐次解析用のパーサーを返却する
+
+    テンプレートが見つからない場合や、indexで複数テンプレートが指定されている場合はNoneを返す。
+    """
+    if template is not None:
+        try:
+            return TextFSMStreamParser(template_registry.get_template(template))
+        except FileNotFoundError:
+            return None
+
+    if platform is None or command is None:
+        raise ValueError("Either 'platform/command' or 'template' must be specified.")
+
+    paths = template_registry.lookup(platform, command)
+    if paths is None and "cisco_xe" in platform:
+        paths = template_registry.lookup("cisco_ios", command)
+    if paths is None or len(paths) > 1:
+        return None
+
+    try:
+        return TextFSMStreamParser(template_registry.get_template(paths[0]))
+    except FileNotFoundError:
+        return None
+
+
+def iter_structured_data_textfsm(
+    lines: Iterable[str],
+    platform: Optional[str] = None,
+    command: Optional[str] = None,
+    template: Optional[str] = None,
+) -> Iterator[Union[str, dict[str, Any]]]:
+    """行のイテラブルを逐次解析し、レコード(dict)を順に返却する
+
+    逐次解析できない場合は全行を受信してからget_structured_data_textfsmで解析し、
+    解析結果がなければ受信した行をそのまま返却する。
+    逐次解析では行を保持しないため、一致するレコードがない場合は何も返却しない。
+    """
+    parser = get_stream_parser(platform, command, template)
+    if parser is not None:
+        yield from parser.parse_iter(lines)
+        return
+
+    received = list(lines)
+    output = get_structured_data_textfsm(
+        "\n".join(received), platform=platform, command=command, template=template
+    )
+    if isinstance(output, str):
+        yield from received
+    else:
+        yield from output
+
+
+async def aiter_structured_data_textfsm(
+    lines: AsyncIterable[str],
+    platform: Optional[str] = None,
+    command: Optional[str] = None,
+    template: Optional[str] = None,
+    executor: Optional[Executor] = None,
+) -> AsyncIterator[Union[str, dict[str, Any]]]:
+    """iter_structured_data_textfsmの非同期版
+
+    1行分の解析は軽いためイベントループ上で行い、
+    逐次解析できない場合の一括解析だけをExecutorで実行する。
+    """
+    parser = get_stream_parser(platform, command, template)
+    if parser is not None:
+        async for line in lines:
+            for record in parser.feed(line):
+                yield record
+        for record in parser.close():
+            yield record
+        return
+
+    received = [line async for line in lines]
+    output = await get_structured_data_textfsm_async(
+        "\n".join(received), platform=platform, command=command, template=template,
+        executor=executor,
+    )
+    if isinstance(output, str):
+        for line in received:
+            yield line
+    else:
+        for record in output:
+            yield record
+
+
+# 非同期版send_commandで解析に使うExecutor。Noneの場合はイベントループ既定のスレッドプール
+_parse_executor: Optional[Executor] = None
+
+
+def set_parse_executor(executor: Optional[Executor]) -> None:
+    """非同期版の解析処理を実行するExecutorを設定する"""
+    global _parse_executor
+    _parse_executor = executor
+
+
+def get_parse_executor() -> Optional[Executor]:
+    return _parse_executor
+
+
+def _warm_templates(targets: list[tuple[str, str]]) -> None:
+    """ワーカープロセスの初期化時にテンプレートを事前にコンパイルする"""
+    for platform, command in targets:
+        try:
+            for path in template_registry.lookup(platform, command) or []:
+                template_registry.get_template(path)
+        except (ValueError, FileNotFoundError, CliTableError):
+            continue
+
+
+def create_parse_process_pool(
+    max_workers: Optional[int] = None, warm: Iterable[tuple[str, str]] = ()
+) -> ProcessPoolExecutor:
+    """テンプレートを事前コンパイルしたワーカーを持つプロセスプールを作成する
+
+    warmには事前にコンパイルしておく(platform, command)の組を指定する。
+    """
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_warm_templates, initargs=(list(warm),)
+    )
+
+
+def get_structured_data_textfsm_batch(
+    items: Iterable[dict[str, Any]],
+) -> list[Union[str, list[dict[str, str]]]]:
+    """複数の出力をまとめて解析する。itemsの各要素はget_structured_data_textfsmの引数"""
+    return [get_structured_data_textfsm(**item) for item in items]
+
+
+async def get_structured_data_textfsm_async(
+    raw_output: str,
+    platform: Optional[str] = None,
+    command: Optional[str] = None,
+    template: Optional[str] = None,
+    executor: Optional[Executor] = None,
+    compact: bool = False,
+) -> Union[str, list[dict[str, str]], ResultTable]:
+    """解析をExecutor上で実行し、イベントループを止めずに結果を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor or _parse_executor,
+        get_structured_data_textfsm,
+        raw_output,
+        platform,
+        command,
+        template,
+        compact,
+    )
+
+
+async def get_structured_data_textfsm_batch_async(
+    items: Iterable[dict[str, Any]],
+    executor: Optional[Executor] = None,
+    chunksize: int = 16,
+) -> list[Union[str, list[dict[str, str]]]]:
+    """複数の出力をchunksize件ずつExecutorに渡して並列に解析する"""
+    loop = asyncio.get_running_loop()
+    items = list(items)
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+    results = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                executor or _parse_executor, get_structured_data_textfsm_batch, chunk
+            )
+            for chunk in chunks
         )
+    )
+    return [output for chunk_result in results for output in chunk_result]
 
 
 def _textfsm_parse(
@@ -66,7 +465,8 @@ def _textfsm_parse(
     raw_output: str,
     attrs: dict[str, str],
     template_file: Optional[str] = None,
-) -> Union[str, list[dict[str, str]]]:
+    compact: bool = False,
+) -> Union[str, list[dict[str, str]], ResultTable]:
     tfsm_parse: Callable[..., Any] = textfsm_obj.ParseCmd
     try:
         if template_file is not None:
@@ -74,8 +474,11 @@ def _textfsm_parse(
         else:
             tfsm_parse(raw_output, attrs)
 
-        structured_data = clitable_to_dict(textfsm_obj)
-        if structured_data == []:
+        if compact:
+            structured_data: Union[list[dict[str, str]], ResultTable] = clitable_to_table(textfsm_obj)
+        else:
+            structured_data = clitable_to_dict(textfsm_obj)
+        if len(structured_data) == 0:
             return raw_output
         else:
             return structured_data
@@ -95,6 +498,11 @@ def clitable_to_dict(cli_table: clitable.CliTable) -> list[dict[str, str]]:
     return return_list
 
 
+def clitable_to_table(cli_table: clitable.CliTable) -> ResultTable:
+    header = [name.lower() for name in cli_table.header]
+    return ResultTable.from_rows(header, (row.values for row in cli_table))
+
+
 def get_template_dir(_skip_ntc_package: bool = False) -> str:
     msg = """
 Directory containing TextFSM index file not found.
@@ -0,0 +1,287 @@
+import os
+import gzip
+import queue
+import atexit
+import asyncio
+import itertools
+import threading
+from datetime import datetime
+from typing import Any, BinaryIO, Optional
+
+from pexnetlib.log import log
+
+# 圧縮方式ごとのファイル拡張子
+_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def _zstd_available() -> bool:
+    try:
+        from compression import zstd  # noqa: F401  (Python 3.14以降の標準ライブラリ)
+        return True
+    except ImportError:
+        pass
+    try:
+        import zstandard  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def resolve_compression(compression: Optional[str]) -> Optional[str]:
+    """利用可能な圧縮方式を返却する。zstdが使えない場合はgzipにフォールバックする"""
+    if compression not in _SUFFIXES:
+        raise ValueError(f"Unsupported compression: {compression}")
+    if compression == "zstd" and not _zstd_available():
+        log.warning("zstd is not available. Falling back to gzip.")
+        return "gzip"
+    return compression
+
+
+def _open_file(path: str, compression: Optional[str]) -> BinaryIO:
+    if compression == "gzip":
+        return gzip.open(path, "ab")
+    if compression == "zstd":
+        try:
+            from compression import zstd
+            return zstd.open(path, "ab")
+        except ImportError:
+            import zstandard
+            return zstandard.ZstdCompressor().stream_writer(open(path, "ab"), closefd=True)
+    return open(path, "ab")
+
+
+class TranscriptFlusher:
+    """TranscriptWriterのブロックをバックグラウンドスレッドで圧縮・書き込みする
+
+    ファイルへの書き込みと圧縮はすべてこのスレッドで行うため、受信処理側はメモリコピーだけで済む。
+    1つのスレッドを複数セッションで共有し、キューの順に処理するためセッション内の順序は保たれる。
+    """
+
+    def __init__(self) -> None:
+        self._queue: "queue.SimpleQueue[tuple[Any, Optional[bytes]]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, writer: "TranscriptWriter", block: Optional[bytes]) -> None:
+        """ブロックを書き込み待ちに追加する。blockがNoneの場合はファイルを閉じる"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="pexnetlib-transcript", daemon=True
+                )
+                self._thread.start()
+        self._queue.put((writer, block))
+
+    def stop(self) -> None:
+        """キューに残ったブロックをすべて書き込んでからスレッドを停止する"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put((None, None))
+            thread.join()
+
+    def _run(self) -> None:
+        while True:
+            writer, block = self._queue.get()
+            if writer is None:
+                return
+            try:
+                if block is None:
+                    writer._close_file()
+                else:
+                    writer._write_block(block)
+            except Exception:
+                log.exception("Failed to write transcript: %s", writer.path)
+                writer._release(len(block) if block else 0)
+
+
+_default_flusher: Optional[TranscriptFlusher] = None
+_default_lock = threading.Lock()
+
+
+def get_default_flusher() -> TranscriptFlusher:
+    global _default_flusher
+    with _default_lock:
+        if _default_flusher is None:
+            _default_flusher = TranscriptFlusher()
+            # プロセス終了時に未書き込みのブロックを失わないようにする
+            atexit.register(_default_flusher.stop)
+        return _default_flusher
+
+
+class TranscriptWriter:
+    """1セッション分のトランスクリプトを書き出すバッファ付きライタ
+
+    write()は受信データをメモリ上のバッファに追加するだけで、block_sizeに達すると
+    ブロック単位でTranscriptFlusherに渡す。書き込み待ちがmax_pendingを超えた場合、
+    overflow="block"ではwait_writable()/drain()が書き込みの完了を待ち(背圧)、
+    overflow="drop"ではブロックを捨ててdroppedに加算する。
+    max_bytesを指定した場合は非圧縮サイズで超えた時点でファイルをローテーションする。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compression: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        backup_count: int = 5,
+        block_size: int = 256 * 1024,
+        max_pending: int = 8 * 1024 * 1024,
+        overflow: str = "block",
+        flusher: Optional[TranscriptFlusher] = None,
+    ) -> None:
+        if overflow not in ("block", "drop"):
+            raise ValueError(f"Unsupported overflow policy: {overflow}")
+        self.compression = resolve_compression(compression)
+        self.path = path + _SUFFIXES[self.compression]
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.block_size = block_size
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.flusher = flusher or get_default_flusher()
+        self.dropped = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._done = threading.Event()
+        # 以下はフラッシュスレッドだけが触る
+        self._file: Optional[BinaryIO] = None
+        self._file_bytes = 0
+
+    @property
+    def pending(self) -> int:
+        """フラッシュスレッドに渡して書き込みが終わっていないバイト数"""
+        return self._pending
+
+    def write(self, data: bytes) -> int:
+        if self.closed:
+            raise ValueError("write to closed transcript")
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def flush(self) -> None:
+        """バッファ中のデータをフラッシュスレッドに渡す(書き込み完了は待たない)"""
+        if self._buffer:
+            self._submit()
+
+    def writable(self) -> bool:
+        return self.overflow == "drop" or self._pending <= self.max_pending
+
+    def wait_writable(self, timeout: Optional[float] = None) -> bool:
+        """書き込み待ちがmax_pending以下になるまで待つ"""
+        with self._cond:
+            return self._cond.wait_for(self.writable, timeout)
+
+    async def drain(self) -> None:
+        """wait_writableの非同期版。イベントループは止めない"""
+        while not self.writable():
+            await asyncio.sleep(0.01)
+
+    def close(self, wait: bool = False) -> None:
+        """残りのデータを渡してファイルを閉じる。wait=Trueの場合は書き込み完了まで待つ"""
+        if not self.closed:
+            self.flush()
+            self.closed = True
+            self.flusher.submit(self, None)
+        if wait:
+            self._done.wait()
+
+    def __enter__(self) -> "TranscriptWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close(wait=True)
+
+    def _submit(self) -> None:
+        block = bytes(self._buffer)
+        self._buffer = bytearray()
+        with self._cond:
+            if self.overflow == "drop" and self._pending > self.max_pending:
+                self.dropped += len(block)
+                return
+            self._pending += len(block)
+        self.flusher.submit(self, block)
+
+    def _release(self, size: int) -> None:
+        with self._cond:
+            self._pending -= size
+            self._cond.notify_all()
+
+    def _write_block(self, block: bytes) -> None:
+        if self.max_bytes and self._file_bytes and self._file_bytes + len(block) > self.max_bytes:
+            self._rotate()
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = _open_file(self.path, self.compression)
+            self._file_bytes = 0
+        self._file.write(block)
+        self._file_bytes += len(block)
+        self._release(len(block))
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _close_file(self) -> None:
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._done.set()
+
+
+class TranscriptManager:
+    """セッションごとのTranscriptWriterを作成する
+
+    接続クラスのtranscriptに指定すると、接続ごとに
+    directory/{ip}_{日時}_{連番}.log(圧縮時は.gz/.zst付き)へ受信データを書き出す。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        compression: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        backup_count: int = 5,
+        block_size: int = 256 * 1024,
+        max_pending: int = 8 * 1024 * 1024,
+        overflow: str = "block",
+        flusher: Optional[TranscriptFlusher] = None,
+    ) -> None:
+        self.directory = directory
+        self.compression = resolve_compression(compression)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.block_size = block_size
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.flusher = flusher
+        self._counter = itertools.count()
+
+    def open(self, name: str) -> TranscriptWriter:
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        filename = f"{name}_{timestamp}_{os.getpid()}-{next(self._counter)}.log"
+        return TranscriptWriter(
+            os.path.join(self.directory, filename),
+            compression=self.compression,
+            max_bytes=self.max_bytes,
+            backup_count=self.backup_count,
+            block_size=self.block_size,
+            max_pending=self.max_pending,
+            overflow=self.overflow,
+            flusher=self.flusher,
+        )
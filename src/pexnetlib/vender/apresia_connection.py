@@ -3,22 +3,24 @@ from pexnetlib.async_base_connection import AsyncBaseConnection
 
 class ApresiaConnection(BaseConnection):
     def __init__(
-        self, device, timeout, use_username, login_prompt="login"
+        self, device, timeout, use_username, login_prompt="login", **kwargs
     ) -> None:
         super().__init__(
             device,
             timeout=timeout,
             use_username=use_username,
             login_prompt=login_prompt,
+            **kwargs,
         )
 
 class ApresiaConnectionAsync(AsyncBaseConnection):
     def __init__(
-        self, device, timeout, use_username, login_prompt="login"
+        self, device, timeout, use_username, login_prompt="login", **kwargs
     ) -> None:
         super().__init__(
             device,
             timeout=timeout,
             use_username=use_username,
             login_prompt=login_prompt,
+            **kwargs,
         )
\ No newline at end of file
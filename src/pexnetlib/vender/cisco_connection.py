@@ -1,31 +1,33 @@
 from pexnetlib.base_connection import BaseConnection
 from pexnetlib.async_base_connection import AsyncBaseConnection
+from pexnetlib.sanitizer import strip_exec_timestamp
 
 class CiscoConnection(BaseConnection):
-    def __init__(self, device, use_username, timeout) -> None:
+    # terminal exec prompt timestampで出力される時刻情報を取り除く
+    sanitize_steps = (strip_exec_timestamp,)
+    init_commands = ("terminal length 0", "terminal exec prompt timestamp")
+    paging = False
+
+    def __init__(self, device, use_username, timeout, **kwargs) -> None:
         super().__init__(
-            device=device, use_username=use_username, timeout=timeout
+            device=device, use_username=use_username, timeout=timeout, **kwargs
         )
 
-    def initialize(self) -> None:
-        self.send_command("terminal length 0")
-        self.send_command("terminal exec prompt timestamp")
-
     def enable(self) -> None:
         self.send_command(f"enable", prompt=self.password_prompt)
         self.send_command(self.device.enable, prompt="#")
         self.hostname, self.prompt = self.find_prompt("#")
 
 class CiscoConnectionAsync(AsyncBaseConnection):
-    def __init__(self, device, use_username, timeout) -> None:
+    sanitize_steps = (strip_exec_timestamp,)
+    init_commands = ("terminal length 0", "terminal exec prompt timestamp")
+    paging = False
+
+    def __init__(self, device, use_username, timeout, **kwargs) -> None:
         super().__init__(
-            device=device, use_username=use_username, timeout=timeout
+            device=device, use_username=use_username, timeout=timeout, **kwargs
         )
 
-    async def initialize(self) -> None:
-        await self.send_command("terminal length 0")
-        await self.send_command("terminal exec prompt timestamp")
-
     async def enable(self) -> None:
         await self.send_command(f"enable", prompt=self.password_prompt)
         await self.send_command(self.device.enable, prompt="#")
@@ -0,0 +1,81 @@
+from typing import Optional
+
+from pexnetlib.base_connection import BaseConnection
+from pexnetlib.async_base_connection import AsyncBaseConnection
+from pexnetlib.log import log
+from pexnetlib.logging_io import AsyncLogginIO, LoggingIO
+from pexnetlib.replay import (
+    ReplayArchive,
+    ReplayChild,
+    ReplayReader,
+    ReplayTransport,
+    ReplayWriter,
+    resolve_archive,
+)
+
+
+def _replay_platform(archive: ReplayArchive, ip: str, device_type: str) -> str:
+    # 記録時のdevice_typeがあればそれを使い、なければ cisco_replay -> cisco_telnet とみなす
+    recorded = archive.device_info(ip)["device_type"]
+    return recorded or device_type.replace("_replay", "_telnet")
+
+
+class ReplayConnection(BaseConnection):
+    """アーカイブに記録したコマンド出力を返す再生用の接続
+
+    装置には接続せず、send_commandなどは記録済みの出力をmmapから読み出して処理する。
+    送受信の経路(expect、整形、TextFSM解析、計測)は通常の接続と共通。
+    """
+
+    def __init__(self, device, use_username, timeout, archive=None, **kwargs) -> None:
+        self.archive = resolve_archive(archive)
+        self.replay_transport: Optional[ReplayTransport] = None
+        super().__init__(
+            device=device, use_username=use_username, timeout=timeout, **kwargs
+        )
+
+    @property
+    def textfsm_platform(self) -> str:
+        return _replay_platform(self.archive, self.device.ip, self.device.device_type)
+
+    def connect(self) -> None:
+        hostname = self.archive.device_info(self.device.ip)["hostname"] or self.device.ip
+        self.replay_transport = ReplayTransport(self.archive, self.device.ip, hostname, self.user_prompt)
+        self.child = ReplayChild(self.replay_transport)
+        if self.session_log is not None:
+            self.child.logfile_read = LoggingIO(log, sink=self.session_log)
+
+    def enable(self) -> None:
+        if self.replay_transport is None:
+            raise RuntimeError
+        self.replay_transport.prompt_char = self.enable_prompt
+        self.hostname, self.prompt = self.find_prompt(self.enable_prompt)
+
+
+class ReplayConnectionAsync(AsyncBaseConnection):
+    """ReplayConnectionの非同期版"""
+
+    def __init__(self, device, use_username, timeout, archive=None, **kwargs) -> None:
+        self.archive = resolve_archive(archive)
+        self.replay_transport: Optional[ReplayTransport] = None
+        super().__init__(
+            device=device, use_username=use_username, timeout=timeout, **kwargs
+        )
+
+    @property
+    def textfsm_platform(self) -> str:
+        return _replay_platform(self.archive, self.device.ip, self.device.device_type)
+
+    async def connect(self) -> None:
+        hostname = self.archive.device_info(self.device.ip)["hostname"] or self.device.ip
+        self.replay_transport = ReplayTransport(self.archive, self.device.ip, hostname, self.user_prompt)
+        self.reader = ReplayReader(self.replay_transport)
+        if self.session_log is not None:
+            self.reader = AsyncLogginIO(self.reader, log, sink=self.session_log)
+        self.writer = ReplayWriter(self.replay_transport)
+
+    async def enable(self) -> None:
+        if self.replay_transport is None:
+            raise RuntimeError
+        self.replay_transport.prompt_char = self.enable_prompt
+        self.hostname, self.prompt = await self.find_prompt(self.enable_prompt)